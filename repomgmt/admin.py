@@ -16,13 +16,14 @@
 #   limitations under the License.
 #
 from django.contrib import admin
-from repomgmt.models import Architecture, Repository, BuildNode
+from repomgmt.models import Architecture, Repository, BuildNode, BuildNodeImage
 from repomgmt.models import Cloud, KeyPair, Series, ChrootTarball
 from repomgmt.models import UploaderKey
 
 admin.site.register(Architecture)
 admin.site.register(Repository)
 admin.site.register(BuildNode)
+admin.site.register(BuildNodeImage)
 admin.site.register(Cloud)
 admin.site.register(KeyPair)
 admin.site.register(Series)
@@ -224,6 +224,7 @@ class RepositoryResource(ModelResource):
     class Meta:
         queryset = Repository.objects.all()
         resource_name = 'repository'
+        excludes = ['config_write_scheduled', 'reprepro_queue_claimed']
         authentication = MultiAuthentication(BasicAuthentication(),
                                              ApiKeyAuthenticationWithHeaderSupport())
         authorization = DjangoAuthorizationWithObjLevelPermissions()
@@ -284,8 +285,10 @@ class SeriesResource(ModelResource):
         basic_bundle = self.build_bundle(request=request)
         obj = self.cached_obj_get(bundle=basic_bundle, **self.remove_api_resource_names(kwargs))
         if deserialized.get('action', None) == 'promote':
-            obj.promote()
-            return HttpAccepted()
+            op = obj.promote()
+            response = HttpAccepted()
+            response['X-Reprepro-Operation'] = str(op.pk)
+            return response
         return http.HttpBadRequest()
 
     def __get_resource_uri(self, bundle_or_obj=None, url_name='api_dispatch_list'):
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""Hands a reprepro notifier event to repo-hook-daemon
+
+Usage: hookclient.py <socket> <spool dir> <hook> [<hook args>...]
+
+This runs once for every package reprepro adds or removes, so it
+deliberately imports neither Django nor the rest of repomgmt. If the
+daemon can't be reached, the event is left in the spool directory for
+the daemon to pick up once it's back."""
+import errno
+import itertools
+import json
+import os
+import socket
+import sys
+import time
+
+TIMEOUT = 10
+
+_counter = itertools.count()
+
+
+def spool_name():
+    # Sorts in the order events were spooled
+    return '%017.6f-%06d-%06d.json' % (time.time(), os.getpid(),
+                                       _counter.next())
+
+
+def spool(spool_dir, event):
+    try:
+        os.makedirs(spool_dir, 0770)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    name = spool_name()
+    tmp = os.path.join(spool_dir, '.%s' % (name,))
+    with open(tmp, 'w') as fp:
+        json.dump(event, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmp, os.path.join(spool_dir, name))
+    return name
+
+
+def send(socket_path, event):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(TIMEOUT)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(event) + '\n')
+        reply = sock.makefile().readline()
+    finally:
+        sock.close()
+    if reply.strip() != 'ok':
+        raise IOError('Unexpected reply from hook daemon: %r' % (reply,))
+
+
+def main(argv):
+    if len(argv) < 4:
+        sys.stderr.write(__doc__)
+        return 1
+    socket_path, spool_dir, hook = argv[1:4]
+    event = {'hook': hook,
+             'args': argv[4:],
+             'env': dict((k, v) for k, v in os.environ.iteritems()
+                         if k.startswith('REPREPRO_'))}
+    try:
+        send(socket_path, event)
+    except (socket.error, IOError), e:
+        sys.stderr.write('Could not reach hook daemon (%s). Spooling the '
+                         'event instead.\n' % (e,))
+        spool(spool_dir, event)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,63 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from repomgmt.models import BuildRecord
+
+
+def read_summary(pk):
+    try:
+        return pk, BuildRecord(pk=pk).parse_summary()
+    except Exception:
+        # Logs of builds that never got as far as sbuild's summary
+        return pk, None
+
+
+class Command(BaseCommand):
+    args = '[<processes>]'
+    help = 'Stores the sbuild summary of finished builds that lack one'
+
+    def handle(self, processes=None, **options):
+        if processes is not None:
+            processes = int(processes)
+
+        builds = BuildRecord.objects.filter(finished__isnull=False,
+                                            sbuild_status='')
+        jobs = [pk for pk in builds.values_list('pk', flat=True)
+                if BuildRecord(pk=pk).log() is not None]
+
+        # The worker processes only read log files. Don't let them
+        # inherit our database connection.
+        connection.close()
+
+        pool = multiprocessing.Pool(processes)
+        stored = 0
+        try:
+            for pk, summary in pool.imap_unordered(read_summary, jobs,
+                                                   chunksize=100):
+                if summary and 'Status' in summary:
+                    BuildRecord(pk=pk).store_summary(summary)
+                    stored += 1
+        finally:
+            pool.close()
+            pool.join()
+
+        self.stdout.write('Stored summaries for %d of %d builds\n' %
+                          (stored, len(jobs)))
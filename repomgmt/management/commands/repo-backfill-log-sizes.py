@@ -0,0 +1,33 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from django.core.management.base import BaseCommand
+from repomgmt.models import BuildRecord
+
+
+class Command(BaseCommand):
+    help = 'Records the log sizes of finished builds that lack one'
+
+    def handle(self, **options):
+        builds = BuildRecord.objects.filter(finished__isnull=False,
+                                            log_expired=False,
+                                            log_bytes__isnull=True)
+        stored = 0
+        for br in builds.only('id').iterator():
+            br.store_log_bytes()
+            stored += 1
+        self.stdout.write('Recorded the log sizes of %d builds\n' % (stored,))
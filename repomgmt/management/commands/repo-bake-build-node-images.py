@@ -0,0 +1,35 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from django.core.management.base import BaseCommand
+from repomgmt.models import BuildNodeImage, ChrootTarball, Cloud
+
+
+class Command(BaseCommand):
+    args = '[<cloud>]'
+    help = 'Bakes build node images for all ready tarballs that lack a current one'
+
+    def handle(self, cloud_arg=None, **options):
+        if cloud_arg:
+            clouds = Cloud.objects.filter(name=cloud_arg)
+        else:
+            clouds = Cloud.objects.all()
+
+        for cloud in clouds:
+            for tb in ChrootTarball.objects.filter(state=ChrootTarball.READY):
+                if BuildNodeImage.usable_image(cloud, tb) is None:
+                    BuildNodeImage.bake(cloud, tb)
@@ -0,0 +1,112 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from repomgmt.models import Architecture, BuildNode, BuildRecord, Cloud
+from repomgmt.models import Repository, Series, UbuntuSeries
+
+
+class Command(BaseCommand):
+    args = '[<records> [<workers>]]'
+    help = ('Measures how fast concurrent workers claim builds from a '
+            'throwaway test database')
+
+    def populate(self, records, workers):
+        # bulk_create skips Repository.save() and Series.save(), which
+        # would otherwise go and write reprepro configuration.
+        UbuntuSeries.objects.get_or_create(name='precise')
+        Architecture.objects.get_or_create(name='amd64')
+        Cloud.objects.get_or_create(name='bench')
+        Repository.objects.bulk_create([Repository(name='bench')])
+        Series.objects.bulk_create([Series(name='bench',
+                                           repository_id='bench',
+                                           base_ubuntu_series_id='precise',
+                                           numerical_version='1')])
+        series = Series.objects.get(name='bench')
+        BuildNode.objects.bulk_create([BuildNode(name='bench%d' % (i,),
+                                                 cloud_id='bench',
+                                                 state=BuildNode.BUILDING)
+                                       for i in range(workers)])
+        for start in range(0, records, 1000):
+            count = min(1000, records - start)
+            BuildRecord.objects.bulk_create(
+                [BuildRecord(source_package_name='pkg%d' % (start + i,),
+                             version='1.0',
+                             architecture_id='amd64',
+                             series=series,
+                             priority=random.randint(0, 200))
+                 for i in range(count)])
+
+    def claim_all(self, build_node, claims, skip_locked):
+        while BuildRecord.pick_build(build_node, skip_locked=skip_locked):
+            claims.append(time.time())
+
+    def claim_all_in_thread(self, *args):
+        try:
+            self.claim_all(*args)
+        finally:
+            connection.close()
+
+    def run_workers(self, workers, skip_locked):
+        BuildRecord.objects.update(build_node=None)
+        claims = []
+        build_nodes = BuildNode.objects.all()[:workers]
+        start = time.time()
+        if workers == 1:
+            self.claim_all(build_nodes[0], claims, skip_locked)
+            return len(claims), time.time() - start
+
+        threads = [threading.Thread(target=self.claim_all_in_thread,
+                                    args=(build_node, claims, skip_locked))
+                   for build_node in build_nodes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(claims), time.time() - start
+
+    def handle(self, records='100000', workers='8', **options):
+        records = int(records)
+        workers = int(workers)
+        if connection.vendor == 'sqlite':
+            self.stderr.write('SQLite test databases live in memory and '
+                              'cannot be shared between threads. '
+                              'Claiming from a single worker.\n')
+            workers = 1
+
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True)
+        try:
+            self.populate(records, workers)
+            strategies = [False]
+            if BuildRecord.supports_skip_locked():
+                strategies.append(True)
+            for skip_locked in strategies:
+                claimed, elapsed = self.run_workers(workers, skip_locked)
+                self.stdout.write('%s: %d workers claimed %d of %d builds '
+                                  'in %.2fs (%.0f claims/s)\n' %
+                                  (skip_locked and 'skip locked' or
+                                   'conditional update',
+                                   workers, claimed, records, elapsed,
+                                   claimed / elapsed))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
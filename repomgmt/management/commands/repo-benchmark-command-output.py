@@ -0,0 +1,80 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import time
+
+from django.core.management.base import BaseCommand
+from repomgmt import utils
+
+
+def quadratic_output(chunks, log):
+    # How BuildNode._run_cmd used to collect output
+    def log_whole_lines(lbuf):
+        while '\n' in lbuf:
+            line, lbuf = lbuf.split('\n', 1)
+            log(line)
+        return lbuf
+
+    out = ''
+    lbuf = ''
+    for data in chunks:
+        out += data
+        lbuf += data
+        lbuf = log_whole_lines(lbuf)
+
+    lbuf = log_whole_lines(lbuf)
+    log(lbuf)
+    return out
+
+
+def streamed_output(chunks, log, keep):
+    output = utils.CommandOutput(log, keep=keep)
+    for data in chunks:
+        output.feed(data)
+    output.close()
+    return output.getvalue()
+
+
+class Command(BaseCommand):
+    args = '[<megabytes>]'
+    help = ('Compares how fast command output is collected before and '
+            'after streaming it')
+
+    def stream(self, megabytes):
+        line = 'x' * 79 + '\n'
+        block = line * (4096 / len(line))
+        blocks = megabytes * 1024 * 1024 / len(block)
+        return [block] * blocks
+
+    def time(self, label, func, chunks):
+        lines = [0]
+
+        def log(s):
+            lines[0] += 1
+
+        start = time.time()
+        out = func(chunks, log)
+        self.stdout.write('%-28s %6.2fs, %d lines, %d bytes kept\n' %
+                          (label, time.time() - start, lines[0], len(out)))
+
+    def handle(self, megabytes='50', **options):
+        chunks = self.stream(int(megabytes))
+        self.time('before (out += data):', quadratic_output, chunks)
+        self.time('after, output kept:',
+                  lambda c, log: streamed_output(c, log, True), chunks)
+        self.time('after, output discarded:',
+                  lambda c, log: streamed_output(c, log, False), chunks)
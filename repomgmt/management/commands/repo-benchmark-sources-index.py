@@ -0,0 +1,108 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from repomgmt import utils
+
+STANZA = '''\
+Package: %(name)s
+Binary: %(name)s, %(name)s-common, python-%(name)s
+Version: %(version)s
+Maintainer: Nobody <nobody@example.com>
+Build-Depends: debhelper (>= 8.0.0), python-all (>= 2.6.6-3~)
+Architecture: all
+Standards-Version: 3.9.3
+Format: 3.0 (quilt)
+Directory: pool/main/%(initial)s/%(name)s
+Files:
+ 0123456789abcdef0123456789abcdef 1234 %(name)s_%(version)s.dsc
+ 0123456789abcdef0123456789abcdef 123456 %(name)s_%(version)s.orig.tar.gz
+Checksums-Sha256:
+ %(sha)s 1234 %(name)s_%(version)s.dsc
+ %(sha)s 123456 %(name)s_%(version)s.orig.tar.gz
+
+'''
+
+
+class Command(BaseCommand):
+    args = '[<sources>]'
+    help = ("Compares reading a series' source packages from its Sources "
+            'indices with listing them with reprepro')
+
+    def write_files(self, tmpdir, sources):
+        index = os.path.join(tmpdir, 'Sources.gz')
+        listing = os.path.join(tmpdir, 'listing')
+        fp = gzip.open(index, 'wb')
+        lfp = open(listing, 'w')
+        for i in range(sources):
+            info = {'name': 'package%d' % (i,),
+                    'initial': 'p',
+                    'version': '2012.2.%d-0ubuntu1' % (i,),
+                    'sha': '%064x' % (i,)}
+            fp.write(STANZA % info)
+            lfp.write('folsom|main|source: %(name)s %(version)s\n' % info)
+        fp.close()
+        lfp.close()
+        return index, listing
+
+    def time(self, label, func, runs):
+        start = time.time()
+        for i in range(runs):
+            pkgs = func()
+        self.stdout.write('%-32s %8.2fms per page view, %d packages\n' %
+                          (label, (time.time() - start) * 1000 / runs,
+                           len(pkgs)))
+
+    def handle(self, sources='5000', **options):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            index, listing = self.write_files(tmpdir, int(sources))
+
+            def subprocess_path():
+                # One "reprepro list" per pocket. cat stands in for reprepro,
+                # so its database reads and lock waits aren't counted.
+                for pocket in range(3):
+                    pkgs = {}
+                    for l in subprocess.check_output(['cat', listing]).split('\n'):
+                        fields = l.split()
+                        if len(fields) == 3:
+                            pkgs[fields[1]] = fields[2]
+                return pkgs
+
+            def cold_index():
+                for pocket in range(3):
+                    utils._sources_cache.clear()
+                    pkgs = utils.read_sources_index(index)
+                return pkgs
+
+            def warm_index():
+                for pocket in range(3):
+                    pkgs = utils.read_sources_index(index)
+                return pkgs
+
+            self.time('subprocess (cat as reprepro):', subprocess_path, 10)
+            self.time('Sources.gz, not cached:', cold_index, 10)
+            self.time('Sources.gz, cached:', warm_index, 10)
+        finally:
+            shutil.rmtree(tmpdir)
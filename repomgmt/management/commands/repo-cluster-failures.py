@@ -0,0 +1,42 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import os
+
+from django.core.management.base import BaseCommand
+from repomgmt.models import BuildRecord, PackageSourceBuildProblem
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Assigns failure signatures to failed builds and package '
+            'source build problems that do not have one yet')
+
+    def handle(self, **options):
+        builds = BuildRecord.objects.filter(
+                     state__in=[BuildRecord.FAILED_TO_BUILD,
+                                BuildRecord.DEPENDENCY_WAIT],
+                     failure_signature__isnull=True)
+        for br in builds.order_by('finished'):
+            br.record_failure_signature()
+
+        problems = PackageSourceBuildProblem.objects.filter(
+                       failure_signature__isnull=True)
+        for problem in problems.order_by('timestamp'):
+            if not os.path.exists(problem.log_file()):
+                continue
+            problem.record_failure_signature(problem.log_file_contents())
@@ -0,0 +1,44 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import os
+
+from django.core.management.base import BaseCommand
+from repomgmt.models import BuildRecord
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Compresses build logs written before logs were compressed'
+
+    def handle(self, **options):
+        for br in BuildRecord.objects.filter(finished__isnull=False):
+            if (br.compressed_log().exists() or
+                    not os.path.exists(br.logfile())):
+                continue
+
+            writer = br.log_writer()
+            try:
+                with open(br.logfile(), 'rb') as fp:
+                    while True:
+                        data = fp.read(writer.block_size)
+                        if not data:
+                            break
+                        writer.write(data)
+            finally:
+                writer.close()
+            os.unlink(br.logfile())
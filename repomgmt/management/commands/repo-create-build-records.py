@@ -22,7 +22,7 @@ from debian_bundle.deb822 import Changes, Dsc
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from repomgmt.models import Architecture, BuildRecord, Repository, Series
+from repomgmt.models import BuildRecord, Repository
 
 
 def get_repository_name():
@@ -49,53 +49,29 @@ class Command(BaseCommand):
     args = '<action> <distribution> <source name> <version> <changes file>'
     help = 'Creates build records for new source uploads'
 
-    def handle(self, action, codename, pkg_type, component, architecture,
-                     pkg_name, pkg_version, *files, **options):
-        if action != 'add' and action != 'replace':
-            return
-
-        if os.environ.get('REPREPRO_CAUSING_COMMAND') not in ('processincoming', 'pull'):
-            # Only create build record if called by processincoming
-            return
-
-        if 'repository' in options:
-            repository_name = options['repository']
-        else:
-            repository_name = get_repository_name()
-
-        repository = Repository.objects.get(name=repository_name)
-        series_name = codename[:-len('-proposed')]
-        series = Series.objects.get(repository=repository, name=series_name)
-
-        known_archs = dict([(arch.name, arch) for arch in Architecture.objects.all()])
-
-        dsc = None
-        for f in files:
-            if f.endswith('.dsc'):
-                dsc = f
-                break
-        if dsc is None:
-            raise Exception('Adding dsc without .dsc file?!?')
-
-        dsc = parse_dsc_file(os.path.join(repository.reprepro_outdir, dsc))
-
-        requested_archs = dsc['Architecture'].split(' ')
-
-        build_archs = set()
-
-        for arch in requested_archs:
-            if arch == 'all':
-                build_archs.add(known_archs['i386'])
-            elif arch == 'any':
-                build_archs.update(known_archs.values())
-            elif arch in known_archs:
-                build_archs.add(known_archs[arch])
-
-        print build_archs
-        for arch in build_archs:
-            br = BuildRecord(source_package_name=pkg_name,
-                             version=pkg_version,
-                             architecture=arch,
-                             state=BuildRecord.NEEDS_BUILDING,
-                             series=series)
-            br.save()
+    def handle(self, *args, **options):
+        self.handle_many([(args, options)])
+
+    def handle_many(self, calls):
+        """Creates the build records for several hook calls at once"""
+        uploads = {}
+        for args, options in calls:
+            causing_command = options.get('causing_command',
+                                          os.environ.get('REPREPRO_CAUSING_COMMAND'))
+            if causing_command not in ('processincoming', 'pull'):
+                # Only create build record if called by processincoming
+                continue
+
+            upload = BuildRecord.upload_from_hook_args(args)
+            if upload is None:
+                continue
+
+            if 'repository' in options:
+                repository_name = options['repository']
+            else:
+                repository_name = get_repository_name()
+            uploads.setdefault(repository_name, []).append(upload)
+
+        for repository_name, repository_uploads in uploads.iteritems():
+            repository = Repository.objects.get(name=repository_name)
+            BuildRecord.create_for_uploads(repository, repository_uploads)
@@ -0,0 +1,226 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import json
+import logging
+import os
+import SocketServer
+import threading
+import time
+
+from django.conf import settings
+from django.core.management import load_command_class
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from repomgmt import hookclient, utils
+
+logger = logging.getLogger(__name__)
+
+# Hooks the daemon handles, and whether they only touch the database.
+# Those are applied in batches, in a single transaction. The rest are
+# run one at a time once the batch is committed.
+#
+# process-changes.sh doesn't go through the daemon: it has to read the
+# .changes file before processincoming deletes it, and it deletes build
+# nodes, which no transaction can roll back. It's only here for events
+# spooled by older hook scripts.
+HOOKS = {'create-build-records': True,
+         'update-source-packages': True,
+         'import-dsc-to-git': False,
+         'process-changes': False}
+
+
+class HookSpool(object):
+    """Events waiting to be applied, one file each, oldest first"""
+    def __init__(self, path):
+        self.path = path
+        self.failed_path = os.path.join(path, 'failed')
+
+    def add(self, event):
+        return hookclient.spool(self.path, event)
+
+    def pending(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith('.json') and not name.startswith('.'))
+
+    def load(self, name):
+        with open(os.path.join(self.path, name), 'r') as fp:
+            return json.load(fp)
+
+    def done(self, name):
+        os.unlink(os.path.join(self.path, name))
+
+    def failed(self, name):
+        if not os.path.isdir(self.failed_path):
+            os.makedirs(self.failed_path)
+        os.rename(os.path.join(self.path, name),
+                  os.path.join(self.failed_path, name))
+
+
+class HookHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        self.connection.settimeout(hookclient.TIMEOUT)
+        try:
+            event = json.loads(self.rfile.readline())
+            if event.get('hook') not in HOOKS:
+                raise ValueError('Unknown hook %r' % (event.get('hook'),))
+        except Exception, e:
+            self.wfile.write('error: %s\n' % (e,))
+            return
+        self.server.spool.add(event)
+        self.wfile.write('ok\n')
+        self.server.wakeup.set()
+
+
+class HookServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, spool):
+        self.spool = spool
+        self.wakeup = threading.Event()
+        if os.path.exists(path):
+            # Left behind by a daemon that didn't shut down cleanly
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, HookHandler)
+        os.chmod(path, 0660)
+
+
+class Command(BaseCommand):
+    args = '[drain]'
+    help = ('Applies reprepro hook events sent by hookclient.py. With '
+            '"drain", applies whatever is spooled and exits.')
+
+    _commands = {}
+
+    def command(self, hook):
+        if hook not in self._commands:
+            self._commands[hook] = load_command_class('repomgmt',
+                                                      'repo-%s' % (hook,))
+        return self._commands[hook]
+
+    def options(self, event):
+        env = event.get('env', {})
+        repository_name = env['REPREPRO_BASE_DIR'][
+                              len(settings.BASE_REPO_DIR):].strip('/')
+        return {'repository': repository_name,
+                'causing_command': env.get('REPREPRO_CAUSING_COMMAND')}
+
+    def dispatch(self, event):
+        self.command(event['hook']).handle(*event['args'],
+                                           **self.options(event))
+
+    def dispatch_all(self, events):
+        """Dispatches events, in one go for hooks that can do that"""
+        grouped = {}
+        for event in events:
+            command = self.command(event['hook'])
+            if hasattr(command, 'handle_many'):
+                grouped.setdefault(event['hook'], []).append(
+                                      (event['args'], self.options(event)))
+            else:
+                self.dispatch(event)
+        for hook, calls in grouped.iteritems():
+            self.command(hook).handle_many(calls)
+
+    def apply(self, spool, names):
+        events = []
+        for name in names:
+            try:
+                events.append((name, spool.load(name)))
+            except (IOError, ValueError):
+                logger.error('Unreadable hook event %s' % (name,),
+                             exc_info=True)
+                spool.failed(name)
+
+        db_events = [(n, e) for n, e in events if HOOKS.get(e.get('hook'))]
+        other_events = [(n, e) for n, e in events
+                        if not HOOKS.get(e.get('hook'))]
+        failed = set()
+
+        try:
+            with transaction.commit_on_success():
+                self.dispatch_all([event for name, event in db_events])
+        except Exception:
+            logger.warning('Applying a batch of %d hook events failed. '
+                           'Retrying them one by one.' % (len(db_events),),
+                           exc_info=True)
+            for name, event in db_events:
+                try:
+                    with transaction.commit_on_success():
+                        self.dispatch(event)
+                except Exception:
+                    logger.error('Hook event %s failed' % (name,),
+                                 exc_info=True)
+                    failed.add(name)
+
+        for name, event in other_events:
+            try:
+                if event.get('hook') not in HOOKS:
+                    raise ValueError('Unknown hook %r' % (event.get('hook'),))
+                self.dispatch(event)
+            except Exception:
+                logger.error('Hook event %s failed' % (name,), exc_info=True)
+                failed.add(name)
+
+        for name, event in events:
+            if name in failed:
+                spool.failed(name)
+            else:
+                spool.done(name)
+        return len(events) - len(failed)
+
+    def drain(self, spool):
+        batch_size = getattr(settings, 'HOOK_BATCH_SIZE', 100)
+        applied = 0
+        while True:
+            names = spool.pending()[:batch_size]
+            if not names:
+                return applied
+            applied += self.apply(spool, names)
+
+    def handle(self, mode=None, **options):
+        spool = HookSpool(utils.hook_spool_dir())
+        if mode == 'drain':
+            self.drain(spool)
+            return
+
+        server = HookServer(utils.hook_socket_path(), spool)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        batch_window = getattr(settings, 'HOOK_BATCH_WINDOW', 0.5)
+        try:
+            while True:
+                try:
+                    applied = self.drain(spool)
+                    if applied:
+                        logger.info('Applied %d hook events' % (applied,))
+                finally:
+                    connection.close()
+                # Events spooled while the daemon was down only get
+                # noticed here, so don't wait forever.
+                server.wakeup.wait(60)
+                server.wakeup.clear()
+                # Give reprepro a moment to send the rest of a burst
+                time.sleep(batch_window)
+        finally:
+            server.shutdown()
+            os.unlink(utils.hook_socket_path())
@@ -0,0 +1,133 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from glob import glob
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from repomgmt import tasks, utils
+from repomgmt.models import Repository
+
+logger = logging.getLogger(__name__)
+
+# How often to look for new repositories (and incoming directories that
+# didn't exist last time we looked)
+REFRESH_INTERVAL = 60
+
+
+class IncomingWatcher(object):
+    """Keeps track of when each repository's incoming directory is
+    worth looking at
+
+    Every file that arrives pushes the repository's deadline back, so
+    an upload of several files is only looked at once it goes quiet."""
+    def __init__(self, delay):
+        self.delay = delay
+        self.due = {}
+
+    def arrived(self, repository_name, now=None):
+        self.due[repository_name] = (now or time.time()) + self.delay
+
+    def timeout(self, now=None):
+        """Seconds until the next deadline, or None if there is none"""
+        if not self.due:
+            return None
+        return max(0, min(self.due.values()) - (now or time.time()))
+
+    def ready(self, now=None):
+        """Repositories whose deadline has passed"""
+        now = now or time.time()
+        names = [name for name, due in self.due.items() if due <= now]
+        for name in names:
+            del self.due[name]
+        return names
+
+
+class Command(BaseCommand):
+    help = ('Watches every repository\'s incoming directory and processes '
+            'uploads as soon as they are complete. Needs pyinotify.')
+
+    def complete_uploads(self, repository):
+        return [path for path in glob(os.path.join(
+                                          repository.reprepro_incomingdir,
+                                          '*.changes'))
+                if utils.upload_complete(path)]
+
+    def trigger(self, repository_names):
+        """Queues processincoming for those of the repositories that
+        have a complete upload waiting
+
+        Incomplete ones get another look when more files arrive."""
+        for repo in Repository.objects.filter(name__in=repository_names):
+            if self.complete_uploads(repo):
+                logger.info('Upload complete in %s' % (repo.name,))
+                tasks.process_incoming_for_repository.delay(repo.name)
+
+    def refresh(self, watches, watch):
+        """Starts watching incoming directories we aren't yet"""
+        for repo in Repository.objects.all():
+            path = repo.reprepro_incomingdir
+            if path in watches or not os.path.isdir(path):
+                continue
+            watch(path)
+            watches[path] = repo.name
+            # Anything that arrived before we started watching
+            self.watcher.arrived(repo.name)
+
+    def handle(self, **options):
+        import pyinotify
+
+        self.watcher = IncomingWatcher(getattr(settings,
+                                               'INCOMING_WATCH_DELAY', 2))
+        watches = {}
+        watcher = self.watcher
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                repository_name = watches.get(event.path)
+                if repository_name:
+                    watcher.arrived(repository_name)
+
+        wm = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+        notifier = pyinotify.Notifier(wm, Handler())
+
+        last_refresh = 0
+        while True:
+            try:
+                if time.time() - last_refresh >= REFRESH_INTERVAL:
+                    self.refresh(watches,
+                                 lambda path: wm.add_watch(path, mask))
+                    last_refresh = time.time()
+
+                ready = watcher.ready()
+                if ready:
+                    self.trigger(ready)
+            finally:
+                connection.close()
+
+            timeout = REFRESH_INTERVAL - (time.time() - last_refresh)
+            if watcher.timeout() is not None:
+                timeout = min(timeout, watcher.timeout())
+            if notifier.check_events(max(0, int(timeout * 1000))):
+                notifier.read_events()
+                notifier.process_events()
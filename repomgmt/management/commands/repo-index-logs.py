@@ -0,0 +1,48 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import os
+
+from django.core.management.base import BaseCommand
+from repomgmt import utils
+from repomgmt.models import BuildRecord, PackageSourceBuildProblem
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Adds build logs and package source build problem logs that '
+            'are not in the search index yet')
+
+    def handle(self, **options):
+        index = utils.log_search_index()
+
+        for br in BuildRecord.objects.filter(finished__isnull=False):
+            log = br.log()
+            if log is None or index.contains('build', br.pk):
+                continue
+            indexer = utils.LogIndexer(index, 'build', br.pk)
+            offset = 0
+            for data in log.read():
+                indexer.add(offset, data)
+                offset += len(data)
+            indexer.close()
+
+        for problem in PackageSourceBuildProblem.objects.all():
+            if (not os.path.exists(problem.log_file()) or
+                    index.contains('problem', problem.pk)):
+                continue
+            problem.index_log(problem.log_file_contents())
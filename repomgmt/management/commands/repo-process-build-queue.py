@@ -16,7 +16,7 @@
 #   limitations under the License.
 #
 from django.core.management.base import BaseCommand
-from repomgmt.models import BuildRecord
+from repomgmt.models import BuildScheduler
 
 
 class Command(BaseCommand):
@@ -24,4 +24,4 @@ class Command(BaseCommand):
     help = 'Processes the build queue'
 
     def handle(self, **options):
-        BuildRecord.perform_single_build()
+        BuildScheduler().run()
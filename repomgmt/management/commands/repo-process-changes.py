@@ -23,7 +23,8 @@ from debian_bundle.deb822 import Changes, Dsc
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from repomgmt.models import Architecture, BuildRecord, Repository, Series
+from repomgmt.models import Architecture, BuildNode, BuildRecord
+from repomgmt.models import Repository, Series
 
 logger = logging.getLogger(__name__)
 
@@ -112,6 +113,11 @@ class Command(BaseCommand):
                                      version=pkg_version)
         br.update_state(BuildRecord.SUCCESFULLY_BUILT)
 
-        logger.info('Finished processing build record %r. Deleting associated '
-                    'build node %r' % (br, br.build_node))
-        br.build_node.delete()
+        build_node = br.build_node
+        if build_node is not None and build_node.state == BuildNode.SHUTTING_DOWN:
+            logger.info('Finished processing build record %r. Deleting '
+                        'associated build node %r' % (br, build_node))
+            build_node.delete()
+        else:
+            logger.info('Finished processing build record %r. Associated '
+                        'build node %r stays in the pool' % (br, build_node))
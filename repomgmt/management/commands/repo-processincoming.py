@@ -15,7 +15,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 #
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from repomgmt.models import Repository, Series
 
 
@@ -25,4 +25,6 @@ class Command(BaseCommand):
 
     def handle(self, repo_arg, **options):
         repo = Repository.objects.get(name=repo_arg)
-        repo.process_incoming()
+        op = repo.process_incoming()
+        if not op.wait():
+            raise CommandError('processincoming failed:\n%s' % (op.output,))
@@ -0,0 +1,38 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from django.core.management.base import BaseCommand
+
+from repomgmt.models import Series
+
+
+class Command(BaseCommand):
+    args = '[<repository> [<series>]]'
+    help = ('Rebuilds the table of source package versions from what '
+            'reprepro says')
+
+    def handle(self, repository_name=None, series_name=None, **options):
+        series_list = Series.objects.all()
+        if repository_name:
+            series_list = series_list.filter(repository=repository_name)
+        if series_name:
+            series_list = series_list.filter(name=series_name)
+
+        for series in series_list:
+            changes = series.reconcile_source_packages()
+            if changes:
+                print '%s: %d source packages out of date' % (series, changes)
@@ -16,6 +16,7 @@
 #   limitations under the License.
 #
 from django.core.management.base import BaseCommand
+from repomgmt import tasks
 from repomgmt.models import Architecture, ChrootTarball, Repository
 
 
@@ -33,3 +34,4 @@ class Command(BaseCommand):
             tb = ChrootTarball(series=series, architecture=arch)
             tb.save()
         tb.refresh()
+        tasks.rebake_build_node_images.delay(tb.id)
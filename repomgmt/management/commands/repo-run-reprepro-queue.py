@@ -0,0 +1,35 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from django.core.management.base import BaseCommand
+from repomgmt.models import Repository
+
+
+class Command(BaseCommand):
+    args = '[<repository>]'
+    help = 'Runs queued reprepro operations'
+
+    def handle(self, repo_name=None, **options):
+        if repo_name:
+            repos = [Repository.objects.get(name=repo_name)]
+        else:
+            repos = Repository.objects.all()
+        for repo in repos:
+            ran = repo.run_reprepro_operations()
+            if ran:
+                self.stdout.write('Ran %d operations for %s\n' % (ran,
+                                                                  repo.name))
@@ -24,4 +24,4 @@ class Command(BaseCommand):
 
     def handle(self, **options):
         for repo in Repository.objects.all():
-            repo.write_configuration()
+            repo.write_configuration(force=True)
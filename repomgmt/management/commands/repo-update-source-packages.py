@@ -0,0 +1,56 @@
+#
+#   Copyright 2012 Cisco Systems, Inc.
+#
+#   Author: Soren Hansen <sorhanse@cisco.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import logging
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from repomgmt.models import Repository, SourcePackageVersion
+
+logger = logging.getLogger(__name__)
+
+
+def get_repository_name():
+    return os.environ['REPREPRO_BASE_DIR'][len(settings.BASE_REPO_DIR):].strip('/')
+
+
+class Command(BaseCommand):
+    args = ('<action> <codename> <package type> <component> <architecture> '
+            '<source name> <version> [<old version>] <files>')
+    help = 'Records source package versions as reprepro adds or removes them'
+
+    def handle(self, action, codename, pkg_type, component, architecture,
+                     pkg_name, pkg_version, *files, **options):
+        if action not in ('add', 'replace', 'remove'):
+            return
+
+        if 'repository' in options:
+            repository_name = options['repository']
+        else:
+            repository_name = get_repository_name()
+
+        repository = Repository.objects.get(name=repository_name)
+        series, pocket = SourcePackageVersion.locate(repository, codename)
+
+        logger.debug('%s %s %s in %s (%s)' % (action, pkg_name, pkg_version,
+                                              series, pocket))
+        if action == 'remove':
+            SourcePackageVersion.record(series, pocket, pkg_name, None)
+        else:
+            SourcePackageVersion.record(series, pocket, pkg_name, pkg_version)
@@ -17,7 +17,10 @@
 #
 from glob import glob
 from datetime import date
+import datetime
+import errno
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import os.path
 import random
@@ -30,6 +33,7 @@ import sys
 import tempfile
 import termios
 import textwrap
+import threading
 import time
 import tty
 
@@ -37,7 +41,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 #from django.core.mail import email_admins
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
 from django.template.loader import render_to_string
 from django.utils import timezone
 
@@ -60,6 +64,16 @@ class Repository(models.Model):
     signing_key_id = models.CharField(max_length=200)
     uploaders = models.ManyToManyField(User)
     contact = models.EmailField()
+    build_log_budget = models.BigIntegerField(null=True, blank=True,
+                                              help_text='Bytes')
+    build_log_max_age = models.IntegerField(null=True, blank=True,
+                                            help_text='Days')
+    # Set while a configuration write is waiting to happen
+    config_write_scheduled = models.DateTimeField(null=True, blank=True,
+                                                  editable=False)
+    # Set while something is working through the reprepro operation queue
+    reprepro_queue_claimed = models.DateTimeField(null=True, blank=True,
+                                                  editable=False)
 
     class Meta:
         verbose_name_plural = "repositories"
@@ -71,10 +85,125 @@ class Repository(models.Model):
     def __unicode__(self):
         return self.name
 
-    def _reprepro(self, *args):
+    def _reprepro(self, *args, **kwargs):
         arg_list = list(args)
         cmd = ['reprepro', '-b', self.reprepro_dir] + arg_list
-        return utils.run_cmd(cmd)
+        return utils.run_cmd(cmd, **kwargs)
+
+    def _reprepro_creating_builds(self, *args):
+        """Runs reprepro, creating build records for every source it
+        accepts in one go once it's done
+
+        Rather than starting Django for each source,
+        create-build-records.sh writes its arguments to a queue file."""
+        fd, queue = tempfile.mkstemp(prefix='build-records-')
+        os.close(fd)
+        try:
+            return self._reprepro(*args, override_env={
+                                      'REPOMGMT_BUILD_RECORD_QUEUE': queue})
+        finally:
+            # Whatever happens here mustn't hide how reprepro got on
+            try:
+                with open(queue, 'r') as fp:
+                    uploads = [BuildRecord.upload_from_hook_args(
+                                   l.rstrip('\n').split('\t')[:-1])
+                               for l in fp]
+                BuildRecord.create_for_uploads(self,
+                                               [u for u in uploads if u])
+            except Exception, e:
+                logger.error('Failed to create build records for %s' %
+                             (self,), exc_info=e)
+            finally:
+                os.unlink(queue)
+
+    def queue_reprepro(self, *args, **kwargs):
+        """Queues a reprepro command that changes the repository
+
+        Queued commands are run one at a time, in the order they were
+        queued. If the same command is already waiting to run, that
+        operation is returned rather than queueing it again. Pass
+        creates_builds=True to have build records created for whatever
+        reprepro accepts.
+
+        Returns the RepreproOperation. Use its wait() method if you
+        really need to block until it has run."""
+        from repomgmt import tasks
+
+        op = RepreproOperation.enqueue(self, args,
+                                       kwargs.get('creates_builds', False))
+        tasks.run_reprepro_operations.delay(self.name)
+        return op
+
+    def claim_reprepro_queue(self):
+        """Atomically makes us the one running this repository's
+        reprepro operations
+
+        Returns False if someone else already is. Claims older than
+        REPREPRO_QUEUE_TIMEOUT seconds are assumed to have been
+        abandoned, as are operations that have been running for that
+        long."""
+        now = timezone.now()
+        stale = RepreproOperation.stale_before(now)
+        matches = self.__class__.objects.filter(
+                      models.Q(reprepro_queue_claimed__isnull=True) |
+                      models.Q(reprepro_queue_claimed__lt=stale),
+                      pk=self.pk).update(reprepro_queue_claimed=now)
+        if matches != 1:
+            return False
+        self.reprepro_queue_claimed = now
+        # Whoever was running these has died. Run them again.
+        reset = RepreproOperation.abandoned(self, now).update(
+                    state=RepreproOperation.PENDING, started=None)
+        if reset:
+            logger.warning('Retrying %d abandoned reprepro operations for %s'
+                           % (reset, self.name))
+        return True
+
+    def renew_reprepro_queue_claim(self):
+        """Keeps our claim from looking abandoned
+
+        Returns False if it has been taken over meanwhile."""
+        now = timezone.now()
+        matches = self.__class__.objects.filter(
+                      pk=self.pk,
+                      reprepro_queue_claimed=self.reprepro_queue_claimed
+                      ).update(reprepro_queue_claimed=now)
+        if matches != 1:
+            return False
+        self.reprepro_queue_claimed = now
+        return True
+
+    def release_reprepro_queue(self):
+        self.__class__.objects.filter(
+            pk=self.pk,
+            reprepro_queue_claimed=self.reprepro_queue_claimed).update(
+                reprepro_queue_claimed=None)
+
+    def run_reprepro_operations(self):
+        """Runs queued reprepro operations until there are none left
+
+        Returns straight away if something else is already running them."""
+        ran = 0
+        while (RepreproOperation.pending(self).exists() or
+                   RepreproOperation.abandoned(self).exists()):
+            if not self.claim_reprepro_queue():
+                return ran
+            try:
+                while True:
+                    if not self.renew_reprepro_queue_claim():
+                        logger.warning('Lost the reprepro queue claim for '
+                                       '%s' % (self.name,))
+                        return ran
+                    op = RepreproOperation.next_pending(self)
+                    if op is None:
+                        break
+                    op.run()
+                    ran += 1
+            finally:
+                self.release_reprepro_queue()
+            # Loop around in case something was queued after we last
+            # looked, but gave up because we still had the claim.
+        return ran
 
     @property
     def signing_key(self):
@@ -92,8 +221,12 @@ class Repository(models.Model):
     def reprepro_incomingdir(self):
         return '%s/%s' % (settings.BASE_INCOMING_DIR, self.name)
 
+    def has_incoming(self):
+        return utils.has_changes_files(self.reprepro_incomingdir)
+
     def process_incoming(self):
-        self._reprepro('processincoming', 'incoming')
+        return self.queue_reprepro('processincoming', 'incoming',
+                                   creates_builds=True)
 
     def not_closed_series(self):
         return self.series_set.exclude(state=Series.CLOSED)
@@ -101,6 +234,94 @@ class Repository(models.Model):
     def build_nodes(self):
         return BuildNode.objects.filter(buildrecord__series__repository=self)
 
+    def build_log_retention(self):
+        """This repository's build log byte budget and maximum age in days
+
+        Either can be None, meaning no limit."""
+        budget = self.build_log_budget
+        if budget is None:
+            budget = getattr(settings, 'BUILD_LOG_BUDGET', None)
+        max_age = self.build_log_max_age
+        if max_age is None:
+            max_age = getattr(settings, 'BUILD_LOG_MAX_AGE', None)
+        return budget, max_age
+
+    def expired_build_logs(self, now=None, batch_size=200):
+        """Finished builds whose logs are past this repository's limits,
+        oldest first
+
+        The latest build of each package in each series and architecture
+        keeps its log regardless. Older logs go if they are too old, or
+        for as long as the logs take up more than the budget. Works from
+        the sizes recorded in the database (see
+        BuildRecord.store_log_bytes), and only reads as many builds as
+        the caller consumes."""
+        budget, max_age = self.build_log_retention()
+        if budget is None and max_age is None:
+            return
+
+        cutoff = None
+        if max_age is not None:
+            cutoff = (now or timezone.now()) - datetime.timedelta(days=max_age)
+
+        builds = BuildRecord.objects.filter(series__repository=self,
+                                            finished__isnull=False,
+                                            log_expired=False)
+        excess = 0
+        if budget is not None:
+            used = builds.aggregate(used=models.Sum('log_bytes'))['used']
+            excess = (used or 0) - budget
+
+        candidates = builds.order_by('finished', 'id')
+        if excess <= 0:
+            if cutoff is None:
+                return
+            candidates = candidates.filter(finished__lt=cutoff)
+
+        last = None
+        while True:
+            batch = candidates
+            if last is not None:
+                batch = batch.filter(models.Q(finished__gt=last.finished) |
+                                     models.Q(finished=last.finished,
+                                              id__gt=last.id))
+            batch = list(batch[:batch_size])
+            if not batch:
+                return
+            latest = dict(
+                ((row['series'], row['source_package_name'],
+                  row['architecture']), row['latest'])
+                for row in builds.filter(
+                    series__in=set(br.series_id for br in batch),
+                    source_package_name__in=set(br.source_package_name
+                                                for br in batch)
+                    ).values('series', 'source_package_name', 'architecture'
+                    ).annotate(latest=models.Max('finished')))
+            for br in batch:
+                key = (br.series_id, br.source_package_name,
+                       br.architecture_id)
+                if br.finished >= latest.get(key, br.finished):
+                    continue
+                if excess > 0:
+                    excess -= br.log_bytes or 0
+                elif cutoff is None or br.finished >= cutoff:
+                    # Within the budget, and everything from here on is
+                    # young enough
+                    return
+                yield br
+            last = batch[-1]
+
+    def expire_build_logs(self, limit=None):
+        """Deletes at most limit expired build logs. Returns how many
+        were deleted."""
+        expired = 0
+        for br in self.expired_build_logs():
+            if limit is not None and expired >= limit:
+                break
+            br.expire_log()
+            expired += 1
+        return expired
+
     def create_key(self):
         if self.signing_key_id:
             return
@@ -122,7 +343,48 @@ class Repository(models.Model):
         self.signing_key_id = key_id
         self.signing_key.public_key
 
-    def write_configuration(self):
+    def schedule_write_configuration(self):
+        """Writes the configuration shortly
+
+        Calls for the same repository until then end up as a single
+        write. If a scheduled write never happened, it is done right away
+        instead."""
+        from repomgmt import tasks
+
+        delay = getattr(settings, 'CONFIG_WRITE_DELAY', 5)
+        now = timezone.now()
+        # Kept in the database so that every process sees it. Cleared by
+        # the task when it starts.
+        repositories = self.__class__.objects.filter(pk=self.pk)
+        if repositories.filter(config_write_scheduled__isnull=True).update(
+               config_write_scheduled=now):
+            try:
+                tasks.write_configuration.apply_async(args=[self.name],
+                                                      countdown=delay)
+                return
+            except Exception:
+                logger.warning('Could not schedule writing the configuration '
+                               'for %s. Writing it now.' % (self.name,),
+                               exc_info=True)
+        else:
+            stale = now - datetime.timedelta(seconds=delay * 10)
+            if not repositories.filter(config_write_scheduled__lt=stale
+                                      ).update(config_write_scheduled=now):
+                return
+            logger.warning('Scheduled configuration write for %s never '
+                           'happened. Writing it now.' % (self.name,))
+        self.clear_scheduled_write_configuration()
+        self.write_configuration()
+
+    def clear_scheduled_write_configuration(self):
+        self.__class__.objects.filter(pk=self.pk).update(
+            config_write_scheduled=None)
+
+    def write_configuration(self, force=False):
+        """Writes out the reprepro configuration files that have changed
+
+        Only runs reprepro export if the distributions have changed (or
+        if force is set). Returns the names of the files written."""
         logger.debug('Writing out config for %s' % (self.name,))
 
         confdir = '%s/conf' % (self.reprepro_dir,)
@@ -133,6 +395,12 @@ class Repository(models.Model):
         basedir = os.path.normpath(os.path.join(settings_module_dir,
                                                 os.pardir))
 
+        hook_client = None
+        if getattr(settings, 'REPREPRO_HOOK_DAEMON', False):
+            hook_client = ' '.join([
+                     os.path.join(os.path.dirname(__file__), 'hookclient.py'),
+                     utils.hook_socket_path(), utils.hook_spool_dir()])
+
         for d, setgid in [(settings.BASE_PUBLIC_REPO_DIR, False),
                           (confdir, False), (self.reprepro_incomingdir, True)]:
             if not os.path.exists(d):
@@ -140,30 +408,53 @@ class Repository(models.Model):
                 if setgid:
                     os.chmod(d, 02775)
 
+        context = self.configuration_context()
+        context.update({'settings': settings,
+                        'basedir': basedir,
+                        'hook_client': hook_client,
+                        'outdir': self.reprepro_outdir})
+
+        changed = []
         for f in ['distributions', 'incoming', 'options', 'pulls',
                   'uploaders', 'create-build-records.sh', 'dput.cf',
-                  'process-changes.sh', 'import-dsc-to-git.sh', 'updates']:
-            s = render_to_string('reprepro/%s.tmpl' % (f,),
-                                 {'repository': self,
-                                  'architectures': Architecture.objects.all(),
-                                  'settings': settings,
-                                  'basedir': basedir,
-                                  'outdir': self.reprepro_outdir})
+                  'process-changes.sh', 'import-dsc-to-git.sh', 'updates',
+                  'update-source-packages.sh']:
+            s = render_to_string('reprepro/%s.tmpl' % (f,), context)
             path = '%s/%s' % (confdir, f)
 
-            with open(path, 'w') as fp:
-                fp.write(s)
-
-            if path.endswith('.sh'):
-                os.chmod(path, 0755)
-
-        if self.series_set.count() > 0:
-            self._reprepro('export')
+            mode = path.endswith('.sh') and 0755 or None
+            if utils.write_if_changed(path, s.encode('utf-8'), mode, force):
+                changed.append(f)
+
+        if changed:
+            logger.info('Wrote %s for %s' % (', '.join(changed), self.name))
+
+        if ('distributions' in changed or force) and context['series_list']:
+            self.queue_reprepro('export')
+        return changed
+
+    def configuration_context(self):
+        """Everything the reprepro configuration templates need, fetched
+        up front with a fixed number of queries"""
+        series_list = list(self.series_set.select_related(
+                               'base_ubuntu_series',
+                               'update_from__repository').order_by('id'))
+        uploaders = self.uploaders.prefetch_related(
+                        'uploaderkey_set').order_by('id')
+        return {'repository': self,
+                'series_list': series_list,
+                'not_closed_series': [series for series in series_list
+                                      if series.state != Series.CLOSED],
+                'uploaders': list(uploaders),
+                'build_nodes': list(self.build_nodes().distinct().order_by(
+                                        'name')),
+                'architectures': list(Architecture.objects.all())}
 
     def save(self, *args, **kwargs):
-        self.write_configuration()
         self.create_key()
-        return super(Repository, self).save(*args, **kwargs)
+        ret = super(Repository, self).save(*args, **kwargs)
+        self.schedule_write_configuration()
+        return ret
 
     def can_modify(self, user):
         # A side effect of using the name as the primary key is that
@@ -261,7 +552,7 @@ class Series(models.Model):
             return '%s-queued' % (self.name,)
 
     def save(self, *args, **kwargs):
-        self.repository.write_configuration()
+        self.repository.schedule_write_configuration()
         if self.pk:
             newly_created = False
             old = Series.objects.get(pk=self.pk)
@@ -299,38 +590,279 @@ class Series(models.Model):
 
     def flush_queue(self):
         logger.info('Flushing queue for %s' % (self,))
-        self.repository._reprepro('pull', '%s-proposed' % (self.name, ))
+        return self.repository.queue_reprepro('pull',
+                                              '%s-proposed' % (self.name,),
+                                              creates_builds=True)
+
+    POCKETS = [('%s', 'stable'),
+               ('%s-proposed', 'proposed'),
+               ('%s-queued', 'queued')]
 
     def get_source_packages(self):
-        pkgs = {}
+        pkgs = dict((pocket, {}) for _, pocket in self.POCKETS)
+        rows = self.sourcepackageversion_set.values_list('pocket', 'name',
+                                                         'version')
+        for pocket, pkg_name, pkg_version in rows:
+            pkgs[pocket][pkg_name] = pkg_version
+        return pkgs
 
-        def get_pkglist(distribution):
-            pkglist = self.repository._reprepro('-A', 'source', 'list', distribution)
-            for l in pkglist.split('\n'):
-                if l.strip() == '':
-                    continue
-                repo_info = pkglist.split(':')[0]
-                _distribution, _section, arch = repo_info.split('|')
-                pkg_name, pkg_version = l.split(' ')[1:]
-                yield (pkg_name, pkg_version)
-
-        for distribution_fmt, key in [('%s', 'stable'),
-                                      ('%s-proposed', 'proposed'),
-                                      ('%s-queued', 'queued')]:
-            distribution = distribution_fmt % (self.name,)
-            pkgs[key] = {}
-            for pkg_name, pkg_version in get_pkglist(distribution):
-                pkgs[key][pkg_name] = pkg_version
+    def sources_index(self, distribution):
+        """Path of distribution's exported Sources index, or None"""
+        path = os.path.join(self.repository.reprepro_outdir, 'dists',
+                            distribution, 'main', 'source', 'Sources')
+        # The uncompressed one is quicker to parse
+        for candidate in [path, path + '.gz']:
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    def _reprepro_source_list(self, distribution):
+        pkglist = self.repository._reprepro('-A', 'source', 'list',
+                                            distribution)
+        for l in pkglist.split('\n'):
+            # <codename>|<component>|<architecture>: <name> <version>
+            fields = l.split()
+            if len(fields) != 3 or not fields[0].endswith('|source:'):
+                continue
+            yield fields[1], fields[2]
+
+    def get_reprepro_source_packages(self):
+        """Like get_source_packages, but from what reprepro has published
 
+        Reads the exported Sources indices, falling back to asking
+        reprepro for distributions that haven't been exported."""
+        pkgs = {}
+        for distribution_fmt, key in self.POCKETS:
+            distribution = distribution_fmt % (self.name,)
+            path = self.sources_index(distribution)
+            if path is not None:
+                pkgs[key] = dict(utils.read_sources_index(path))
+            else:
+                pkgs[key] = dict(self._reprepro_source_list(distribution))
         return pkgs
 
+    @transaction.commit_on_success
+    def reconcile_source_packages(self):
+        """Brings the source package table in line with reprepro
+
+        Returns the number of rows added, changed or removed."""
+        wanted = self.get_reprepro_source_packages()
+        known = dict(((spv.pocket, spv.name), spv)
+                     for spv in self.sourcepackageversion_set.all())
+        changes = 0
+        new = []
+        for pocket, pkgs in wanted.iteritems():
+            for name, version in pkgs.iteritems():
+                spv = known.pop((pocket, name), None)
+                if spv is None:
+                    new.append(SourcePackageVersion(series=self, pocket=pocket,
+                                                    name=name,
+                                                    version=version))
+                elif spv.version != version:
+                    spv.version = version
+                    spv.save()
+                    changes += 1
+        SourcePackageVersion.objects.bulk_create(new)
+        if known:
+            SourcePackageVersion.objects.filter(
+                pk__in=[spv.pk for spv in known.values()]).delete()
+        return changes + len(new) + len(known)
+
     def update(self):
         self.repository.write_configuration()
         if self.update_from:
-            self.repository._reprepro('update', '%s-proposed' % (self.name,))
+            return self.repository.queue_reprepro('update',
+                                                  '%s-proposed' % (self.name,))
 
     def promote(self):
-        self.repository._reprepro('pull', self.name)
+        return self.repository.queue_reprepro('pull', self.name)
+
+
+class SourcePackageVersion(models.Model):
+    """The version of each source package in each pocket of a series
+
+    Kept up to date by reprepro's notifiers, so reprepro needn't be asked."""
+    POCKETS = [(pocket, pocket.capitalize()) for _, pocket in Series.POCKETS]
+
+    series = models.ForeignKey(Series)
+    pocket = models.CharField(max_length=20, choices=POCKETS)
+    name = models.CharField(max_length=200)
+    version = models.CharField(max_length=200)
+
+    class Meta:
+        unique_together = ('series', 'pocket', 'name')
+        # Covers BuildRecord.superseded()
+        index_together = [['series', 'name', 'version']]
+
+    def __unicode__(self):
+        return '%s %s in %s (%s)' % (self.name, self.version,
+                                     self.series, self.pocket)
+
+    @classmethod
+    def locate(cls, repository, codename):
+        """Returns the series and pocket of a reprepro codename"""
+        for distribution_fmt, pocket in Series.POCKETS:
+            suffix = distribution_fmt % ('',)
+            if suffix and not codename.endswith(suffix):
+                continue
+            name = codename[:len(codename) - len(suffix)]
+            try:
+                return (Series.objects.get(repository=repository, name=name),
+                        pocket)
+            except Series.DoesNotExist:
+                continue
+        raise Series.DoesNotExist(codename)
+
+    @classmethod
+    def record_many(cls, versions):
+        """Like record, for a dict mapping (series, pocket, name) to
+        version"""
+        if not versions:
+            return
+        names = sorted(set(name for _, __, name in versions))
+        known = {}
+        for i in range(0, len(names), 500):
+            for spv in cls.objects.filter(
+                           series__in=set(key[0] for key in versions),
+                           name__in=names[i:i + 500]):
+                known[(spv.series_id, spv.pocket, spv.name)] = spv
+        new = []
+        for (series, pocket, name), version in versions.iteritems():
+            spv = known.get((series.id, pocket, name))
+            if spv is None:
+                new.append(cls(series=series, pocket=pocket, name=name,
+                               version=version))
+            elif spv.version != version:
+                cls.objects.filter(pk=spv.pk).update(version=version)
+        cls.objects.bulk_create(new)
+
+    @classmethod
+    def record(cls, series, pocket, name, version):
+        if version is None:
+            cls.objects.filter(series=series, pocket=pocket,
+                               name=name).delete()
+            return
+        updated = cls.objects.filter(series=series, pocket=pocket,
+                                     name=name).update(version=version)
+        if not updated:
+            cls(series=series, pocket=pocket, name=name,
+                version=version).save()
+
+
+class RepreproOperation(models.Model):
+    """A reprepro command waiting for (or done) its turn to change a
+    repository
+
+    See Repository.queue_reprepro."""
+    PENDING = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+    STATES = ((PENDING, 'Pending'),
+              (RUNNING, 'Running'),
+              (DONE, 'Done'),
+              (FAILED, 'Failed'))
+
+    repository = models.ForeignKey(Repository)
+    # Tab separated
+    args = models.CharField(max_length=255)
+    creates_builds = models.BooleanField(default=False)
+    state = models.SmallIntegerField(default=PENDING, choices=STATES)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    # What reprepro had to say if it failed
+    output = models.TextField(blank=True)
+
+    class Meta:
+        index_together = [['repository', 'state']]
+
+    def __unicode__(self):
+        return 'reprepro %s in %s' % (' '.join(self.arg_list),
+                                      self.repository_id)
+
+    @property
+    def arg_list(self):
+        return self.args.split('\t')
+
+    @classmethod
+    def pending(cls, repository):
+        return cls.objects.filter(repository=repository, state=cls.PENDING)
+
+    @classmethod
+    def stale_before(cls, now=None):
+        timeout = getattr(settings, 'REPREPRO_QUEUE_TIMEOUT', 3600)
+        return (now or timezone.now()) - datetime.timedelta(seconds=timeout)
+
+    @classmethod
+    def abandoned(cls, repository, now=None):
+        """Operations that have been running for suspiciously long"""
+        return cls.objects.filter(repository=repository, state=cls.RUNNING,
+                                  started__lt=cls.stale_before(now))
+
+    @classmethod
+    def enqueue(cls, repository, args, creates_builds=False):
+        args = '\t'.join(args)
+        try:
+            return cls.pending(repository).filter(
+                       args=args, creates_builds=creates_builds)[0]
+        except IndexError:
+            return cls.objects.create(repository=repository, args=args,
+                                      creates_builds=creates_builds)
+
+    @classmethod
+    def next_pending(cls, repository):
+        """Atomically takes the oldest pending operation
+
+        Returns None if there isn't one."""
+        while True:
+            try:
+                op = cls.pending(repository).order_by('id')[0]
+            except IndexError:
+                return None
+            now = timezone.now()
+            if cls.objects.filter(pk=op.pk, state=cls.PENDING
+                                 ).update(state=cls.RUNNING,
+                                          started=now) == 1:
+                op.state = cls.RUNNING
+                op.started = now
+                return op
+
+    def run(self):
+        logger.info('Running %s' % (self,))
+        if self.creates_builds:
+            run = self.repository._reprepro_creating_builds
+        else:
+            run = self.repository._reprepro
+        try:
+            run(*self.arg_list)
+            self.state = self.DONE
+        except CommandFailed, e:
+            logger.error('%s failed: %s' % (self, e.stderr))
+            self.output = '%s%s' % (e.stdout or '', e.stderr or '')
+            self.state = self.FAILED
+        except Exception, e:
+            logger.error('%s failed' % (self,), exc_info=e)
+            self.output = str(e)
+            self.state = self.FAILED
+        self.finished = timezone.now()
+        self.save()
+
+    def wait(self, timeout=None, interval=1):
+        """Blocks until the operation has run
+
+        Returns True if it succeeded, False if it failed and None if it
+        still hadn't run after timeout seconds."""
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            op = self.__class__.objects.get(pk=self.pk)
+            self.state, self.output = op.state, op.output
+            if self.state in (self.DONE, self.FAILED):
+                return self.state == self.DONE
+            if deadline and time.time() > deadline:
+                return None
+            time.sleep(interval)
 
 
 class Package(object):
@@ -459,6 +991,48 @@ class ChrootTarball(models.Model):
         self.save()
 
 
+class FailureSignature(models.Model):
+    """Failures whose logs end the same way, give or take versions,
+    paths and timestamps"""
+    signature = models.CharField(max_length=40, unique=True)
+    sample = models.TextField()
+    count = models.IntegerField(default=0)
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        lines = self.sample.splitlines()
+        return lines and lines[-1] or self.signature
+
+    def get_absolute_url(self):
+        return reverse('failure_signature_detail',
+                       kwargs={'signature_id': self.pk})
+
+    @classmethod
+    def record(cls, log_tail, when=None):
+        """Count a failure ending in log_tail against its signature
+
+        Returns the FailureSignature or None if there's nothing in
+        log_tail to go by."""
+        excerpt = utils.failure_excerpt(log_tail)
+        if not excerpt:
+            return None
+        sample, signature = utils.failure_signature(excerpt)
+        when = when or timezone.now()
+        sig, created = cls.objects.get_or_create(
+                           signature=signature,
+                           defaults={'sample': sample,
+                                     'first_seen': when,
+                                     'last_seen': when})
+        cls.objects.filter(pk=sig.pk).update(count=models.F('count') + 1)
+        # Backfills may come in any order
+        cls.objects.filter(pk=sig.pk, last_seen__lt=when).update(
+                                                            last_seen=when)
+        cls.objects.filter(pk=sig.pk, first_seen__gt=when).update(
+                                                           first_seen=when)
+        return sig
+
+
 class BuildRecord(models.Model):
     BUILDING = 1
     SUCCESFULLY_BUILT = 2
@@ -491,12 +1065,43 @@ class BuildRecord(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     finished = models.DateTimeField(db_index=True, null=True, blank=True)
 
+    # Taken from sbuild's summary when the build finishes
+    sbuild_status = models.CharField(max_length=200, blank=True)
+    fail_stage = models.CharField(max_length=200, blank=True, db_index=True)
+    build_time = models.IntegerField(null=True, blank=True, db_index=True,
+                                     help_text='Seconds')
+    build_space = models.IntegerField(null=True, blank=True,
+                                      help_text='Kilobytes')
+    install_time = models.IntegerField(null=True, blank=True,
+                                       help_text='Seconds')
+    package_time = models.IntegerField(null=True, blank=True,
+                                       help_text='Seconds')
+    failure_signature = models.ForeignKey(FailureSignature, null=True,
+                                          blank=True,
+                                          on_delete=models.SET_NULL)
+
+    # Once the log is deleted, the summary above is all that's left
+    log_expired = models.BooleanField(default=False)
+    log_bytes = models.BigIntegerField(null=True, blank=True,
+                                       help_text='Bytes on disk')
+
+    SUMMARY_FIELDS = (
+        ('Status', 'sbuild_status', str),
+        ('Fail-Stage', 'fail_stage', str),
+        ('Build-Time', 'build_time', int),
+        ('Build-Space', 'build_space', int),
+        ('Install-Time', 'install_time', int),
+        ('Package-Time', 'package_time', int),
+    )
+
     def get_tarball(self):
         return self.series.base_ubuntu_series.chroottarball_set.get(architecture=self.architecture)
 
     class Meta:
         unique_together = ('series', 'source_package_name',
                            'version', 'architecture')
+        # Covers pending_builds() ordered by priority
+        index_together = [['state', 'build_node', 'priority']]
 
     def __unicode__(self):
         return ('Build of %s_%s_%s' %
@@ -507,6 +1112,14 @@ class BuildRecord(models.Model):
         # Also update this cached object
         self.state = new_state
 
+    def requeue(self):
+        """Puts a build that is stuck in BUILDING back in the queue"""
+        if self.__class__.objects.filter(pk=self.pk, state=self.BUILDING
+                                        ).update(state=self.NEEDS_BUILDING,
+                                                 build_node=None):
+            self.state = self.NEEDS_BUILDING
+            self.build_node = None
+
     @classmethod
     def pending_builds(cls):
         return cls.objects.filter(state=cls.NEEDS_BUILDING,
@@ -516,24 +1129,182 @@ class BuildRecord(models.Model):
     def pending_build_count(cls):
         return cls.pending_builds().count()
 
-    def superseded(self):
-        pkginfo = self.series.get_source_packages()
-        for pocket in pkginfo:
-            if pocket.endswith('-queued'):
+    @classmethod
+    def pending_builds_for_tarball(cls, tarball):
+        return cls.pending_builds().filter(
+                   architecture=tarball.architecture_id,
+                   series__base_ubuntu_series=tarball.series_id)
+
+    @classmethod
+    def pending_tarballs(cls):
+        """The tarballs needed by pending builds, most urgent first"""
+        tarballs = []
+        pending = cls.pending_builds().order_by('-priority')
+        for arch_id, ubuntu_series_id in pending.values_list(
+                                 'architecture', 'series__base_ubuntu_series'):
+            try:
+                tarball = ChrootTarball.objects.get(
+                                              architecture=arch_id,
+                                              series=ubuntu_series_id)
+            except ChrootTarball.DoesNotExist:
+                logger.warning('No %s tarball for %s. Cannot build for it.'
+                               % (arch_id, ubuntu_series_id))
                 continue
-            if self.source_package_name in pkginfo[pocket]:
-                version = pkginfo[pocket][self.source_package_name]
-                if self.version == version:
-                    return False
-        return True
+            if tarball not in tarballs:
+                tarballs.append(tarball)
+        return tarballs
+
+    @staticmethod
+    def upload_from_hook_args(args):
+        """(codename, name, version, .dsc path) from the arguments reprepro
+        gives its dsc notifiers, or None if there is nothing to build"""
+        if len(args) < 7 or args[0] not in ('add', 'replace'):
+            return None
+        codename, name, version = args[1], args[5], args[6]
+        for f in args[7:]:
+            if f.endswith('.dsc'):
+                return (codename, name, version, f)
+        raise Exception('Adding dsc without .dsc file?!?')
 
     @classmethod
-    def perform_single_build(cls):
-        if cls.pending_build_count() > 0:
-            bn = BuildNode.start_new()
-            br = BuildRecord.pick_build(bn)
-            bn.prepare(br)
-            bn.build(br)
+    def create_for_uploads(cls, repository, uploads):
+        """Creates build records for sources reprepro has accepted into
+        -proposed
+
+        uploads is a list of (codename, name, version, .dsc path) tuples.
+        Build records that already exist are skipped. Returns the number
+        of build records created."""
+        if not uploads:
+            return 0
+
+        series_by_name = dict((series.name, series)
+                              for series in repository.series_set.all())
+        known_archs = dict((arch.name, arch)
+                           for arch in Architecture.objects.all())
+
+        def dsc_architectures(path):
+            try:
+                return utils.dsc_architectures(path)
+            except (IOError, OSError), e:
+                logger.error('Not creating build records for %s: %s' %
+                             (path, e))
+                return None
+
+        # Reading the .dsc files is what takes time
+        paths = [os.path.join(repository.reprepro_outdir, dsc)
+                 for _, __, ___, dsc in uploads]
+        threads = min(len(paths), getattr(settings, 'DSC_READ_THREADS', 8))
+        if threads > 1:
+            pool = ThreadPool(threads)
+            try:
+                requested = pool.map(dsc_architectures, paths)
+            finally:
+                pool.close()
+        else:
+            requested = map(dsc_architectures, paths)
+
+        wanted = {}
+        proposed = {}
+        for (codename, name, version, dsc), archs in zip(uploads, requested):
+            if archs is None:
+                continue
+            series = series_by_name[codename[:-len('-proposed')]]
+            build_archs = set()
+            for arch in archs:
+                if arch == 'all':
+                    build_archs.add(known_archs['i386'])
+                elif arch == 'any':
+                    build_archs.update(known_archs.values())
+                elif arch in known_archs:
+                    build_archs.add(known_archs[arch])
+            for arch in build_archs:
+                wanted[(series.id, name, version, arch.name)] = series
+            # Don't wait for update-source-packages (which may go through
+            # the hook daemon) before sweep_superseded knows about it
+            proposed[(series, 'proposed', name)] = version
+
+        def existing():
+            names = sorted(set(key[1] for key in wanted))
+            found = set()
+            for i in range(0, len(names), 500):
+                found.update(cls.objects.filter(
+                    series__in=set(key[0] for key in wanted),
+                    source_package_name__in=names[i:i + 500]).values_list(
+                        'series', 'source_package_name', 'version',
+                        'architecture'))
+            return found
+
+        for attempt in range(2):
+            found = existing()
+            new = [cls(series=series, source_package_name=name,
+                       version=version, architecture=known_archs[arch],
+                       state=cls.NEEDS_BUILDING)
+                   for (series_id, name, version, arch), series
+                   in wanted.iteritems()
+                   if (series_id, name, version, arch) not in found]
+            try:
+                if transaction.is_managed():
+                    # Part of the caller's transaction
+                    cls.objects.bulk_create(new)
+                    SourcePackageVersion.record_many(proposed)
+                else:
+                    with transaction.commit_on_success():
+                        cls.objects.bulk_create(new)
+                        SourcePackageVersion.record_many(proposed)
+                break
+            except IntegrityError:
+                # Someone else created some of them in the meantime
+                if attempt:
+                    raise
+        logger.info('Created %d build records for %d uploads to %s' %
+                    (len(new), len(uploads), repository))
+        return len(new)
+
+    @classmethod
+    def sweep_superseded(cls):
+        """Marks builds waiting to be built whose package is now at a
+        different version in their series as BUILD_FOR_SUPERSEDED_SOURCE
+
+        Packages the series doesn't list at all are left alone: more
+        likely the table hasn't caught up (or been filled in) yet than
+        the package has gone. Returns the number of builds marked."""
+        waiting = cls.objects.filter(
+                      models.Q(state=cls.NEEDS_BUILDING,
+                               build_node__isnull=True) |
+                      models.Q(state=cls.DEPENDENCY_WAIT))
+        records = list(waiting.values_list('id', 'series',
+                                           'source_package_name', 'version'))
+        if not records:
+            return 0
+
+        current = set(SourcePackageVersion.objects.filter(
+                          series__in=set(r[1] for r in records)).values_list(
+                              'series', 'name', 'version'))
+        listed = set((series, name) for series, name, _ in current)
+        superseded = [pk for pk, series, name, version in records
+                      if (series, name) in listed and
+                         (series, name, version) not in current]
+
+        count = 0
+        # Stay well below SQLite's limit on query parameters. Re-checking
+        # the state means builds picked up in the meantime are left alone.
+        for i in range(0, len(superseded), 500):
+            count += waiting.filter(pk__in=superseded[i:i + 500]).update(
+                                       state=cls.BUILD_FOR_SUPERSEDED_SOURCE)
+        if count:
+            logger.info('Marked %d builds for superseded sources' % (count,))
+        return count
+
+    def superseded(self):
+        """Whether the series now has a different version of the package
+
+        Like sweep_superseded, a package the series doesn't list at all
+        is assumed not to have been recorded yet."""
+        versions = SourcePackageVersion.objects.filter(
+                       series=self.series_id, name=self.source_package_name)
+        if versions.filter(version=self.version).exists():
+            return False
+        return versions.exists()
 
     def allow_rebuild(self):
         return (self.state in [BuildRecord.DEPENDENCY_WAIT,
@@ -541,32 +1312,102 @@ class BuildRecord(models.Model):
                 and not self.superseded())
 
     def build_log_url(self):
-        return '%s/%s' % (settings.BASE_BUILD_LOG_URL, '%s.log.txt' % self.pk)
+        return reverse('build_log', kwargs={'build_id': self.pk})
 
     def logfile(self):
+        """Where logs were kept before they were compressed"""
         return os.path.join(settings.BUILD_LOG_DIR, '%s.log.txt' % self.pk)
 
-    def log_tail(self, max_lines=20):
-        last_lines = []
+    def compressed_log(self):
+        return utils.BlockLog(os.path.join(settings.BUILD_LOG_DIR,
+                                           '%s.log' % self.pk))
+
+    def log(self):
+        """The build log (compressed or not), or None if there is none"""
+        compressed_log = self.compressed_log()
+        if compressed_log.exists():
+            return compressed_log
+        if os.path.exists(self.logfile()):
+            return utils.PlainLog(self.logfile())
+        return None
+
+    def log_files(self):
+        compressed_log = self.compressed_log()
+        return [self.logfile(), compressed_log.data_path,
+                compressed_log.index_path]
+
+    def log_disk_usage(self):
+        """Bytes taken up by the log"""
+        if self.log_bytes is not None:
+            return self.log_bytes
+        return sum(os.path.getsize(path) for path in self.log_files()
+                   if os.path.exists(path))
+
+    def store_log_bytes(self):
+        """Records how much disk the log takes up
+
+        Called when the log writer is closed, so that expiring logs
+        needn't look at the files."""
+        self.log_bytes = None
+        self.log_bytes = self.log_disk_usage()
+        self.__class__.objects.filter(pk=self.pk).update(
+                                          log_bytes=self.log_bytes)
+
+    def expire_log(self):
+        logger.info('Deleting build log of %r' % (self,))
+        for path in self.log_files():
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
         try:
-            with open(self.logfile(), 'r') as fp:
-                for l in fp:
-                    last_lines.append(l)
-
-                last_lines = last_lines[-max_lines:]
-
-            return ''.join(last_lines)
+            utils.log_search_index().remove('build', self.pk)
+        except Exception:
+            logger.error('Failed to remove %r from the search index' %
+                         (self,), exc_info=True)
+        self.log_expired = True
+        self.log_bytes = 0
+        self.__class__.objects.filter(pk=self.pk).update(log_expired=True,
+                                                         log_bytes=0)
+
+    def log_writer(self):
+        if not os.path.exists(settings.BUILD_LOG_DIR):
+            os.makedirs(settings.BUILD_LOG_DIR)
+        if self.log_expired or self.log_bytes is not None:
+            self.log_expired = False
+            self.log_bytes = None
+            self.__class__.objects.filter(pk=self.pk).update(
+                                              log_expired=False,
+                                              log_bytes=None)
+        return utils.BlockLogWriter(
+                   self.compressed_log().prefix,
+                   getattr(settings, 'BUILD_LOG_BLOCK_SIZE', 65536),
+                   getattr(settings, 'BUILD_LOG_FLUSH_INTERVAL', 10),
+                   utils.LogIndexer(utils.log_search_index(), 'build',
+                                    self.pk),
+                   on_close=self.store_log_bytes)
+
+    def log_tail(self, max_lines=20, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = getattr(settings, 'BUILD_LOG_TAIL_MAX_BYTES', 65536)
+        try:
+            return self.log().tail(max_lines, max_bytes)
         except:
             return ''
 
     def parse_summary(self):
-        lines = self.log_tail(40).split('\n')
-        if not lines:
-            return {'Status': 'Unknown'}
+        return self.parse_summary_text(self.log_tail(40))
 
-        for i in range(len(lines) - 1, 0, -1):
+    @staticmethod
+    def parse_summary_text(log_tail):
+        lines = log_tail.split('\n')
+        for i in range(len(lines) - 1, -1, -1):
             if 'Summary' in lines[i]:
                 break
+        else:
+            # sbuild never got as far as the summary (or even started)
+            return {}
 
         # The ith line is the summary heading.
         # i+1 is the bottem of the heading box.
@@ -580,32 +1421,60 @@ class BuildRecord(models.Model):
             summary[k] = v.strip()
         return summary
 
+    def store_summary(self, summary):
+        values = {}
+        for key, field, kind in self.SUMMARY_FIELDS:
+            value = summary.get(key)
+            if kind is int:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    # Missing or "n/a"
+                    value = None
+            else:
+                value = value or ''
+            values[field] = value
+            setattr(self, field, value)
+        self.__class__.objects.filter(pk=self.pk).update(**values)
+
+    def record_failure_signature(self):
+        sig = FailureSignature.record(self.log_tail(max_lines=60),
+                                      self.finished)
+        if sig:
+            self.failure_signature = sig
+            self.__class__.objects.filter(pk=self.pk).update(
+                                                   failure_signature=sig)
+        return sig
+
     def update_state_from_build_log(self):
         logger.debug('Setting build state if %r from build log' % (self,))
 
         summary = self.parse_summary()
-        if summary['Status'] == 'successful':
+        self.store_summary(summary)
+        if summary.get('Status') == 'successful':
             logger.debug('Build summary says build %r completed succesfully. '
                          'Setting state accordingly.' % (self,))
             # Everything worked beautifully
             self.update_state(self.SUCCESFULLY_BUILT)
             return
-        elif summary['Status'] == 'attempted':
+        elif summary.get('Status') == 'attempted':
             # The infrastructure performed as expected. The build failed.
             # There's nothing more for us to do
             logger.debug('Build summary says build %r failed. '
                          'Setting state accordingly.' % (self,))
             self.update_state(self.FAILED_TO_BUILD)
+            self.record_failure_signature()
             return
-        elif summary['Status'] == 'failed':
+        elif summary.get('Status') == 'failed':
             # Some dependencies could not be fulfilled.
-            if summary['Fail-Stage'] == 'install-deps':
+            if summary.get('Fail-Stage') == 'install-deps':
                 logger.debug('Build summary says installing deps failed for '
                              'build %r. Setting state accordingly.' % (self,))
                 self.update_state(self.DEPENDENCY_WAIT)
+                self.record_failure_signature()
                 return
             # We failed to fetch the source pkg. Put it back in the queue
-            if summary['Fail-Stage'] == 'fetch-src':
+            if summary.get('Fail-Stage') == 'fetch-src':
                 logger.debug('Build summary says fetching source for build %r '
                              'failed. Setting state to NEEDS_BUILDING to '
                              'retry.' % (self,))
@@ -620,12 +1489,36 @@ class BuildRecord(models.Model):
         self.update_state(self.NEEDS_BUILDING)
 
     @classmethod
-    def pick_build(cls, build_node):
-        """Picks the highest priority build"""
+    def supports_skip_locked(cls):
+        return (connection.vendor == 'postgresql' and
+                connection.pg_version >= 90500)
+
+    @classmethod
+    def _claim_with_skip_locked(cls, builds, build_node):
+        """Claims the next build in a single statement
+
+        Rows other claimers are looking at are skipped rather than
+        waited for, so concurrent schedulers never block each other."""
+        next_build = builds.order_by('-priority', 'id').values('id')[:1]
+        sql, params = next_build.query.sql_with_params()
+        table = connection.ops.quote_name(cls._meta.db_table)
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET build_node_id = %%s '
+                       'WHERE build_node_id IS NULL AND id = '
+                       '(%s FOR UPDATE OF %s SKIP LOCKED) '
+                       'RETURNING id' % (table, sql, table),
+                       [build_node.pk] + list(params))
+        row = cursor.fetchone()
+        transaction.commit_unless_managed()
+        if row is None:
+            return None
+        return cls.objects.get(id=row[0])
+
+    @classmethod
+    def _claim_with_retries(cls, builds, build_node):
         while True:
-            builds = cls.pending_builds()
             try:
-                next_build = builds.order_by('-priority')[0]
+                next_build = builds.order_by('-priority', 'id')[0]
             except IndexError:
                 return None
             # This ensures that assigning a build node is atomic,x
@@ -641,6 +1534,21 @@ class BuildRecord(models.Model):
             else:
                 return cls.objects.get(id=next_build.id)
 
+    @classmethod
+    def pick_build(cls, build_node, skip_locked=None):
+        """Picks the highest priority build the build node can handle"""
+        if build_node is not None and build_node.tarball_id:
+            builds = cls.pending_builds_for_tarball(build_node.tarball)
+        else:
+            builds = cls.pending_builds()
+
+        if skip_locked is None:
+            skip_locked = cls.supports_skip_locked()
+
+        if skip_locked:
+            return cls._claim_with_skip_locked(builds, build_node)
+        return cls._claim_with_retries(builds, build_node)
+
 
 class Cloud(models.Model):
     name = models.CharField(max_length=200, primary_key=True)
@@ -651,6 +1559,9 @@ class Cloud(models.Model):
     region = models.CharField(max_length=200, blank=True)
     flavor_name = models.CharField(max_length=200)
     image_name = models.CharField(max_length=200)
+    max_build_nodes = models.IntegerField(null=True, blank=True,
+                                          help_text="(Leave blank for no "
+                                                    "limit)")
 
     def __unicode__(self):
         return self.name
@@ -680,14 +1591,275 @@ class KeyPair(models.Model):
     private_key = models.TextField()
     public_key = models.TextField()
 
+    # Parsed private keys, keyed by the key text, so that editing a key
+    # pair makes us parse the new key rather than reuse a stale one.
+    _parsed_keys = {}
+    _parsed_keys_lock = threading.Lock()
+
     def __unicode__(self):
         return '%s@%s' % (self.name, self.cloud)
 
+    @property
+    def paramiko_key(self):
+        with self._parsed_keys_lock:
+            key = self._parsed_keys.get(self.private_key)
+            if key is None:
+                priv_key_file = StringIO.StringIO(self.private_key)
+                key = paramiko.RSAKey.from_private_key(priv_key_file)
+                self._parsed_keys[self.private_key] = key
+            return key
+
     class Meta:
         verbose_name_plural = "series"
         unique_together = ('cloud', 'name')
 
 
+class BuildNodeImage(models.Model):
+    """An image of a build node with everything set up for a tarball"""
+    cloud = models.ForeignKey(Cloud)
+    tarball = models.ForeignKey(ChrootTarball)
+    image_id = models.CharField(max_length=200)
+    created = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('cloud', 'tarball')
+
+    def __unicode__(self):
+        return '%s@%s' % (self.tarball, self.cloud)
+
+    def is_stale(self):
+        return (self.tarball.last_refresh is not None and
+                self.created < self.tarball.last_refresh)
+
+    @classmethod
+    def usable_image(cls, cloud, tarball):
+        try:
+            image = cls.objects.get(cloud=cloud, tarball=tarball)
+        except cls.DoesNotExist:
+            return None
+
+        if image.is_stale():
+            logger.info('Image %s predates the last refresh of %s' %
+                        (image, tarball))
+            return None
+        return image
+
+    @classmethod
+    def bake(cls, cloud, tarball):
+        """Prepares a fresh node for the tarball and takes an image of it"""
+        logger.info('Baking build node image for %s on cloud %s' %
+                    (tarball, cloud))
+        started = timezone.now()
+        bn = BuildNode.start_new(cloud)
+        try:
+            bn.update_state(BuildNode.BOOTING)
+            bn.wait_until_reachable()
+            bn.update_state(BuildNode.PREPARING)
+            bn.install(tarball)
+            image_id = bn.snapshot('buildd-%s-%s-%s' %
+                                   (tarball.series.name,
+                                    tarball.architecture.name,
+                                    started.strftime('%Y%m%d%H%M%S')))
+        finally:
+            bn.delete()
+
+        try:
+            image = cls.objects.get(cloud=cloud, tarball=tarball)
+            old_image_id = image.image_id
+        except cls.DoesNotExist:
+            image = cls(cloud=cloud, tarball=tarball)
+            old_image_id = None
+
+        image.image_id = image_id
+        image.created = started
+        image.save()
+
+        if old_image_id:
+            logger.info('Deleting superseded image %s on cloud %s' %
+                        (old_image_id, cloud))
+            try:
+                cloud.client.images.get(old_image_id).delete()
+            except novaclient_exceptions.NotFound:
+                pass
+        return image
+
+    def delete(self):
+        try:
+            self.cloud.client.images.get(self.image_id).delete()
+        except novaclient_exceptions.NotFound:
+            logger.info('Image %s already gone' % (self.image_id,))
+        super(BuildNodeImage, self).delete()
+
+
+class SSHConnectionCache(object):
+    """Keeps one SSH connection open per build node
+
+    Commands each get their own channel on the node's connection, so
+    only the first command (or the first one after the connection
+    dropped) pays for the TCP connection and key exchange."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    @staticmethod
+    def keepalive_interval():
+        return getattr(settings, 'SSH_KEEPALIVE_INTERVAL', 30)
+
+    @staticmethod
+    def _is_active(ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get(self, build_node):
+        with self._lock:
+            ssh = self._clients.get(build_node.name)
+            if ssh is not None:
+                if self._is_active(ssh):
+                    return ssh
+                del self._clients[build_node.name]
+
+        if ssh is not None:
+            logger.info('SSH connection to %s went away. Reconnecting.' %
+                        (build_node,))
+            ssh.close()
+
+        ssh = build_node.ssh_client()
+        ssh.get_transport().set_keepalive(self.keepalive_interval())
+
+        with self._lock:
+            # Another thread may have connected in the mean time
+            existing = self._clients.get(build_node.name)
+            if existing is not None and self._is_active(existing):
+                ssh.close()
+                return existing
+            self._clients[build_node.name] = ssh
+        return ssh
+
+    def close(self, build_node):
+        with self._lock:
+            ssh = self._clients.pop(build_node.name, None)
+        if ssh is not None:
+            ssh.close()
+
+ssh_connections = SSHConnectionCache()
+
+
+class CommandMultiplexer(object):
+    """Streams the output of commands running on many build nodes
+
+    A single select() loop reads from every channel that has been
+    added and hands the output to that channel's output_callback.
+    Channels that had nothing to read get their idle_callback called
+    instead. Once a command exits, its channel is closed and
+    exit_callback is called with the exit status. Channels can be added from any thread, but
+    the callbacks all run in whichever thread calls run(), so they must
+    not block. Slow work belongs in spawn()."""
+    chunk_size = 32768
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._spawned = 0
+
+    @property
+    def busy(self):
+        with self._lock:
+            return bool(self._channels) or self._spawned > 0
+
+    def spawn(self, func, *args):
+        """Calls func(*args) in a thread of its own
+
+        The multiplexer counts as busy until it returns."""
+        with self._lock:
+            self._spawned += 1
+        thread = threading.Thread(target=self._run_spawned,
+                                  args=(func,) + args)
+        thread.daemon = True
+        try:
+            thread.start()
+        except Exception:
+            with self._lock:
+                self._spawned -= 1
+            raise
+        return thread
+
+    def _run_spawned(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            logger.error('Command follow-up failed', exc_info=True)
+        finally:
+            # Each thread gets its own database connection
+            connection.close()
+            with self._lock:
+                self._spawned -= 1
+
+    def add(self, chan, output_callback=None, exit_callback=None,
+            idle_callback=None):
+        with self._lock:
+            self._channels[chan] = (output_callback or (lambda _: None),
+                                    exit_callback or (lambda _: None),
+                                    idle_callback)
+
+    def _call(self, callback, arg):
+        try:
+            callback(arg)
+        except Exception:
+            logger.error('Command callback failed', exc_info=True)
+
+    def _service(self, chan):
+        output_callback, exit_callback, _ = self._channels[chan]
+        while chan.recv_ready():
+            data = chan.recv(self.chunk_size)
+            if not data:
+                break
+            self._call(output_callback, data)
+
+        if not chan.recv_ready() and chan.exit_status_ready():
+            with self._lock:
+                del self._channels[chan]
+            status = chan.recv_exit_status()
+            chan.close()
+            self._call(exit_callback, status)
+
+    def run_once(self, timeout=1):
+        with self._lock:
+            channels = dict(self._channels)
+
+        if not channels:
+            time.sleep(timeout)
+            return
+
+        r, _, __ = select.select(channels.keys(), [], [], timeout)
+        for chan in r:
+            self._service(chan)
+
+        ready = set(r)
+        for chan, (_, __, idle_callback) in channels.iteritems():
+            if chan not in ready and idle_callback is not None:
+                try:
+                    idle_callback()
+                except Exception:
+                    logger.error('Command callback failed', exc_info=True)
+
+    def run(self, timeout=None):
+        """Runs until every command has exited or timeout seconds pass"""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.busy:
+            if timeout is None:
+                self.run_once()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                self.run_once(min(remaining, 1))
+        if timeout is not None:
+            remaining = deadline - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+
+
 class BuildNode(models.Model):
     NEW = 0
     BOOTING = 1
@@ -711,89 +1883,267 @@ class BuildNode(models.Model):
     state = models.SmallIntegerField(default=NEW,
                                      choices=NODE_STATES)
     signing_key_id = models.CharField(max_length=200)
+    tarball = models.ForeignKey(ChrootTarball, null=True, blank=True)
+    last_used = models.DateTimeField(null=True, blank=True)
+    image = models.ForeignKey('BuildNodeImage', null=True, blank=True,
+                              on_delete=models.SET_NULL)
 
     def __unicode__(self):
         return self.name
 
+    @classmethod
+    def idle_nodes(cls, tarball=None):
+        nodes = cls.objects.filter(state=cls.READY)
+        if tarball is not None:
+            nodes = nodes.filter(tarball=tarball)
+        return nodes.order_by('last_used')
+
+    @classmethod
+    def pool_min_size(cls):
+        return getattr(settings, 'BUILD_NODE_POOL_MIN_SIZE', 0)
+
+    @classmethod
+    def pool_max_size(cls):
+        return getattr(settings, 'BUILD_NODE_POOL_MAX_SIZE', 2)
+
+    @classmethod
+    def pool_idle_ttl(cls):
+        return getattr(settings, 'BUILD_NODE_IDLE_TTL', 600)
+
+    @classmethod
+    def expire_idle_nodes(cls):
+        """Deletes nodes that have been idle for longer than the idle TTL
+
+        The pool for each tarball is never shrunk below its minimum size."""
+        cutoff = timezone.now() - datetime.timedelta(seconds=cls.pool_idle_ttl())
+        for tarball in ChrootTarball.objects.filter(
+                                    buildnode__state=cls.READY).distinct():
+            idle = list(cls.idle_nodes(tarball))
+            surplus = len(idle) - cls.pool_min_size()
+            for node in idle[:max(surplus, 0)]:
+                if node.last_used is None or node.last_used < cutoff:
+                    logger.info('%s has been idle since %s. Retiring it.' %
+                                (node, node.last_used))
+                    node.retire()
+
+    def current_build_record(self):
+        try:
+            return self.buildrecord_set.order_by('-id')[0]
+        except IndexError:
+            return None
+
+    def acquire(self):
+        """Atomically takes an idle node out of the pool
+
+        Returns False if someone else got to it first."""
+        matches = self.__class__.objects.filter(pk=self.pk,
+                                                state=self.READY
+                                               ).update(state=self.BUILDING)
+        if matches != 1:
+            return False
+        self.state = self.BUILDING
+        return True
+
+    def retire(self):
+        """Deletes an idle node, unless someone grabbed it meanwhile"""
+        matches = self.__class__.objects.filter(pk=self.pk,
+                                                state=self.READY
+                                               ).update(state=self.SHUTTING_DOWN)
+        if matches == 1:
+            self.state = self.SHUTTING_DOWN
+            self.delete()
+            return True
+        return False
+
+    def release(self, build_record=None):
+        """Hands the node back to the pool once it's done building"""
+        try:
+            self._run_cmd('rm -rf build')
+            healthy = True
+        except Exception:
+            logger.info('Cleaning up build node %s failed' % (self,),
+                        exc_info=True)
+            healthy = False
+
+        pool_size = self.__class__.idle_nodes(self.tarball_id).count()
+        if healthy and pool_size < self.pool_max_size():
+            logger.info('Returning build node %s to the pool' % (self,))
+            self.last_used = timezone.now()
+            self.state = self.READY
+            self.save()
+        elif (build_record is not None and
+                  build_record.state == BuildRecord.SUCCESFULLY_BUILT):
+            # If the build succeeded, defer deleting the build node record
+            # until the upload has been processed.
+            self.update_state(self.SHUTTING_DOWN)
+        else:
+            self.delete()
+
     def _run_cmd(self, cmd, *args, **kwargs):
+        """Runs cmd, logging its output line by line
+
+        The output is only returned if keep_output is True."""
         def log(s):
             logger.info('%-15s: %s' % (self.name, s))
 
-        def log_whole_lines(lbuf):
-            while '\n' in lbuf:
-                line, lbuf = lbuf.split('\n', 1)
-                log(line)
-            return lbuf
-
         output_callback = kwargs.pop('output_callback', lambda _: None)
+        keep_output = kwargs.pop('keep_output', False)
 
-        out = ''
-        lbuf = ''
+        output = utils.CommandOutput(log, keep=keep_output)
         for data in self.run_cmd(cmd, *args, **kwargs):
             output_callback(data)
-            out += data
-            lbuf += data
-            lbuf = log_whole_lines(lbuf)
+            output.feed(data)
+        output.close()
 
-        lbuf = log_whole_lines(lbuf)
-        log(lbuf)
-        return out
+        if keep_output:
+            return output.getvalue()
 
     def update_state(self, new_state):
         self.__class__.objects.filter(pk=self.pk).update(state=new_state)
         # Also update this cached object
         self.state = new_state
 
-    def prepare(self, build_record):
+    def wait_until_reachable(self):
+        while True:
+            try:
+                self._run_cmd('id')
+                break
+            except Exception:
+                logger.debug('Build node %s not reachable yet' % (self,),
+                             exc_info=True)
+            time.sleep(5)
+
+    def install(self, tarball):
+        """Installs the build infrastructure for the given chroot tarball"""
+        self._run_cmd('sudo apt-get update')
+        self._run_cmd('sudo DEBIAN_FRONTEND=noninteractive '
+                      'apt-get -y --force-yes install puppet')
+        self._run_cmd('sudo wget -O puppet.pp %s/puppet/nodes/%s/' %
+                                      (settings.BASE_URL, tarball.id))
+        self._run_cmd('sudo -H puppet apply --verbose puppet.pp')
+
+    def generate_signing_key(self):
+        self._run_cmd(textwrap.dedent('''\n
+                      cat <<EOF > keygen.param
+                      Key-Type: 1
+                      Key-Length: 2048
+                      Subkey-Type: ELG-E
+                      Subkey-Length: 2048
+                      Name-Real: %s signing key
+                      Expire-Date: 0
+                      %%commit
+                      EOF''' % (self,)))
+        out = self._run_cmd('''gpg --gen-key --batch keygen.param''',
+                            keep_output=True)
+        for l in out.split('\n'):
+            if l.startswith('gpg: key '):
+                key_id = l.split(' ')[2]
+        self.signing_key_id = key_id
+
+        public_key_data = self._run_cmd('gpg -a --export %s' %
+                                        (self.signing_key_id),
+                                        keep_output=True)
+        utils.run_cmd(['gpg', '--import'], input=public_key_data)
+
+    def prepare(self, tarball):
+        """Gets the node ready to build with the given chroot tarball
+
+        Nodes booted from a pre-baked image already have the build
+        infrastructure installed, so they only need a signing key."""
         self.state = self.BOOTING
+        self.tarball = tarball
         self.save()
         try:
-            while True:
-                try:
-                    self._run_cmd('id')
-                    break
-                except Exception, e:
-                    print e
-                time.sleep(5)
+            self.wait_until_reachable()
             self.state = self.PREPARING
             self.save()
-            self._run_cmd('sudo apt-get update')
-            self._run_cmd('sudo DEBIAN_FRONTEND=noninteractive '
-                          'apt-get -y --force-yes install puppet')
-            self._run_cmd('sudo wget -O puppet.pp %s/puppet/%s/' %
-                                          (settings.BASE_URL, build_record.id))
-            self._run_cmd('sudo -H puppet apply --verbose puppet.pp')
-            self._run_cmd(textwrap.dedent('''\n
-                          cat <<EOF > keygen.param
-                          Key-Type: 1
-                          Key-Length: 2048
-                          Subkey-Type: ELG-E
-                          Subkey-Length: 2048
-                          Name-Real: %s signing key
-                          Expire-Date: 0
-                          %%commit
-                          EOF''' % (self,)))
-            out = self._run_cmd('''gpg --gen-key --batch keygen.param''')
-            for l in out.split('\n'):
-                if l.startswith('gpg: key '):
-                    key_id = l.split(' ')[2]
-            self.signing_key_id = key_id
-
-            public_key_data = self._run_cmd('gpg -a --export %s' %
-                                            (self.signing_key_id))
-            utils.run_cmd(['gpg', '--import'], input=public_key_data)
+            if self.image_id is None:
+                self.install(tarball)
+            self.generate_signing_key()
 
             self.state = self.READY
+            self.last_used = timezone.now()
             self.save()
-            build_record.series.repository.write_configuration()
         except Exception, e:
             logger.info('Preparing build node %s failed' % (self.name),
                          exc_info=True)
             self.delete()
 
-    def build(self, build_record):
+    def snapshot(self, name):
+        """Turns this node's disk into an image. Returns the image id."""
+        cl = self.cloud.client
+        self._run_cmd('sync')
+        logger.info('Creating image %s from build node %s' % (name, self))
+        image_id = cl.servers.create_image(self.cloud_node_id, name)
+
+        timeout = time.time() + getattr(settings, 'IMAGE_SNAPSHOT_TIMEOUT',
+                                        1800)
+        while timeout > time.time():
+            image = cl.images.get(image_id)
+            if image.status == 'ACTIVE':
+                return image_id
+            elif image.status == 'ERROR':
+                break
+            time.sleep(10)
+
+        try:
+            cl.images.get(image_id).delete()
+        except novaclient_exceptions.NotFound:
+            pass
+        raise Exception('Failed to create image %s from build node %s' %
+                        (name, self))
+
+    def customise(self, build_record):
+        """Points an already prepared node at the build's repository"""
+        self._run_cmd('sudo wget -O build.pp %s/puppet/%s/' %
+                                      (settings.BASE_URL, build_record.id))
+        self._run_cmd('sudo -H puppet apply --verbose build.pp')
+        # Make sure the repository accepts uploads signed by this node
+        build_record.series.repository.schedule_write_configuration()
+
+    def build(self, build_record, multiplexer=None):
+        """Builds build_record on this node
+
+        If a multiplexer is given, this returns as soon as sbuild has been
+        started. The rest of the build is then driven by whoever runs the
+        multiplexer. Otherwise, it waits for the build to finish."""
+        if multiplexer is None:
+            multiplexer = CommandMultiplexer()
+            self.build(build_record, multiplexer)
+            multiplexer.run()
+            return
+
         self.update_state(BuildNode.BUILDING)
         build_record.update_state(BuildRecord.BUILDING)
+
+        def finish(status=None):
+            try:
+                self.finish_build(build_record)
+            except Exception:
+                logger.error('Finishing build %r on %s failed' %
+                             (build_record, self), exc_info=True)
+                build_record.requeue()
+                self.delete()
+
+        # Closing the log, cleaning up the node and talking to the cloud
+        # all block, so they stay out of the multiplexer's thread
+        def finish_later(status):
+            multiplexer.spawn(finish)
+
+        def upload(status):
+            log.close()
+            if status != 0:
+                finish()
+                return
+            try:
+                self.start_cmd('cd build; dput return *.changes', multiplexer,
+                               exit_callback=finish_later)
+            except Exception:
+                finish()
+
+        def upload_later(status):
+            multiplexer.spawn(upload, status)
+
         try:
             series = build_record.series
             self._run_cmd('mkdir build')
@@ -808,28 +2158,27 @@ class BuildNode(models.Model):
             sbuild_cmd += ('%s_%s' % (build_record.source_package_name,
                                       build_record.version))
 
-            if not os.path.exists(settings.BUILD_LOG_DIR):
-                os.makedirs(settings.BUILD_LOG_DIR)
-
-            with open(build_record.logfile(), 'a') as fp:
-                def write_and_flush(s):
-                    fp.write(s)
-                    fp.flush()
-
-                self._run_cmd(sbuild_cmd, output_callback=write_and_flush)
-
-            self._run_cmd('cd build; dput return *.changes')
+            log = build_record.log_writer()
+            try:
+                self.start_cmd(sbuild_cmd, multiplexer,
+                               output_callback=log.write,
+                               idle_callback=log.flush_if_due,
+                               exit_callback=upload_later)
+            except Exception:
+                log.close()
+                raise
         except Exception:
-            pass
+            finish()
 
+    def finish_build(self, build_record):
         build_record.update_state_from_build_log()
+        if build_record.state == BuildRecord.NEEDS_BUILDING:
+            # Let another node have a go
+            build_record.build_node = None
         build_record.finished = timezone.now()
         build_record.save()
 
-        if build_record.state != build_record.SUCCESFULLY_BUILT:
-            # If the build succeeded, defer deleting the build node record
-            # until the upload has been processed.
-            self.delete()
+        self.release(build_record)
 
     @classmethod
     def get_unique_keypair_name(cls, cl):
@@ -840,19 +2189,20 @@ class BuildNode(models.Model):
                 return name
 
     @classmethod
-    def get_unique_buildnode_name(cls, cl):
+    def get_unique_buildnode_names(cls, cl, count):
         existing_server_names = [srv.name for srv in cl.servers.list()]
         old_build_node_names = [bn.name for bn in BuildNode.objects.all()]
         names_to_avoid = set(existing_server_names + old_build_node_names)
-        while True:
+        names = []
+        while len(names) < count:
             name = 'buildd-%d' % random.randint(1, 1000)
             if name not in names_to_avoid:
-                return name
+                names_to_avoid.add(name)
+                names.append(name)
+        return names
 
     @classmethod
-    def start_new(cls):
-        cloud = random.choice(Cloud.objects.all())
-        logger.info('Picked cloud %s' % (cloud,))
+    def get_keypair(cls, cloud):
         cl = cloud.client
         if cloud.keypair_set.count() < 1:
             logger.info('Cloud %s does not have a keypair yet. '
@@ -867,66 +2217,135 @@ class BuildNode(models.Model):
         else:
             keypair = cloud.keypair_set.all()[0]
         logger.debug('Using cached keypair: %s' % (keypair,))
+        return keypair
 
-        name = cls.get_unique_buildnode_name(cl)
-        flavor = utils.get_flavor_by_name(cl, cl.cloud.flavor_name)
-        image = utils.get_image_by_regex(cl, cl.cloud.image_name)
-
-        logger.info('Creating server %s on cloud %s' % (name, cloud))
-        srv = cl.servers.create(name, image, flavor, key_name=keypair.name)
+    @classmethod
+    def get_boot_image(cls, cloud, tarball=None):
+        """Returns the image to boot and the BuildNodeImage it belongs to
 
-        timeout = time.time() + 120
-        succeeded = False
-        while timeout > time.time():
-            if srv.status == 'BUILD':
-                time.sleep(3)
-                srv = cl.servers.get(srv.id)
-            else:
-                succeeded = True
-                break
+        The BuildNodeImage is None if there is no usable pre-baked image for
+        the tarball and the cloud's base image is used instead."""
+        cl = cloud.client
+        image = None
+        baked_image = None
+        if tarball is not None:
+            baked_image = BuildNodeImage.usable_image(cloud, tarball)
+        if baked_image is not None:
+            try:
+                image = cl.images.get(baked_image.image_id)
+                logger.info('Using pre-baked image %s' % (baked_image,))
+            except novaclient_exceptions.NotFound:
+                logger.warning('Pre-baked image %s has gone missing' %
+                               (baked_image,))
+                baked_image = None
+        if image is None:
+            image = utils.get_image_by_regex(cl, cloud.image_name)
+        return image, baked_image
 
-        if not succeeded:
-            srv.delete()
-            raise Exception('Failed to launch instance')
+    @classmethod
+    def start_new(cls, cloud=None, tarball=None):
+        if cloud is None:
+            cloud = random.choice(Cloud.objects.all())
+        logger.info('Picked cloud %s' % (cloud,))
+        for bn in cls.start_many(cloud, tarball, 1):
+            return bn
+        raise Exception('Failed to launch instance')
 
-        if getattr(settings, 'USE_FLOATING_IPS', False):
-            logger.info('Grabbing floating ip for server %s on cloud %s' %
-                        (name, cloud))
-            floating_ip = cl.floating_ips.create()
-            logger.info('Got floating ip %s for server %s on cloud %s' %
-                        (floating_ip.ip, name, cloud))
-
-            logger.debug('Assigning floating ip %s to server %s on cloud %s.'
-                         'Timing out in 20 seconds.' % (floating_ip.ip,
-                                                        name, cloud))
-
-            timeout = time.time() + 20
-            succeeded = False
-            while timeout > time.time():
-                try:
-                    srv.add_floating_ip(floating_ip.ip)
-                    succeeded = True
-                    break
-                except:
-                    pass
-                time.sleep(1)
+    @classmethod
+    def start_many(cls, cloud, tarball=None, count=1):
+        """Boots count build nodes on cloud at the same time
 
-            if succeeded:
-                logger.info('Assigned floating ip %s to server %s on cloud %s.'
-                            % (floating_ip.ip, name, cloud))
-            else:
-                logger.error('Failed to assign floating ip %s to server %s on '
-                             'cloud %s' % (floating_ip.ip, name, cloud))
-                logger.info('Deleting server %s on cloud %s' % (name, cloud))
+        Yields each build node as soon as its server is up (and has its
+        floating ip, if USE_FLOATING_IPS is set). The status of the whole
+        batch is checked with one API call per poll. Servers that fail to
+        come up are deleted."""
+        cl = cloud.client
+        keypair = cls.get_keypair(cloud)
+        flavor = utils.get_flavor_by_name(cl, cloud.flavor_name)
+        image, baked_image = cls.get_boot_image(cloud, tarball)
+        use_floating_ips = getattr(settings, 'USE_FLOATING_IPS', False)
+
+        def register(srv):
+            bn = BuildNode(name=srv.name, cloud=cloud, cloud_node_id=srv.id,
+                           image=baked_image)
+            bn.save()
+            return bn
+
+        booting = {}
+        attaching = {}
+        floating_ips = []
+        try:
+            for name in cls.get_unique_buildnode_names(cl, count):
+                logger.info('Creating server %s on cloud %s' % (name, cloud))
+                srv = cl.servers.create(name, image, flavor,
+                                        key_name=keypair.name)
+                booting[srv.id] = srv
+
+            if use_floating_ips:
+                logger.info('Grabbing %d floating ips on cloud %s' %
+                            (count, cloud))
+                floating_ips = [cl.floating_ips.create()
+                                for _ in range(count)]
+
+            boot_timeout = time.time() + 120
+            while booting or attaching:
+                if booting:
+                    for srv in cl.servers.list():
+                        if srv.id not in booting or srv.status == 'BUILD':
+                            continue
+                        del booting[srv.id]
+                        if srv.status == 'ERROR':
+                            logger.error('Server %s on cloud %s failed to '
+                                         'boot' % (srv.name, cloud))
+                            srv.delete()
+                        elif use_floating_ips:
+                            attaching[srv.id] = (srv, floating_ips.pop(),
+                                                 time.time() + 20)
+                        else:
+                            yield register(srv)
+
+                for srv_id, (srv, floating_ip, timeout) in attaching.items():
+                    try:
+                        srv.add_floating_ip(floating_ip.ip)
+                    except Exception:
+                        if timeout > time.time():
+                            continue
+                        logger.error('Failed to assign floating ip %s to '
+                                     'server %s on cloud %s' %
+                                     (floating_ip.ip, srv.name, cloud))
+                        del attaching[srv_id]
+                        srv.delete()
+                        floating_ip.delete()
+                        continue
+                    del attaching[srv_id]
+                    logger.info('Assigned floating ip %s to server %s on '
+                                'cloud %s.' % (floating_ip.ip, srv.name,
+                                               cloud))
+                    yield register(srv)
+
+                if booting and boot_timeout < time.time():
+                    for srv in booting.values():
+                        logger.error('Server %s on cloud %s did not boot in '
+                                     'time' % (srv.name, cloud))
+                        srv.delete()
+                    booting.clear()
+
+                if booting or attaching:
+                    time.sleep(attaching and 1 or 3)
+        finally:
+            for srv in booting.values():
+                logger.info('Deleting server %s on cloud %s' %
+                            (srv.name, cloud))
+                srv.delete()
+            for srv, floating_ip, timeout in attaching.values():
+                logger.info('Deleting server %s on cloud %s' %
+                            (srv.name, cloud))
                 srv.delete()
+                floating_ips.append(floating_ip)
+            for floating_ip in floating_ips:
                 logger.info('Deleting floating ip %s on cloud %s' %
                             (floating_ip.ip, cloud))
                 floating_ip.delete()
-                raise Exception('Failed to spawn node')
-
-        bn = BuildNode(name=name, cloud=cloud, cloud_node_id=srv.id)
-        bn.save()
-        return bn
 
     @property
     def cloud_server(self):
@@ -944,6 +2363,8 @@ class BuildNode(models.Model):
         return self.cloud_server.networks.values()[0][index]
 
     def delete(self):
+        ssh_connections.close(self)
+
         if getattr(settings, 'USE_FLOATING_IPS', False):
             try:
                 floating_ip = self.ip
@@ -983,9 +2404,7 @@ class BuildNode(models.Model):
 
     @property
     def paramiko_private_key(self):
-        private_key = self.keypair.private_key
-        priv_key_file = StringIO.StringIO(private_key)
-        return paramiko.RSAKey.from_private_key(priv_key_file)
+        return self.keypair.paramiko_key
 
     def ssh_client(self):
         ssh = paramiko.SSHClient()
@@ -993,35 +2412,54 @@ class BuildNode(models.Model):
         ssh.connect(self.ip, username='ubuntu', pkey=self.paramiko_private_key)
         return ssh
 
-    def run_cmd(self, cmd, input=None):
+    def start_cmd(self, cmd, multiplexer, output_callback=None,
+                  exit_callback=None, input=None, idle_callback=None):
+        """Starts cmd and lets the multiplexer stream its output"""
         logger.debug('Running: %s' % (cmd,))
 
-        ssh = self.ssh_client()
-        transport = ssh.get_transport()
+        chan = self._open_channel()
+        try:
+            chan.exec_command(cmd)
+            chan.set_combine_stderr(True)
+            if input:
+                chan.sendall(input)
+                chan.shutdown_write()
+        except Exception:
+            chan.close()
+            raise
 
-        chan = transport.open_session()
-        chan.exec_command(cmd)
-        chan.set_combine_stderr(True)
-        if input:
-            chan.sendall(input)
-            chan.shutdown_write()
+        multiplexer.add(chan, output_callback, exit_callback, idle_callback)
+        return chan
 
-        while True:
-            r, _, __ = select.select([chan], [], [], 1)
-            if r:
-                if chan in r:
-                    if chan.recv_ready():
-                        s = chan.recv(4096)
-                        if len(s) == 0:
-                            break
-                        yield s
-                    else:
-                        status = chan.recv_exit_status()
-                        if status != 0:
-                            raise Exception('Command %s failed' % cmd)
-                        break
+    def run_cmd(self, cmd, input=None):
+        output = []
+        status = []
+        multiplexer = CommandMultiplexer()
+        chan = self.start_cmd(cmd, multiplexer, output.append, status.append,
+                              input=input)
+        try:
+            while multiplexer.busy:
+                multiplexer.run_once()
+                while output:
+                    yield output.pop(0)
+        finally:
+            if multiplexer.busy:
+                # The caller stopped reading before the command exited
+                chan.close()
+
+        if status[0] != 0:
+            raise Exception('Command %s failed' % cmd)
 
-        ssh.close()
+    def _open_channel(self):
+        try:
+            return ssh_connections.get(self).get_transport().open_session()
+        except (paramiko.SSHException, socket.error), e:
+            # The connection died since we last looked at it.
+            # Try once more on a fresh one.
+            logger.info('Failed to open channel to %s (%s). Reconnecting.' %
+                        (self, e))
+            ssh_connections.close(self)
+            return ssh_connections.get(self).get_transport().open_session()
 
     def _posix_shell(self, chan):
         oldtty = termios.tcgetattr(sys.stdin)
@@ -1056,6 +2494,340 @@ class BuildNode(models.Model):
         self._posix_shell(shell)
 
 
+class BuildWorker(threading.Thread):
+    """Runs a single build on a build node
+
+    If no build node is given, a new one is booted on the given cloud.
+    New build nodes are prepared for the given tarball first. Once the
+    build is done, the node is returned to the pool. If a multiplexer is
+    given, the worker hands the build over to it as soon as sbuild is
+    running."""
+    def __init__(self, cloud, tarball, build_node=None, multiplexer=None):
+        super(BuildWorker, self).__init__(name='build-worker-%s' % (cloud,))
+        self.daemon = True
+        self.cloud = cloud
+        self.tarball = tarball
+        self.build_node = build_node
+        self.build_record = None
+        self.multiplexer = multiplexer
+
+    def run(self):
+        try:
+            if self.build_node is None:
+                self.build_node = BuildNode.start_new(self.cloud,
+                                                      self.tarball)
+            if self.build_node.state == BuildNode.NEW:
+                self.build_node.prepare(self.tarball)
+                if self.build_node.state != BuildNode.READY:
+                    # prepare() has already logged the failure and deleted
+                    # the node.
+                    return
+                if not self.build_node.acquire():
+                    # The scheduler handed the idle node to someone else
+                    return
+
+            self.build_record = BuildRecord.pick_build(self.build_node)
+            if self.build_record is None:
+                logger.info('No pending builds left for %s' %
+                            (self.build_node,))
+                self.build_node.release()
+                return
+
+            self.build_node.customise(self.build_record)
+            self.build_node.build(self.build_record, self.multiplexer)
+        except Exception:
+            logger.error('Build worker on cloud %s failed' % (self.cloud,),
+                         exc_info=True)
+            if self.build_node is not None:
+                # Deleting the node also puts the build record (if any)
+                # back in the queue
+                try:
+                    self.build_node.delete()
+                except Exception:
+                    logger.error('Deleting build node %s failed' %
+                                 (self.build_node,), exc_info=True)
+        finally:
+            # Each thread gets its own database connection
+            connection.close()
+
+
+class BuildNodeLauncher(threading.Thread):
+    """Boots a batch of build nodes on a cloud
+
+    Each node is handed to a new build worker as soon as it is up."""
+    def __init__(self, scheduler, cloud, tarball, count):
+        super(BuildNodeLauncher, self).__init__(
+                                   name='build-node-launcher-%s' % (cloud,))
+        self.daemon = True
+        self.scheduler = scheduler
+        self.cloud = cloud
+        self.tarball = tarball
+        self.booting = count
+
+    def run(self):
+        try:
+            for build_node in BuildNode.start_many(self.cloud, self.tarball,
+                                                   self.booting):
+                self.scheduler.start_worker(self.cloud, self.tarball,
+                                            build_node)
+                self.booting -= 1
+        except Exception:
+            logger.error('Launching build nodes on cloud %s failed' %
+                         (self.cloud,), exc_info=True)
+        finally:
+            self.booting = 0
+            connection.close()
+
+
+class BuildSchedulerLock(models.Model):
+    """Makes sure only one BuildScheduler runs at a time
+
+    The holder renews its heartbeat as it goes. A lock whose heartbeat
+    is older than SCHEDULER_LOCK_TIMEOUT seconds (300 by default) is
+    assumed to have been abandoned."""
+    NAME = 'build-scheduler'
+
+    name = models.CharField(max_length=50, primary_key=True)
+    holder = models.CharField(max_length=200)
+    heartbeat = models.DateTimeField()
+
+    def __unicode__(self):
+        return '%s (held by %s)' % (self.name, self.holder)
+
+    @classmethod
+    def acquire(cls, holder):
+        """Takes (or renews) the lock
+
+        Returns False if someone else holds it."""
+        now = timezone.now()
+        timeout = getattr(settings, 'SCHEDULER_LOCK_TIMEOUT', 300)
+        stale = now - datetime.timedelta(seconds=timeout)
+        if cls.objects.filter(models.Q(holder=holder) |
+                              models.Q(heartbeat__lt=stale),
+                              name=cls.NAME).update(holder=holder,
+                                                    heartbeat=now):
+            return True
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(name=cls.NAME, holder=holder, heartbeat=now)
+        except IntegrityError:
+            # Someone else has it
+            transaction.savepoint_rollback(sid)
+            return False
+        transaction.savepoint_commit(sid)
+        return True
+
+    @classmethod
+    def release(cls, holder):
+        cls.objects.filter(name=cls.NAME, holder=holder).delete()
+
+
+class BuildScheduler(object):
+    """Drains the build queue
+
+    Idle build nodes in the pool get work before new ones are booted.
+    Runs up to max_concurrent_builds build nodes at the same time
+    (further limited by each cloud's max_build_nodes) and returns once
+    there is nothing left that it can start and every build it started
+    has finished.
+
+    Workers only live until their build is running. The scheduler
+    streams the output of every running build itself.
+
+    Only one scheduler runs at a time (see BuildSchedulerLock). If
+    another one is already running, run() returns straight away."""
+    def __init__(self, max_concurrent_builds=None, poll_interval=5):
+        if max_concurrent_builds is None:
+            max_concurrent_builds = getattr(settings,
+                                            'MAX_CONCURRENT_BUILDS', 10)
+        self.max_concurrent_builds = max_concurrent_builds
+        self.poll_interval = poll_interval
+        self.workers = []
+        self.launchers = []
+        # Launchers start workers from their own threads
+        self._lock = threading.Lock()
+        self.multiplexer = CommandMultiplexer()
+        self.lock_holder = '%s-%d-%d' % (socket.gethostname(), os.getpid(),
+                                         id(self))
+
+    def active_workers(self):
+        with self._lock:
+            self.workers = [w for w in self.workers if w.is_alive()]
+            return list(self.workers)
+
+    def active_launchers(self):
+        with self._lock:
+            self.launchers = [l for l in self.launchers if l.is_alive()]
+            return list(self.launchers)
+
+    def unclaimed_workers(self, tarball=None):
+        """Workers that have not picked their build record yet"""
+        return [w for w in self.active_workers()
+                if w.build_record is None and
+                   (tarball is None or w.tarball == tarball)]
+
+    def booting_nodes(self, cloud=None, tarball=None):
+        """Number of nodes being booted that have no BuildNode record yet"""
+        def matches(w):
+            return ((cloud is None or w.cloud == cloud) and
+                    (tarball is None or w.tarball == tarball))
+
+        return (len([w for w in self.active_workers()
+                     if w.build_node is None and matches(w)]) +
+                sum(l.booting for l in self.active_launchers() if matches(l)))
+
+    def nodes_in_use(self, cloud=None):
+        nodes = BuildNode.objects.all()
+        if cloud is not None:
+            nodes = nodes.filter(cloud=cloud)
+        return nodes.count() + self.booting_nodes(cloud)
+
+    def free_slots(self, cloud):
+        free = self.max_concurrent_builds - self.nodes_in_use()
+        if cloud.max_build_nodes is not None:
+            free = min(free, cloud.max_build_nodes - self.nodes_in_use(cloud))
+        return max(free, 0)
+
+    def available_clouds(self):
+        if self.nodes_in_use() >= self.max_concurrent_builds:
+            return []
+        return [cloud for cloud in Cloud.objects.all()
+                if self.free_slots(cloud) > 0]
+
+    def nodes_wanted(self, tarball):
+        """Number of pending builds for tarball no node is on its way for"""
+        pending = BuildRecord.pending_builds_for_tarball(tarball).count()
+        on_their_way = (len([w for w in self.unclaimed_workers(tarball)
+                             if w.build_node is not None]) +
+                        self.booting_nodes(tarball=tarball))
+        return pending - on_their_way
+
+    def needs_node(self, tarball):
+        return self.nodes_wanted(tarball) > 0
+
+    def start_worker(self, cloud, tarball, build_node=None):
+        worker = BuildWorker(cloud, tarball, build_node, self.multiplexer)
+        with self._lock:
+            self.workers.append(worker)
+        worker.start()
+        return worker
+
+    def start_launcher(self, cloud, tarball, count):
+        logger.info('Booting %d build nodes for %s on cloud %s' %
+                    (count, tarball, cloud))
+        launcher = BuildNodeLauncher(self, cloud, tarball, count)
+        with self._lock:
+            self.launchers.append(launcher)
+        launcher.start()
+        return launcher
+
+    def dispatch_to_idle_node(self):
+        for build_node in BuildNode.idle_nodes():
+            if build_node.tarball_id is None:
+                continue
+            if not self.needs_node(build_node.tarball):
+                continue
+            if build_node.acquire():
+                logger.info('Reusing idle build node %s' % (build_node,))
+                self.start_worker(build_node.cloud, build_node.tarball,
+                                  build_node)
+                return True
+        return False
+
+    def make_room(self, tarball):
+        """Retires an idle node no pending build can use"""
+        for build_node in BuildNode.idle_nodes().exclude(tarball=tarball):
+            if (build_node.tarball_id is None or
+                    not self.needs_node(build_node.tarball)):
+                if build_node.retire():
+                    return True
+        return False
+
+    def dispatch_to_new_node(self):
+        for tarball in BuildRecord.pending_tarballs():
+            wanted = self.nodes_wanted(tarball)
+            if wanted < 1:
+                continue
+            clouds = self.available_clouds()
+            if not clouds and self.make_room(tarball):
+                clouds = self.available_clouds()
+            if clouds:
+                cloud = random.choice(clouds)
+                self.start_launcher(cloud, tarball,
+                                    min(wanted, self.free_slots(cloud)))
+                return True
+        return False
+
+    def fill_pool(self):
+        """Boots nodes until each pool has at least its minimum size"""
+        if BuildNode.pool_min_size() < 1:
+            return False
+        tarballs = ChrootTarball.objects.filter(
+                        state=ChrootTarball.READY,
+                        series__series__state__in=[Series.ACTIVE,
+                                                   Series.MAINTAINED,
+                                                   Series.FROZEN]).distinct()
+        for tarball in tarballs:
+            warm = (BuildNode.idle_nodes(tarball).count() +
+                    len(self.unclaimed_workers(tarball)) +
+                    self.booting_nodes(tarball=tarball))
+            if warm >= BuildNode.pool_min_size():
+                continue
+            clouds = self.available_clouds()
+            if clouds:
+                logger.info('Pool for %s is below its minimum size. '
+                            'Booting more nodes.' % (tarball,))
+                cloud = random.choice(clouds)
+                self.start_launcher(cloud, tarball,
+                                    min(BuildNode.pool_min_size() - warm,
+                                        self.free_slots(cloud)))
+                return True
+        return False
+
+    def report(self, pending):
+        logger.info('Build queue: %d pending, %d of %d build slots in use '
+                    '(%d idle), %d workers starting builds' %
+                    (pending, self.nodes_in_use(), self.max_concurrent_builds,
+                     BuildNode.idle_nodes().count(),
+                     len(self.active_workers())))
+
+    def run(self):
+        """Drains the build queue
+
+        Returns False if another scheduler is already doing that."""
+        if not BuildSchedulerLock.acquire(self.lock_holder):
+            logger.info('Another build scheduler is running')
+            return False
+        try:
+            while True:
+                # Renewing the lock doubles as a heartbeat. If someone
+                # has taken over, leave dispatching to them and just see
+                # our own builds through.
+                if BuildSchedulerLock.acquire(self.lock_holder):
+                    BuildNode.expire_idle_nodes()
+                    # Don't boot anything for versions that are already
+                    # gone
+                    BuildRecord.sweep_superseded()
+                    self.report(BuildRecord.pending_build_count())
+
+                    if (self.dispatch_to_idle_node() or
+                            self.dispatch_to_new_node() or
+                            self.fill_pool()):
+                        continue
+                else:
+                    logger.warning('Lost the build scheduler lock')
+
+                if (not self.active_workers() and
+                        not self.active_launchers() and
+                        not self.multiplexer.busy):
+                    break
+
+                self.multiplexer.run(self.poll_interval)
+        finally:
+            BuildSchedulerLock.release(self.lock_holder)
+        return True
+
+
 class TarballCacheEntry(models.Model):
     project_name = models.CharField(max_length=200)
     project_version = models.CharField(max_length=200)
@@ -1084,10 +2856,91 @@ class PackageSourceBuildProblem(models.Model):
     pkg_rev = models.CharField(max_length=200)
     flavor = models.CharField(max_length=200)
     timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+    failure_signature = models.ForeignKey(FailureSignature, null=True,
+                                          blank=True,
+                                          on_delete=models.SET_NULL)
+    log_expired = models.BooleanField(default=False)
+
+    @classmethod
+    def expired_logs(cls, now=None, batch_size=200):
+        """Problems older than SRC_PKG_BUILD_FAILURE_LOG_MAX_AGE days,
+        except the latest one of each package source, oldest first"""
+        max_age = getattr(settings, 'SRC_PKG_BUILD_FAILURE_LOG_MAX_AGE', 30)
+        if max_age is None:
+            return
+        cutoff = (now or timezone.now()) - datetime.timedelta(days=max_age)
+        problems = cls.objects.filter(log_expired=False)
+        candidates = problems.filter(timestamp__lt=cutoff).order_by(
+                                                         'timestamp', 'id')
+        last = None
+        while True:
+            batch = candidates
+            if last is not None:
+                batch = batch.filter(models.Q(timestamp__gt=last.timestamp) |
+                                     models.Q(timestamp=last.timestamp,
+                                              id__gt=last.id))
+            batch = list(batch[:batch_size])
+            if not batch:
+                return
+            latest = dict(problems.filter(
+                              name__in=set(p.name for p in batch)
+                              ).values_list('name').annotate(
+                                  models.Max('timestamp')))
+            for problem in batch:
+                if problem.timestamp < latest.get(problem.name,
+                                                  problem.timestamp):
+                    yield problem
+            last = batch[-1]
+
+    @classmethod
+    def expire_logs(cls, limit=None):
+        expired = 0
+        for problem in cls.expired_logs():
+            if limit is not None and expired >= limit:
+                break
+            problem.expire_log()
+            expired += 1
+        return expired
+
+    def expire_log(self):
+        try:
+            os.unlink(self.log_file())
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        try:
+            utils.log_search_index().remove('problem', self.pk)
+        except Exception:
+            logger.error('Failed to remove %r from the search index' %
+                         (self,), exc_info=True)
+        self.log_expired = True
+        self.__class__.objects.filter(pk=self.pk).update(log_expired=True)
 
     def save_log(self, contents):
         with open(self.log_file(), 'w') as fp:
-            return fp.write(contents)
+            fp.write(contents)
+        self.index_log(contents)
+        self.record_failure_signature(contents)
+
+    def record_failure_signature(self, contents):
+        sig = FailureSignature.record(contents, self.timestamp)
+        if sig:
+            self.failure_signature = sig
+            self.__class__.objects.filter(pk=self.pk).update(
+                                                   failure_signature=sig)
+        return sig
+
+    def index_log(self, contents):
+        index = utils.log_search_index()
+        try:
+            index.remove('problem', self.pk)
+        except Exception:
+            logger.error('Failed to remove %r from the search index' %
+                         (self,), exc_info=True)
+            return
+        indexer = utils.LogIndexer(index, 'problem', self.pk)
+        indexer.add(0, contents)
+        indexer.close()
 
     def log_file(self):
         return os.path.join(settings.SRC_PKG_BUILD_FAILURE_LOG_DIR, str(self.pk))
@@ -18,8 +18,9 @@
 from celery.utils.log import get_task_logger
 from django.conf import settings
 
-from repomgmt.models import BuildRecord, ChrootTarball, PackageSource
-from repomgmt.models import Repository
+from repomgmt.models import BuildNodeImage, BuildScheduler, ChrootTarball
+from repomgmt.models import Cloud, PackageSource, PackageSourceBuildProblem
+from repomgmt.models import Repository, RepreproOperation
 
 logger = get_task_logger(__name__)
 
@@ -31,6 +32,8 @@ if getattr(settings, 'TESTING', False):
             def run(*args, **kwargs):
                 return f(*args, **kwargs)
             f.delay = run
+            f.apply_async = lambda args=(), kwargs={}, **options: run(*args,
+                                                                  **kwargs)
             return f
         return inner
 else:
@@ -42,22 +45,83 @@ def refresh_tarball(tarball_id):
     tb = ChrootTarball.objects.get(pk=tarball_id)
     logger.info('Refreshing %r' % (tb,))
     tb.refresh()
+    rebake_build_node_images.delay(tb.id)
+
+
+@task()
+def bake_build_node_image(cloud_name, tarball_id):
+    cloud = Cloud.objects.get(pk=cloud_name)
+    tb = ChrootTarball.objects.get(pk=tarball_id)
+    BuildNodeImage.bake(cloud, tb)
+
+
+@task()
+def rebake_build_node_images(tarball_id):
+    for image in BuildNodeImage.objects.filter(tarball__id=tarball_id):
+        if image.is_stale():
+            bake_build_node_image.delay(image.cloud_id, tarball_id)
 
 
 @task()
 def process_build_queue():
-    BuildRecord.perform_single_build()
+    BuildScheduler().run()
 
 
 @task()
 def process_incoming():
     for repo in Repository.objects.all():
         try:
-            repo.process_incoming()
+            if repo.has_incoming():
+                process_incoming_for_repository.delay(repo.name)
+            elif RepreproOperation.abandoned(repo).exists():
+                # Nothing else will get them going again
+                run_reprepro_operations.delay(repo.name)
         except Exception, e:
             logger.error('Error processing incoming for %s', repo.name, exc_info=e)
 
 
+@task()
+def process_incoming_for_repository(repository_name):
+    try:
+        repo = Repository.objects.get(name=repository_name)
+    except Repository.DoesNotExist:
+        return
+    # Queued behind (or merged with) anything else that's changing the
+    # repository, so runs never overlap.
+    repo.process_incoming()
+
+
+@task()
+def run_reprepro_operations(repository_name):
+    try:
+        repo = Repository.objects.get(name=repository_name)
+    except Repository.DoesNotExist:
+        return
+    repo.run_reprepro_operations()
+
+
+@task()
+def write_configuration(repository_name):
+    try:
+        repo = Repository.objects.get(name=repository_name)
+    except Repository.DoesNotExist:
+        return
+    # Changes made from now on need another write
+    repo.clear_scheduled_write_configuration()
+    repo.write_configuration()
+
+
+@task()
+def expire_logs(limit=1000):
+    for repo in Repository.objects.all():
+        try:
+            limit -= repo.expire_build_logs(limit)
+        except Exception, e:
+            logger.error('Error expiring build logs for %s', repo.name,
+                         exc_info=e)
+    PackageSourceBuildProblem.expire_logs(limit)
+
+
 @task()
 def poll_upstreams():
     for pkg_src in PackageSource.objects.all():
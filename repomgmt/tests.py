@@ -17,16 +17,36 @@
 #
 from base64 import b64encode
 from contextlib import contextmanager
+import datetime
+import gzip
 import json
 import mock
+import os
+import shutil
+import tempfile
 import textwrap
+import threading
 from StringIO import StringIO
 
 from django.contrib.auth.models import User
-from django.test import TestCase, client
+from django.core.management import call_command
+from django.db import connection, DatabaseError
+from django.template.loader import render_to_string
+from django.test import TestCase, TransactionTestCase, client
 from django.test.utils import override_settings
-from repomgmt.models import Cloud, BuildNode, BuildRecord, KeyPair, Repository
+from django.utils import timezone
+from django.utils.unittest import skipUnless
+from repomgmt import hookclient, tasks, utils
+from repomgmt.models import Cloud, BuildNode, BuildNodeImage, BuildRecord
+from repomgmt.models import BuildScheduler, BuildSchedulerLock
+from repomgmt.models import CommandMultiplexer
+from repomgmt.models import ChrootTarball, FailureSignature, KeyPair
+from repomgmt.exceptions import CommandFailed
+from repomgmt.models import PackageSourceBuildProblem, Repository
+from repomgmt.models import RepreproOperation
 from repomgmt.models import Series, UploaderKey, PackageSource, Subscription
+from repomgmt.models import SourcePackageVersion
+from repomgmt.models import ssh_connections
 
 
 class CloudTests(TestCase):
@@ -127,6 +147,81 @@ class BuildNodeTests(TestCase):
             self.assertEquals(fp.read().split(' ')[1],
                               bn.paramiko_private_key.get_base64())
 
+    def test_paramiko_private_key_is_parsed_once(self):
+        bn = self._create()
+        with mock.patch.dict(KeyPair._parsed_keys, clear=True):
+            with mock.patch('paramiko.RSAKey.from_private_key') as parse:
+                bn.paramiko_private_key
+                bn.paramiko_private_key
+                self.assertEquals(parse.call_count, 1)
+
+    def _run_cmd_with_fake_ssh(self, bn, active=True):
+        ssh = mock.Mock()
+        ssh.get_transport.return_value.is_active.return_value = active
+        chan = ssh.get_transport.return_value.open_session.return_value
+        chan.recv_ready.return_value = False
+        chan.recv_exit_status.return_value = 0
+        with mock.patch.object(BuildNode, 'ssh_client') as ssh_client:
+            ssh_client.return_value = ssh
+            with mock.patch('select.select') as select:
+                select.return_value = ([chan], [], [])
+                list(bn.run_cmd('id'))
+                list(bn.run_cmd('id'))
+        ssh_connections.close(bn)
+        return ssh_client, chan
+
+    def test_run_cmd_reuses_connection(self):
+        bn = self._create()
+        ssh_client, chan = self._run_cmd_with_fake_ssh(bn)
+        self.assertEquals(ssh_client.call_count, 1)
+        self.assertEquals(chan.exec_command.call_count, 2)
+        self.assertEquals(chan.close.call_count, 2)
+
+    def test_run_cmd_reconnects_dead_connection(self):
+        bn = self._create()
+        ssh_client, chan = self._run_cmd_with_fake_ssh(bn, active=False)
+        self.assertEquals(ssh_client.call_count, 2)
+
+    def _server(self, id, status):
+        srv = mock.Mock()
+        srv.id = id
+        srv.name = 'buildd-%s' % (id,)
+        srv.status = status
+        return srv
+
+    def _start_many(self, polls):
+        cloud = Cloud.objects.get(name='test_cloud')
+        with mock.patch.object(Cloud, 'client') as client:
+            client.flavors.list.return_value = []
+            client.images.list.return_value = []
+            client.servers.create.side_effect = [self._server('a', 'BUILD'),
+                                                 self._server('b', 'BUILD')]
+            # The first call checks for name clashes
+            client.servers.list.side_effect = [[]] + polls
+            with mock.patch('time.sleep'):
+                nodes = list(BuildNode.start_many(cloud, count=2))
+        return client, nodes
+
+    def test_start_many_polls_whole_batch(self):
+        client, nodes = self._start_many(
+                            [[self._server('a', 'ACTIVE'),
+                              self._server('b', 'BUILD')],
+                             [self._server('a', 'ACTIVE'),
+                              self._server('b', 'ACTIVE')]])
+
+        self.assertEquals([bn.cloud_node_id for bn in nodes], ['a', 'b'])
+        self.assertEquals(client.servers.create.call_count, 2)
+        self.assertEquals(client.servers.list.call_count, 3)
+        self.assertFalse(client.servers.get.called)
+
+    def test_start_many_deletes_failed_servers(self):
+        failed = self._server('b', 'ERROR')
+        client, nodes = self._start_many([[self._server('a', 'ACTIVE'),
+                                           failed]])
+
+        self.assertEquals([bn.cloud_node_id for bn in nodes], ['a'])
+        failed.delete.assert_called_with()
+
     def test_ip(self):
         bn = self._create()
         with mock.patch.object(Cloud, 'client') as client:
@@ -137,6 +232,259 @@ class BuildNodeTests(TestCase):
             client.servers.get.assert_called_with(self.test_id)
 
 
+class CommandOutputTests(TestCase):
+    def test_lines_split_across_chunks(self):
+        lines = []
+        output = utils.CommandOutput(lines.append)
+        for data in ['fo', 'o\nb', 'a', 'r\nbaz\n', 'qu', 'x']:
+            output.feed(data)
+        output.close()
+
+        self.assertEquals(lines, ['foo', 'bar', 'baz', 'qux'])
+        self.assertEquals(output.getvalue(), '')
+
+    def test_keep_output(self):
+        output = utils.CommandOutput(lambda _: None, keep=True)
+        output.feed('foo\n')
+        output.feed('bar')
+        output.close()
+
+        self.assertEquals(output.getvalue(), 'foo\nbar')
+
+
+class TailTests(TestCase):
+    def _tail(self, contents, *args, **kwargs):
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write(contents)
+            fp.flush()
+            return utils.tail(fp.name, *args, **kwargs)
+
+    def test_matches_naive_tail(self):
+        contents = ''.join('line %d\n' % i for i in range(1000))
+        for block_size in [1, 7, 8192]:
+            for max_lines in [1, 20, 2000]:
+                self.assertEquals(self._tail(contents, max_lines, 1000000,
+                                             block_size=block_size),
+                                  ''.join(contents.splitlines(True)
+                                                  [-max_lines:]))
+
+    def test_no_trailing_newline(self):
+        self.assertEquals(self._tail('foo\nbar\nbaz', 2, 100, block_size=3),
+                          'bar\nbaz')
+
+    def test_byte_budget(self):
+        contents = 'a' * 100 + '\n' + 'b' * 10 + '\n'
+        self.assertEquals(self._tail(contents, 20, 50), 'b' * 10 + '\n')
+
+    def test_empty_file(self):
+        self.assertEquals(self._tail('', 20, 100), '')
+
+
+class BlockLogTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmpdir, 'test.log')
+        self.contents = ''.join('line %d\n' % i for i in range(1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, contents, block_size=1000):
+        writer = utils.BlockLogWriter(self.prefix, block_size=block_size)
+        for i in range(0, len(contents), 100):
+            writer.write(contents[i:i + 100])
+        writer.close()
+        return utils.BlockLog(self.prefix)
+
+    def test_round_trip(self):
+        log = self._write(self.contents)
+        self.assertTrue(len(log.index()) > 1)
+        self.assertEquals(log.size(), len(self.contents))
+        self.assertEquals(''.join(log.read()), self.contents)
+
+    def test_data_file_is_plain_gzip(self):
+        self._write(self.contents)
+        with gzip.open(self.prefix + '.gz') as fp:
+            self.assertEquals(fp.read(), self.contents)
+
+    def test_read_range(self):
+        log = self._write(self.contents)
+        for start, end in [(0, 1), (990, 2010), (1500, 1600),
+                           (len(self.contents) - 5, None)]:
+            self.assertEquals(''.join(log.read(start, end)),
+                              self.contents[start:end])
+
+    def test_tail(self):
+        log = self._write(self.contents)
+        self.assertEquals(log.tail(20, 65536),
+                          ''.join(self.contents.splitlines(True)[-20:]))
+
+    def test_append(self):
+        self._write(self.contents[:5000])
+        log = self._write(self.contents[5000:])
+        self.assertEquals(''.join(log.read()), self.contents)
+
+    def test_flushes_partial_blocks_after_interval(self):
+        writer = utils.BlockLogWriter(self.prefix, flush_interval=0)
+        writer.write('foo\n')
+        self.assertEquals(utils.BlockLog(self.prefix).tail(1, 100), 'foo\n')
+        writer.close()
+
+    def test_flush_if_due(self):
+        writer = utils.BlockLogWriter(self.prefix, flush_interval=60)
+        writer.write('foo\n')
+        writer.flush_if_due()
+        self.assertEquals(utils.BlockLog(self.prefix).index(), [])
+        writer.flush_interval = 0
+        writer.flush_if_due()
+        self.assertEquals(utils.BlockLog(self.prefix).tail(1, 100), 'foo\n')
+        writer.close()
+
+
+class LogSearchIndexTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = utils.LogSearchIndex(os.path.join(self.tmpdir,
+                                                       'search.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_search(self):
+        self.index.add('build', 1, 0, 'gcc: internal compiler error\n')
+        self.index.add('build', 1, 100, 'another compiler error\n')
+        self.index.add('build', 2, 0, 'all good\n')
+        self.index.add('problem', 1, 0, 'compiler exploded\n')
+
+        hits = self.index.search('compiler')
+        self.assertEquals(sorted((kind, ref) for kind, ref, _, __ in hits),
+                          [('build', 1), ('problem', 1)])
+
+        hits = self.index.search('"internal compiler"')
+        self.assertEquals(len(hits), 1)
+        kind, ref, offset, snippet = hits[0]
+        self.assertEquals((kind, ref, offset), ('build', 1, 0))
+        self.assertIn('\x02internal', snippet)
+
+    def test_search_limit(self):
+        for ref in range(5):
+            self.index.add('build', ref, 0, 'compiler error\n')
+        self.assertEquals(len(self.index.search('compiler', limit=2)), 2)
+
+        # The best chunks come from the same log
+        self.index.SEARCH_OVERFETCH = 1
+        for offset in range(100, 400, 100):
+            self.index.add('build', 9, offset,
+                           'compiler compiler compiler\n')
+        self.assertEquals([ref for _, ref, __, ___ in
+                           self.index.search('compiler', limit=2)], [9])
+
+    def test_remove(self):
+        self.index.add('problem', 1, 0, 'compiler exploded\n')
+        self.assertTrue(self.index.contains('problem', 1))
+        self.index.remove('problem', 1)
+        self.assertFalse(self.index.contains('problem', 1))
+        self.assertEquals(self.index.search('compiler'), [])
+
+    def test_indexer_only_indexes_whole_lines(self):
+        index = mock.Mock()
+        indexer = utils.LogIndexer(index, 'build', 1)
+        indexer.add(0, 'foo\nba')
+        indexer.add(6, 'r\nbaz')
+        indexer.close()
+        conn = index.connect.return_value
+        self.assertEquals(index.add.call_args_list,
+                          [mock.call('build', 1, 0, 'foo\n', conn=conn),
+                           mock.call('build', 1, 4, 'bar\n', conn=conn),
+                           mock.call('build', 1, 8, 'baz', conn=conn)])
+        self.assertEquals(index.connect.call_count, 1)
+        conn.close.assert_called_with()
+
+
+class CommandMultiplexerTests(TestCase):
+    def _fake_channel(self, chunks, status=0):
+        chan = mock.Mock()
+        chunks = list(chunks)
+        chan.recv_ready.side_effect = lambda: bool(chunks)
+        chan.recv.side_effect = lambda size: chunks.pop(0)
+        chan.exit_status_ready.return_value = True
+        chan.recv_exit_status.return_value = status
+        return chan
+
+    def test_streams_many_channels(self):
+        chan1 = self._fake_channel(['foo', 'bar'])
+        chan2 = self._fake_channel(['baz'], status=1)
+        output = {1: [], 2: []}
+        status = {}
+
+        multiplexer = CommandMultiplexer()
+        multiplexer.add(chan1, output[1].append,
+                        lambda s: status.__setitem__(1, s))
+        multiplexer.add(chan2, output[2].append,
+                        lambda s: status.__setitem__(2, s))
+
+        with mock.patch('select.select') as select:
+            select.side_effect = lambda r, w, x, timeout: (r, [], [])
+            multiplexer.run()
+
+        self.assertEquals(select.call_count, 1)
+        self.assertEquals(output, {1: ['foo', 'bar'], 2: ['baz']})
+        self.assertEquals(status, {1: 0, 2: 1})
+        self.assertFalse(multiplexer.busy)
+        chan1.close.assert_called_with()
+        chan2.close.assert_called_with()
+
+    def test_failing_callback_does_not_stop_others(self):
+        chan1 = self._fake_channel(['foo'])
+        chan2 = self._fake_channel(['bar'])
+        output = []
+
+        multiplexer = CommandMultiplexer()
+        multiplexer.add(chan1, mock.Mock(side_effect=Exception))
+        multiplexer.add(chan2, output.append)
+
+        with mock.patch('select.select') as select:
+            select.side_effect = lambda r, w, x, timeout: (r, [], [])
+            multiplexer.run()
+
+        self.assertEquals(output, ['bar'])
+        self.assertFalse(multiplexer.busy)
+
+    def test_idle_channels_get_idle_callback(self):
+        chan1 = self._fake_channel(['foo'])
+        chan1.exit_status_ready.return_value = False
+        chan2 = self._fake_channel([])
+        chan2.exit_status_ready.return_value = False
+        idle = {1: mock.Mock(), 2: mock.Mock()}
+
+        multiplexer = CommandMultiplexer()
+        multiplexer.add(chan1, idle_callback=idle[1])
+        multiplexer.add(chan2, idle_callback=idle[2])
+
+        with mock.patch('select.select') as select:
+            select.return_value = ([chan1], [], [])
+            multiplexer.run_once()
+            self.assertFalse(idle[1].called)
+            self.assertEquals(idle[2].call_count, 1)
+
+            select.return_value = ([], [], [])
+            multiplexer.run_once()
+            self.assertEquals(idle[1].call_count, 1)
+            self.assertEquals(idle[2].call_count, 2)
+
+    def test_spawned_work_keeps_it_busy(self):
+        multiplexer = CommandMultiplexer()
+        go = threading.Event()
+        done = []
+        thread = multiplexer.spawn(lambda x: go.wait(5) and done.append(x),
+                                   'foo')
+        self.assertTrue(multiplexer.busy)
+        go.set()
+        thread.join(5)
+        self.assertEquals(done, ['foo'])
+        self.assertFalse(multiplexer.busy)
+
+
 class BuildSchedulerTests(TestCase):
     fixtures = ["test_series.yaml", "test_cloud.yaml"]
 
@@ -174,6 +522,762 @@ class BuildSchedulerTests(TestCase):
         br = BuildRecord.pick_build(bn)
         self.assertEquals(br, br2)
 
+    def test_sweep_superseded(self):
+        series = Series.objects.get(pk=1)
+        SourcePackageVersion.record(series, 'proposed', 'foo', '1.1')
+        SourcePackageVersion.record(series, 'stable', 'foo', '1.0')
+
+        def build(version, **kwargs):
+            br = BuildRecord(series_id=1, architecture_id='i386',
+                             source_package_name='foo', version=version,
+                             **kwargs)
+            br.save()
+            return br
+
+        current = build('1.1')
+        stable = build('1.0')
+        old = build('0.9')
+        old_depwait = build('0.8', state=BuildRecord.DEPENDENCY_WAIT)
+        old_failed = build('0.7', state=BuildRecord.FAILED_TO_BUILD)
+
+        with self.assertNumQueries(3):
+            self.assertEquals(BuildRecord.sweep_superseded(), 2)
+
+        def state(br):
+            return BuildRecord.objects.get(pk=br.pk).state
+        self.assertEquals(state(current), BuildRecord.NEEDS_BUILDING)
+        self.assertEquals(state(stable), BuildRecord.NEEDS_BUILDING)
+        self.assertEquals(state(old), BuildRecord.BUILD_FOR_SUPERSEDED_SOURCE)
+        self.assertEquals(state(old_depwait),
+                          BuildRecord.BUILD_FOR_SUPERSEDED_SOURCE)
+        self.assertEquals(state(old_failed), BuildRecord.FAILED_TO_BUILD)
+
+    def test_sweep_leaves_unlisted_series_alone(self):
+        br = BuildRecord(series_id=1, architecture_id='i386',
+                         source_package_name='foo', version='1.0')
+        br.save()
+        self.assertEquals(BuildRecord.sweep_superseded(), 0)
+        self.assertFalse(br.superseded())
+
+        br.update_state(BuildRecord.FAILED_TO_BUILD)
+        self.assertTrue(br.allow_rebuild())
+
+    def test_available_clouds_honours_cloud_cap(self):
+        cloud = Cloud.objects.get(name='test_cloud')
+        cloud.max_build_nodes = 1
+        cloud.save()
+        scheduler = BuildScheduler(max_concurrent_builds=10)
+        self.assertEquals(scheduler.available_clouds(), [cloud])
+
+        BuildNode(name='buildd-1', cloud=cloud).save()
+        self.assertEquals(scheduler.available_clouds(), [])
+
+    def test_available_clouds_honours_global_cap(self):
+        cloud = Cloud.objects.get(name='test_cloud')
+        scheduler = BuildScheduler(max_concurrent_builds=1)
+        self.assertEquals(scheduler.available_clouds(), [cloud])
+
+        BuildNode(name='buildd-1', cloud=cloud).save()
+        self.assertEquals(scheduler.available_clouds(), [])
+
+    def _create_tarball(self, arch='i386'):
+        tarball = ChrootTarball(series_id='precise', architecture_id=arch,
+                                state=ChrootTarball.READY)
+        tarball.save()
+        return tarball
+
+    def test_scheduler_drains_queue(self):
+        tarball = self._create_tarball()
+        for i in range(3):
+            BuildRecord(series_id=1, architecture_id='i386',
+                        source_package_name='foo%d' % i,
+                        version='1.2-2ubuntu2').save()
+
+        started = []
+
+        class FakeWorker(object):
+            def __init__(self, cloud, tarball, build_node=None,
+                         multiplexer=None):
+                self.cloud = cloud
+                self.tarball = tarball
+                self.build_node = build_node
+                self.build_record = None
+
+            def start(self):
+                started.append(self)
+                br = BuildRecord.pending_builds_for_tarball(self.tarball)[0]
+                br.update_state(BuildRecord.BUILDING)
+
+            def is_alive(self):
+                return False
+
+        launched = []
+
+        class FakeLauncher(object):
+            def __init__(self, scheduler, cloud, tarball, count):
+                self.scheduler = scheduler
+                self.cloud = cloud
+                self.tarball = tarball
+                self.count = count
+                self.booting = 0
+
+            def start(self):
+                launched.append(self)
+                for i in range(self.count):
+                    self.scheduler.start_worker(self.cloud, self.tarball)
+
+            def is_alive(self):
+                return False
+
+        with mock.patch('repomgmt.models.BuildWorker', FakeWorker):
+            with mock.patch('repomgmt.models.BuildNodeLauncher',
+                            FakeLauncher):
+                BuildScheduler(max_concurrent_builds=10,
+                               poll_interval=0).run()
+
+        self.assertEquals([l.count for l in launched], [3])
+        self.assertEquals(len(started), 3)
+        self.assertTrue(all(w.tarball == tarball for w in started))
+        self.assertEquals(BuildRecord.pending_build_count(), 0)
+
+    def test_only_one_scheduler_runs_at_a_time(self):
+        BuildRecord(series_id=1, architecture_id='i386',
+                    source_package_name='foo1', version='1.0').save()
+        self.assertTrue(BuildSchedulerLock.acquire('someone-else'))
+
+        scheduler = BuildScheduler(poll_interval=0)
+        with mock.patch.object(scheduler, 'dispatch_to_idle_node') as d:
+            self.assertFalse(scheduler.run())
+            self.assertFalse(d.called)
+        self.assertEquals(BuildSchedulerLock.objects.get().holder,
+                          'someone-else')
+
+        # Until the other one is deemed dead
+        BuildSchedulerLock.objects.update(
+            heartbeat=timezone.now() - datetime.timedelta(hours=1))
+        with mock.patch.object(scheduler, 'dispatch_to_idle_node') as d:
+            d.return_value = False
+            with mock.patch.object(scheduler, 'dispatch_to_new_node',
+                                   return_value=False):
+                self.assertTrue(scheduler.run())
+            self.assertTrue(d.called)
+        self.assertFalse(BuildSchedulerLock.objects.exists())
+
+    def _start_build(self):
+        bn = BuildNode(name='buildd-1', cloud_id='test_cloud',
+                       state=BuildNode.BUILDING)
+        bn.save()
+        br = BuildRecord(series_id=1, architecture_id='i386',
+                         source_package_name='foo1', version='1.0',
+                         build_node=bn)
+        br.save()
+        return bn, br
+
+    def test_empty_build_log_has_no_summary(self):
+        self.assertEquals(BuildRecord.parse_summary_text(''), {})
+        self.assertEquals(BuildRecord.parse_summary_text('E: foo\n'), {})
+
+    def test_build_failing_before_sbuild_is_retried(self):
+        bn, br = self._start_build()
+        logdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, logdir)
+        with self.settings(BUILD_LOG_DIR=logdir), \
+                mock.patch.object(BuildNode, '_run_cmd') as run_cmd, \
+                mock.patch.object(BuildNode, 'delete') as delete:
+            run_cmd.side_effect = IOError('Connection refused')
+            bn.build(br)
+            delete.assert_called_with()
+        br = BuildRecord.objects.get(pk=br.pk)
+        self.assertEquals(br.state, BuildRecord.NEEDS_BUILDING)
+        self.assertIsNone(br.build_node_id)
+        self.assertEquals(BuildRecord.pending_build_count(), 1)
+
+    def test_build_that_cannot_be_finished_is_requeued(self):
+        bn, br = self._start_build()
+        with mock.patch.object(BuildNode, '_run_cmd') as run_cmd, \
+                mock.patch.object(BuildNode, 'finish_build') as finish, \
+                mock.patch.object(BuildNode, 'delete'):
+            run_cmd.side_effect = IOError('Connection refused')
+            finish.side_effect = IOError('Connection refused')
+            bn.build(br)
+        br = BuildRecord.objects.get(pk=br.pk)
+        self.assertEquals(br.state, BuildRecord.NEEDS_BUILDING)
+        self.assertIsNone(br.build_node_id)
+
+    def test_build_exit_callbacks_do_not_block_the_multiplexer(self):
+        bn, br = self._start_build()
+        multiplexer = mock.Mock()
+        logdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, logdir)
+        with self.settings(BUILD_LOG_DIR=logdir), \
+                mock.patch.object(BuildNode, '_run_cmd'), \
+                mock.patch.object(BuildNode, 'start_cmd') as start_cmd, \
+                mock.patch.object(BuildNode, 'finish_build') as finish:
+            bn.build(br, multiplexer)
+            exit_callback = start_cmd.call_args[1]['exit_callback']
+            exit_callback(1)
+            self.assertFalse(finish.called)
+            upload, status = multiplexer.spawn.call_args[0]
+            upload(status)
+            finish.assert_called_with(br)
+
+    def test_pick_build_matches_node_tarball(self):
+        tarball = self._create_tarball('amd64')
+        BuildRecord(series_id=1, architecture_id='i386', priority=200,
+                    source_package_name='foo1', version='1.0').save()
+        br = BuildRecord(series_id=1, architecture_id='amd64', priority=100,
+                         source_package_name='foo2', version='1.0')
+        br.save()
+
+        bn = BuildNode(name='buildd-1', cloud_id='test_cloud',
+                       tarball=tarball)
+        bn.save()
+        self.assertEquals(BuildRecord.pick_build(bn), br)
+        self.assertIsNone(BuildRecord.pick_build(bn))
+
+    def test_pick_build_breaks_priority_ties_by_age(self):
+        br1 = BuildRecord(series_id=1, architecture_id='i386',
+                          source_package_name='foo1', version='1.0')
+        br1.save()
+        br2 = BuildRecord(series_id=1, architecture_id='i386',
+                          source_package_name='foo2', version='1.0')
+        br2.save()
+
+        bn = BuildNode(name='buildd-1', cloud_id='test_cloud')
+        bn.save()
+        self.assertEquals(BuildRecord.pick_build(bn, skip_locked=False), br1)
+        self.assertEquals(BuildRecord.pick_build(bn, skip_locked=False), br2)
+
+    def test_pick_build_claims_in_one_statement_with_skip_locked(self):
+        bn = BuildNode(name='buildd-1', cloud_id='test_cloud')
+        bn.save()
+        with mock.patch('repomgmt.models.connection') as conn:
+            conn.ops.quote_name.side_effect = lambda name: '"%s"' % (name,)
+            cursor = conn.cursor.return_value
+            cursor.fetchone.return_value = None
+            self.assertIsNone(BuildRecord.pick_build(bn, skip_locked=True))
+
+        self.assertEquals(cursor.execute.call_count, 1)
+        sql, params = cursor.execute.call_args[0]
+        self.assertTrue(sql.startswith('UPDATE "repomgmt_buildrecord" '))
+        self.assertIn('FOR UPDATE OF "repomgmt_buildrecord" SKIP LOCKED',
+                      sql)
+        self.assertEquals(params[0], bn.pk)
+
+    def test_pick_build_returns_the_build_skip_locked_claimed(self):
+        br = BuildRecord(series_id=1, architecture_id='i386',
+                         source_package_name='foo1', version='1.0')
+        br.save()
+        bn = BuildNode(name='buildd-1', cloud_id='test_cloud')
+        bn.save()
+        with mock.patch('repomgmt.models.connection') as conn:
+            conn.ops.quote_name.side_effect = lambda name: '"%s"' % (name,)
+            conn.cursor.return_value.fetchone.return_value = (br.pk,)
+            self.assertEquals(BuildRecord.pick_build(bn, skip_locked=True),
+                              br)
+
+    def test_idle_node_is_reused(self):
+        tarball = self._create_tarball()
+        BuildRecord(series_id=1, architecture_id='i386',
+                    source_package_name='foo1', version='1.0').save()
+        bn = BuildNode(name='buildd-1', cloud_id='test_cloud',
+                       tarball=tarball, state=BuildNode.READY)
+        bn.save()
+
+        scheduler = BuildScheduler()
+        with mock.patch.object(scheduler, 'start_worker') as start_worker:
+            self.assertTrue(scheduler.dispatch_to_idle_node())
+            start_worker.assert_called_with(bn.cloud, tarball, bn)
+        self.assertEquals(BuildNode.objects.get(pk='buildd-1').state,
+                          BuildNode.BUILDING)
+
+    def test_release_returns_node_to_pool(self):
+        tarball = self._create_tarball()
+        bn = BuildNode(name='buildd-1', cloud_id='test_cloud',
+                       tarball=tarball, state=BuildNode.BUILDING)
+        bn.save()
+        with mock.patch.object(BuildNode, '_run_cmd'):
+            with self.settings(BUILD_NODE_POOL_MAX_SIZE=1):
+                bn.release()
+        self.assertEquals(list(BuildNode.idle_nodes(tarball)), [bn])
+
+    def test_release_deletes_node_when_pool_is_full(self):
+        tarball = self._create_tarball()
+        bn = BuildNode(name='buildd-1', cloud_id='test_cloud',
+                       tarball=tarball, state=BuildNode.BUILDING)
+        bn.save()
+        with mock.patch.object(BuildNode, '_run_cmd'):
+            with mock.patch.object(BuildNode, 'delete') as delete:
+                with self.settings(BUILD_NODE_POOL_MAX_SIZE=0):
+                    bn.release()
+                delete.assert_called_with()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Needs PostgreSQL')
+class SkipLockedClaimTests(TransactionTestCase):
+    """Claims builds from two connections at once
+
+    Run the tests with a PostgreSQL (9.5 or later) database to run
+    these."""
+    fixtures = ["test_series.yaml", "test_cloud.yaml"]
+
+    def setUp(self):
+        if not BuildRecord.supports_skip_locked():
+            self.skipTest('Needs PostgreSQL 9.5 or later')
+
+    def other_connection(self):
+        import psycopg2
+
+        settings_dict = connection.settings_dict
+        params = [('database', settings_dict['NAME']),
+                  ('user', settings_dict['USER']),
+                  ('password', settings_dict['PASSWORD']),
+                  ('host', settings_dict['HOST']),
+                  ('port', settings_dict['PORT'])]
+        conn = psycopg2.connect(**dict((k, v) for k, v in params if v))
+        self.addCleanup(conn.close)
+        return conn
+
+    def test_locked_builds_are_skipped(self):
+        first = BuildRecord(series_id=1, architecture_id='i386',
+                            priority=200, source_package_name='foo1',
+                            version='1.0')
+        first.save()
+        second = BuildRecord(series_id=1, architecture_id='i386',
+                             priority=100, source_package_name='foo2',
+                             version='1.0')
+        second.save()
+        bn1 = BuildNode(name='buildd-1', cloud_id='test_cloud')
+        bn1.save()
+        bn2 = BuildNode(name='buildd-2', cloud_id='test_cloud')
+        bn2.save()
+
+        # Another scheduler is in the middle of claiming the first build
+        other = self.other_connection()
+        other.cursor().execute('SELECT id FROM repomgmt_buildrecord '
+                               'WHERE id = %s FOR UPDATE', [first.pk])
+
+        self.assertEquals(BuildRecord.pick_build(bn1), second)
+        other.rollback()
+        self.assertEquals(BuildRecord.pick_build(bn2), first)
+        self.assertIsNone(BuildRecord.pick_build(bn2))
+        self.assertEquals(
+            dict(BuildRecord.objects.values_list('id', 'build_node')),
+            {first.pk: bn2.pk, second.pk: bn1.pk})
+
+
+class BuildSummaryTests(TestCase):
+    fixtures = ["test_series.yaml"]
+
+    build_log = textwrap.dedent("""\
+        Finished at 20130101-1200
+        Build needed 00:01:23, 4567k disc space
+        E: Package build dependencies not satisfied; skipping
+
+        +------------------------------------------------------------------+
+        | Summary                                                          |
+        +------------------------------------------------------------------+
+
+        Build Architecture: i386
+        Build-Space: n/a
+        Build-Time: 83
+        Distribution: precise
+        Fail-Stage: install-deps
+        Install-Time: 12
+        Job: foo_1.0
+        Package: foo
+        Status: failed
+        Version: 1.0
+        """)
+
+    def _create(self):
+        br = BuildRecord(series_id=1, architecture_id='i386',
+                         source_package_name='foo', version='1.0')
+        br.save()
+        return br
+
+    def test_summary_stored_with_state(self):
+        br = self._create()
+        logdir = tempfile.mkdtemp()
+        try:
+            with override_settings(BUILD_LOG_DIR=logdir):
+                with open(br.logfile(), 'w') as fp:
+                    fp.write(self.build_log)
+                br.update_state_from_build_log()
+        finally:
+            shutil.rmtree(logdir)
+
+        br = BuildRecord.objects.get(pk=br.pk)
+        self.assertEquals(br.state, BuildRecord.DEPENDENCY_WAIT)
+        self.assertEquals(br.sbuild_status, 'failed')
+        self.assertEquals(br.fail_stage, 'install-deps')
+        self.assertEquals(br.build_time, 83)
+        self.assertEquals(br.install_time, 12)
+        self.assertIsNone(br.build_space)
+        self.assertIsNone(br.package_time)
+
+    def test_build_log_view(self):
+        br = self._create()
+        logdir = tempfile.mkdtemp()
+        try:
+            with override_settings(BUILD_LOG_DIR=logdir):
+                log = br.log_writer()
+                log.write(self.build_log)
+                log.close()
+
+                c = client.Client()
+                url = '/builds/%d/log/' % (br.pk,)
+                response = c.get(url)
+                self.assertEquals(response.status_code, 200)
+                self.assertEquals(''.join(response.streaming_content),
+                                  self.build_log)
+
+                response = c.get(url, HTTP_RANGE='bytes=10-19')
+                self.assertEquals(response.status_code, 206)
+                self.assertEquals(''.join(response.streaming_content),
+                                  self.build_log[10:20])
+                self.assertEquals(response['Content-Range'],
+                                  'bytes 10-19/%d' % (len(self.build_log),))
+
+                response = c.get(url, HTTP_RANGE='bytes=100000-')
+                self.assertEquals(response.status_code, 416)
+
+                response = c.get(url, {'tail': '1'})
+                self.assertEquals(response.content, 'Version: 1.0\n')
+
+                self.assertEquals(br.parse_summary()['Fail-Stage'],
+                                  'install-deps')
+        finally:
+            shutil.rmtree(logdir)
+
+    def test_follow_build_log(self):
+        br = self._create()
+        br.update_state(BuildRecord.BUILDING)
+        logdir = tempfile.mkdtemp()
+        try:
+            with override_settings(BUILD_LOG_DIR=logdir,
+                                   BUILD_LOG_POLL_INTERVAL=3):
+                url = '/builds/%d/log/' % (br.pk,)
+                c = client.Client()
+
+                response = c.get(url, {'since': '0'})
+                self.assertEquals(response.content, '')
+                self.assertEquals(response['X-Log-Offset'], '0')
+                self.assertEquals(response['X-Build-Finished'], 'false')
+                self.assertEquals(response['Retry-After'], '3')
+
+                log = br.log_writer()
+                log.write('foo\n')
+                log.flush()
+
+                response = c.get(url, {'since': '0'})
+                self.assertEquals(response.content, 'foo\n')
+                self.assertEquals(response['X-Log-Offset'], '4')
+
+                log.write('bar\n')
+                log.close()
+                br.update_state(BuildRecord.FAILED_TO_BUILD)
+
+                response = c.get(url, {'since': '4'})
+                self.assertEquals(response.content, 'bar\n')
+                self.assertEquals(response['X-Log-Offset'], '8')
+                self.assertEquals(response['X-Build-Finished'], 'true')
+
+                with override_settings(BUILD_LOG_FOLLOW_MAX_BYTES=3):
+                    response = c.get(url, {'since': '2'})
+                    self.assertEquals(response.content, 'o\nb')
+                    self.assertEquals(response['X-Log-Offset'], '5')
+                    self.assertEquals(response['X-Build-Finished'], 'false')
+                    self.assertEquals(response['Retry-After'], '0')
+        finally:
+            shutil.rmtree(logdir)
+
+    def test_log_search(self):
+        br = self._create()
+        logdir = tempfile.mkdtemp()
+        try:
+            with override_settings(BUILD_LOG_DIR=logdir):
+                log = br.log_writer()
+                log.write(self.build_log)
+                log.close()
+
+                c = client.Client()
+                response = c.get('/search/', {'q': 'dependencies',
+                                              'format': 'json'})
+                results = json.loads(response.content)['results']
+                self.assertEquals(len(results), 1)
+                self.assertEquals(results[0]['url'],
+                                  '/builds/%d/' % (br.pk,))
+                self.assertIn('<b>dependencies</b>', results[0]['snippet'])
+
+                response = c.get('/search/', {'q': '"unbalanced'})
+                self.assertEquals(response.status_code, 200)
+                self.assertTrue(response.context['error'])
+        finally:
+            shutil.rmtree(logdir)
+
+    def test_build_list_filters_by_fail_stage(self):
+        br = self._create()
+        br.store_summary({'Status': 'failed', 'Fail-Stage': 'install-deps'})
+        BuildRecord(series_id=1, architecture_id='i386',
+                    source_package_name='bar', version='1.0').save()
+
+        c = client.Client()
+        response = c.get('/builds/', {'fail_stage': 'install-deps',
+                                      'order': 'build_time'})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(list(response.context['build_records']), [br])
+
+
+class FailureSignatureTests(TestCase):
+    fixtures = ["test_series.yaml"]
+
+    build_log = textwrap.dedent("""\
+        /tmp/buildd/%(pkg)s-%(version)s/src/main.c:%(line)d:5: error: 'x' undeclared
+        make[1]: *** [main.o] Error 1
+        dpkg-buildpackage: error: debian/rules build gave error exit status 2
+        Finished at 2013010%(day)d-1200
+
+        +------------------------------------------------------------------+
+        | Summary                                                          |
+        +------------------------------------------------------------------+
+
+        Build Architecture: i386
+        Fail-Stage: build
+        Package: %(pkg)s
+        Status: attempted
+        Version: %(version)s
+        """)
+
+    def _failed_build(self, pkg, version, line, day):
+        br = BuildRecord(series_id=1, architecture_id='i386',
+                         source_package_name=pkg, version=version)
+        br.save()
+        with open(br.logfile(), 'w') as fp:
+            fp.write(self.build_log % {'pkg': pkg, 'version': version,
+                                       'line': line, 'day': day})
+        br.update_state_from_build_log()
+        return BuildRecord.objects.get(pk=br.pk)
+
+    def test_excerpt_stops_at_summary(self):
+        excerpt = utils.failure_excerpt(self.build_log % {'pkg': 'foo',
+                                                          'version': '1.0',
+                                                          'line': 1,
+                                                          'day': 1})
+        self.assertTrue(excerpt.startswith('/tmp/buildd/foo-1.0/'))
+        self.assertTrue(excerpt.endswith('Finished at 20130101-1200'))
+
+    def test_signature_ignores_versions_paths_and_times(self):
+        a = utils.failure_signature(
+                '/build/foo-1.0/a.c:12: error: bad\n'
+                'Finished at 20130101-1200')
+        b = utils.failure_signature(
+                '/tmp/bar-2.3.4~git1/b.c:345: error: bad\n'
+                'Finished at 20130512-0930')
+        c = utils.failure_signature('/build/foo-1.0/a.c:12: error: worse')
+        self.assertEquals(a, b)
+        self.assertNotEquals(a[1], c[1])
+
+    def test_failed_builds_share_signature(self):
+        logdir = tempfile.mkdtemp()
+        try:
+            with override_settings(BUILD_LOG_DIR=logdir):
+                br1 = self._failed_build('foo', '1.0', 10, 1)
+                br2 = self._failed_build('bar', '2.0-1', 20, 2)
+        finally:
+            shutil.rmtree(logdir)
+
+        self.assertEquals(br1.state, BuildRecord.FAILED_TO_BUILD)
+        self.assertIsNotNone(br1.failure_signature)
+        self.assertEquals(br1.failure_signature, br2.failure_signature)
+        sig = FailureSignature.objects.get()
+        self.assertEquals(sig.count, 2)
+        self.assertIn("<path>:N:N: error: 'x' undeclared", sig.sample)
+
+        c = client.Client()
+        response = c.get('/failures/')
+        self.assertEquals(list(response.context['signatures']), [sig])
+        response = c.get('/failures/%d/' % (sig.pk,))
+        self.assertEquals(set(response.context['build_records']),
+                          set([br1, br2]))
+
+    def test_record_keeps_first_and_last_seen(self):
+        now = timezone.now()
+        earlier = now - datetime.timedelta(days=1)
+        FailureSignature.record('error: bad', now)
+        sig = FailureSignature.record('error: bad', earlier)
+        sig = FailureSignature.objects.get(pk=sig.pk)
+        self.assertEquals(sig.count, 2)
+        self.assertEquals(sig.first_seen, earlier)
+        self.assertEquals(sig.last_seen, now)
+        self.assertIsNone(FailureSignature.record('\n\n'))
+
+
+class LogRetentionTests(TestCase):
+    fixtures = ["test_series.yaml"]
+
+    def setUp(self):
+        self.logdir = tempfile.mkdtemp()
+        self.settings = override_settings(BUILD_LOG_DIR=self.logdir,
+                                          SRC_PKG_BUILD_FAILURE_LOG_DIR=
+                                              self.logdir)
+        self.settings.enable()
+        self.now = timezone.now()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.logdir)
+
+    def _build(self, version, days_ago, arch='i386', size=1000):
+        br = BuildRecord(series_id=1, architecture_id=arch,
+                         source_package_name='foo', version=version,
+                         finished=self.now - datetime.timedelta(days=days_ago))
+        br.save()
+        with open(br.logfile(), 'w') as fp:
+            fp.write('x' * size)
+        br.store_log_bytes()
+        return br
+
+    def _expired(self):
+        repo = Repository.objects.get(name='cisco')
+        return [br.version for br in repo.expired_build_logs(self.now)]
+
+    def test_no_limits(self):
+        self._build('1.0', 100)
+        self._build('2.0', 0)
+        self.assertEquals(self._expired(), [])
+
+    def test_max_age_keeps_latest(self):
+        self._build('1.0', 10)
+        self._build('1.1', 5)
+        self._build('1.0', 10, arch='amd64')
+        Repository.objects.filter(name='cisco').update(build_log_max_age=7)
+        self.assertEquals(self._expired(), ['1.0'])
+
+    def test_budget(self):
+        self._build('1.0', 3)
+        self._build('1.1', 2)
+        self._build('1.2', 1)
+        with override_settings(BUILD_LOG_BUDGET=2500):
+            self.assertEquals(self._expired(), ['1.0'])
+
+    def test_budget_scan_is_bounded(self):
+        for i in range(10):
+            self._build('1.%d' % (i,), 20 - i)
+        repo = Repository.objects.get(name='cisco')
+        with override_settings(BUILD_LOG_BUDGET=2500):
+            with mock.patch('os.path.getsize') as getsize:
+                expired = repo.expired_build_logs(self.now, batch_size=3)
+                with self.assertNumQueries(3):
+                    self.assertEquals([expired.next().version
+                                       for i in range(2)], ['1.0', '1.1'])
+                self.assertFalse(getsize.called)
+            self.assertEquals([br.version for br in expired],
+                              ['1.2', '1.3', '1.4', '1.5', '1.6', '1.7'])
+
+    def test_log_size_is_recorded_when_the_log_is_closed(self):
+        br = self._build('1.0', 1)
+        BuildRecord.objects.filter(pk=br.pk).update(log_bytes=None)
+        os.unlink(br.logfile())
+        br = BuildRecord.objects.get(pk=br.pk)
+        log = br.log_writer()
+        log.write('foo\n' * 1000)
+        log.close()
+        self.assertEquals(BuildRecord.objects.get(pk=br.pk).log_bytes,
+                          br.log_disk_usage())
+        self.assertTrue(0 < br.log_bytes < 4000)
+
+        BuildRecord.objects.filter(pk=br.pk).update(log_bytes=None)
+        call_command('repo-backfill-log-sizes', stdout=StringIO())
+        self.assertEquals(BuildRecord.objects.get(pk=br.pk).log_bytes,
+                          br.log_bytes)
+
+    def test_expire(self):
+        old = self._build('1.0', 10)
+        self._build('1.1', 0)
+        with override_settings(BUILD_LOG_MAX_AGE=7):
+            tasks.expire_logs()
+
+        old = BuildRecord.objects.get(pk=old.pk)
+        self.assertTrue(old.log_expired)
+        self.assertFalse(os.path.exists(old.logfile()))
+
+        c = client.Client()
+        response = c.get('/builds/%d/log/' % (old.pk,))
+        self.assertEquals(response.status_code, 410)
+        response = c.get('/builds/%d/' % (old.pk,))
+        self.assertContains(response, 'Expired')
+
+    def test_expire_problem_logs(self):
+        problems = []
+        for i in range(3):
+            problem = PackageSourceBuildProblem(name='foo')
+            problem.save()
+            problem.save_log('oops')
+            problems.append(problem)
+        PackageSourceBuildProblem.objects.filter(
+            pk__in=[p.pk for p in problems[:2]]).update(
+                timestamp=self.now - datetime.timedelta(days=31))
+
+        self.assertEquals(PackageSourceBuildProblem.expire_logs(limit=1), 1)
+        self.assertEquals(PackageSourceBuildProblem.expire_logs(), 1)
+        self.assertEquals(
+            [p.log_expired for p in PackageSourceBuildProblem.objects.order_by('id')],
+            [True, True, False])
+        self.assertTrue(os.path.exists(problems[2].log_file()))
+
+
+class BuildNodeImageTests(TestCase):
+    fixtures = ['test_series.yaml', 'test_cloud.yaml']
+
+    def setUp(self):
+        self.cloud = Cloud.objects.get(name='test_cloud')
+        self.tarball = ChrootTarball(series_id='precise',
+                                     architecture_id='i386',
+                                     state=ChrootTarball.READY,
+                                     last_refresh=timezone.now())
+        self.tarball.save()
+        super(BuildNodeImageTests, self).setUp()
+
+    def _create(self, age):
+        image = BuildNodeImage(cloud=self.cloud, tarball=self.tarball,
+                               image_id='image-1',
+                               created=self.tarball.last_refresh + age)
+        image.save()
+        return image
+
+    def test_usable_image(self):
+        image = self._create(datetime.timedelta(minutes=5))
+        self.assertEquals(BuildNodeImage.usable_image(self.cloud,
+                                                      self.tarball), image)
+
+    def test_image_older_than_tarball_is_stale(self):
+        image = self._create(-datetime.timedelta(minutes=5))
+        self.assertTrue(image.is_stale())
+        self.assertIsNone(BuildNodeImage.usable_image(self.cloud,
+                                                      self.tarball))
+
+    def test_prepare_skips_install_on_baked_node(self):
+        image = self._create(datetime.timedelta(minutes=5))
+        bn = BuildNode(name='buildd-1', cloud=self.cloud, image=image)
+        bn.save()
+        with mock.patch.multiple(BuildNode, wait_until_reachable=mock.DEFAULT,
+                                 install=mock.DEFAULT,
+                                 generate_signing_key=mock.DEFAULT) as mocks:
+            bn.prepare(self.tarball)
+            self.assertFalse(mocks['install'].called)
+            self.assertTrue(mocks['generate_signing_key'].called)
+        self.assertEquals(bn.state, BuildNode.READY)
+
+    def test_prepare_installs_on_plain_node(self):
+        bn = BuildNode(name='buildd-1', cloud=self.cloud)
+        bn.save()
+        with mock.patch.multiple(BuildNode, wait_until_reachable=mock.DEFAULT,
+                                 install=mock.DEFAULT,
+                                 generate_signing_key=mock.DEFAULT) as mocks:
+            bn.prepare(self.tarball)
+            mocks['install'].assert_called_with(self.tarball)
+
 
 class SeriesTests(TestCase):
     fixtures = ['test_series.yaml']
@@ -185,11 +1289,15 @@ class SeriesTests(TestCase):
         folsom-proposed|main|source: cinder 2012.2.1~+cisco-folsom1260-53'''
 
     @override_settings(BASE_REPO_DIR='/base/repo/dir')
-    def test_get_packages(self):
+    def test_reconcile_source_packages(self):
+        series = Series.objects.get(name='folsom')
+        SourcePackageVersion.record(series, 'stable', 'nova', '2012.2')
+        SourcePackageVersion.record(series, 'proposed', 'cinder', '2012.1')
         with mock.patch('repomgmt.utils.run_cmd') as run_cmd:
-            series = Series.objects.get(name='folsom')
-            run_cmd.return_value = textwrap.dedent(self.reprepro_list)
-            pkg_list = list(series.get_source_packages())
+            run_cmd.side_effect = lambda cmd: (cmd[-1] == 'folsom-proposed'
+                                  and textwrap.dedent(self.reprepro_list)
+                                  or '')
+            self.assertEquals(series.reconcile_source_packages(), 2)
             calls = []
             calls += [mock.call(['reprepro', '-b',
                                  '/base/repo/dir/cisco', '-A', 'source',
@@ -201,7 +1309,644 @@ class SeriesTests(TestCase):
                                  '/base/repo/dir/cisco', '-A', 'source',
                                  'list', 'folsom'])]
             run_cmd.assert_has_calls(calls, any_order=True)
-            self.assertEquals(len(pkg_list), 3)
+
+        with self.assertNumQueries(1):
+            pkgs = series.get_source_packages()
+        self.assertEquals(pkgs, {'stable': {},
+                                 'proposed': {'cinder':
+                                     '2012.2.1~+cisco-folsom1260-53'},
+                                 'queued': {}})
+
+    sources_index = textwrap.dedent("""\
+        Package: cinder
+        Binary: cinder-api, cinder-common
+        Version: 2012.2.1~+cisco-folsom1260-53
+        Files:
+         0123456789abcdef0123456789abcdef 1234 cinder_2012.2.1.dsc
+        Checksums-Sha256:
+         0123456789abcdef 1234 Version: bogus
+
+        Package: nova
+        Version: 2012.2.3-0ubuntu1
+        """)
+
+    def test_read_exported_sources_index(self):
+        series = Series.objects.get(name='folsom')
+        outdir = tempfile.mkdtemp()
+        try:
+            with override_settings(BASE_PUBLIC_REPO_DIR=outdir):
+                path = os.path.join(series.repository.reprepro_outdir, 'dists',
+                                    'folsom-proposed', 'main', 'source')
+                os.makedirs(path)
+                fp = gzip.open(os.path.join(path, 'Sources.gz'), 'wb')
+                fp.write(self.sources_index)
+                fp.close()
+
+                with mock.patch('repomgmt.utils.run_cmd') as run_cmd:
+                    run_cmd.return_value = ''
+                    pkgs = series.get_reprepro_source_packages()
+                    self.assertEquals(len(run_cmd.call_args_list), 2)
+                self.assertEquals(pkgs['proposed'],
+                                  {'cinder': '2012.2.1~+cisco-folsom1260-53',
+                                   'nova': '2012.2.3-0ubuntu1'})
+
+                # Cached until the index changes
+                with mock.patch('repomgmt.utils.parse_sources') as parse:
+                    series.get_reprepro_source_packages()
+                    self.assertFalse(parse.called)
+                with open(os.path.join(path, 'Sources'), 'w') as fp:
+                    fp.write('Package: nova\nVersion: 2013.1\n')
+                self.assertEquals(utils.read_sources_index(
+                                      series.sources_index('folsom-proposed')),
+                                  {'nova': '2013.1'})
+        finally:
+            shutil.rmtree(outdir)
+
+    def test_update_source_packages_hook(self):
+        mod = __import__('repomgmt.management.commands.repo-update-source-packages')
+        cmd = getattr(mod.management.commands,
+                      'repo-update-source-packages').Command()
+        series = Series.objects.get(name='folsom')
+
+        cmd.handle('add', 'folsom-proposed', 'dsc', 'main', 'source',
+                   'nova', '1.0', 'nova_1.0.dsc', repository='cisco')
+        cmd.handle('add', 'folsom', 'dsc', 'main', 'source',
+                   'nova', '1.0', 'nova_1.0.dsc', repository='cisco')
+        cmd.handle('replace', 'folsom-proposed', 'dsc', 'main', 'source',
+                   'nova', '1.1', '1.0', 'nova_1.1.dsc', '--',
+                   'nova_1.0.dsc', repository='cisco')
+        self.assertEquals(series.get_source_packages(),
+                          {'stable': {'nova': '1.0'},
+                           'proposed': {'nova': '1.1'},
+                           'queued': {}})
+
+        br = BuildRecord(series=series, architecture_id='i386',
+                         source_package_name='nova', version='1.0')
+        self.assertFalse(br.superseded())
+        cmd.handle('remove', 'folsom', 'dsc', 'main', 'source',
+                   'nova', '1.0', 'nova_1.0.dsc', repository='cisco')
+        self.assertTrue(br.superseded())
+
+
+class WriteConfigurationTests(TestCase):
+    fixtures = ['test_series.yaml']
+
+    def setUp(self):
+        self.repository = Repository.objects.get(name='cisco')
+        self.repository.clear_scheduled_write_configuration()
+
+    def test_only_changed_files_are_written(self):
+        with mock.patch.object(Repository, '_reprepro') as reprepro:
+            self.repository.write_configuration(force=True)
+            reprepro.assert_called_with('export')
+            reprepro.reset_mock()
+
+            self.assertEquals(self.repository.write_configuration(), [])
+            self.assertFalse(reprepro.called)
+
+            Series.objects.filter(pk=1).update(numerical_version='2012.2')
+            self.assertEquals(self.repository.write_configuration(),
+                              ['distributions'])
+            reprepro.assert_called_with('export')
+
+    def test_query_budget(self):
+        User.objects.bulk_create([User(username='uploader%d' % (i,))
+                                  for i in range(200)])
+        users = list(User.objects.filter(username__startswith='uploader'))
+        self.repository.uploaders.add(*users)
+        UploaderKey.objects.bulk_create([UploaderKey(key_id='%08X' % (i,),
+                                                     uploader=user)
+                                         for i, user in enumerate(users)])
+        Series.objects.bulk_create([Series(name='series%d' % (i,),
+                                           repository=self.repository,
+                                           base_ubuntu_series_id='precise',
+                                           numerical_version='%d.0' % (i,),
+                                           update_from_id=1)
+                                    for i in range(49)])
+
+        with mock.patch.object(Repository, 'queue_reprepro'):
+            with self.assertNumQueries(5):
+                self.repository.write_configuration(force=True)
+
+        uploaders = os.path.join(self.repository.reprepro_dir, 'conf',
+                                 'uploaders')
+        with open(uploaders, 'r') as fp:
+            self.assertEquals(fp.read().count('group uploaders add'), 201)
+
+    def test_writes_are_coalesced(self):
+        with mock.patch('repomgmt.tasks.write_configuration') as task:
+            self.repository.schedule_write_configuration()
+            self.repository.schedule_write_configuration()
+            self.assertEquals(task.apply_async.call_count, 1)
+
+            # Once the task has started, changes need another write
+            self.repository.clear_scheduled_write_configuration()
+            self.repository.schedule_write_configuration()
+            self.assertEquals(task.apply_async.call_count, 2)
+
+    def test_lost_writes_happen_anyway(self):
+        with mock.patch.object(Repository, 'write_configuration') as write:
+            with mock.patch('repomgmt.tasks.write_configuration') as task:
+                task.apply_async.side_effect = IOError('Broker is down')
+                self.repository.schedule_write_configuration()
+                self.assertEquals(write.call_count, 1)
+
+            with mock.patch('repomgmt.tasks.write_configuration') as task:
+                Repository.objects.filter(pk='cisco').update(
+                    config_write_scheduled=timezone.now())
+                self.repository.schedule_write_configuration()
+                self.assertEquals(write.call_count, 1)
+
+                # The task should have run long ago
+                Repository.objects.filter(pk='cisco').update(
+                    config_write_scheduled=timezone.now() -
+                                           datetime.timedelta(hours=1))
+                self.repository.schedule_write_configuration()
+                self.assertEquals(write.call_count, 2)
+                self.assertFalse(task.apply_async.called)
+        self.assertIsNone(Repository.objects.get(
+                              pk='cisco').config_write_scheduled)
+
+    def test_write_if_changed(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'foo.sh')
+            self.assertTrue(utils.write_if_changed(path, 'foo', 0755))
+            self.assertFalse(utils.write_if_changed(path, 'foo', 0755))
+            self.assertTrue(utils.write_if_changed(path, 'bar', 0755))
+            self.assertEquals(os.stat(path).st_mode & 0777, 0755)
+            self.assertEquals(os.listdir(tmpdir), ['foo.sh'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class RepreproQueueTests(TestCase):
+    fixtures = ['test_series.yaml']
+
+    def setUp(self):
+        self.repository = Repository.objects.get(name='cisco')
+
+    def test_duplicate_pending_operations_are_merged(self):
+        with mock.patch('repomgmt.tasks.run_reprepro_operations') as task:
+            op1 = self.repository.queue_reprepro('export')
+            op2 = self.repository.queue_reprepro('export')
+            op3 = self.repository.queue_reprepro('pull', 'folsom')
+            self.assertEquals(task.delay.call_count, 3)
+        self.assertEquals(op1.pk, op2.pk)
+        self.assertNotEquals(op1.pk, op3.pk)
+        self.assertEquals(
+            RepreproOperation.pending(self.repository).count(), 2)
+
+        RepreproOperation.objects.filter(pk=op1.pk).update(
+            state=RepreproOperation.DONE)
+        with mock.patch('repomgmt.tasks.run_reprepro_operations'):
+            op4 = self.repository.queue_reprepro('export')
+        self.assertNotEquals(op1.pk, op4.pk)
+
+    def test_operations_run_in_order(self):
+        with mock.patch('repomgmt.tasks.run_reprepro_operations'):
+            self.repository.queue_reprepro('pull', 'folsom')
+            self.repository.queue_reprepro('export')
+
+        with mock.patch.object(Repository, '_reprepro') as reprepro:
+            self.assertEquals(self.repository.run_reprepro_operations(), 2)
+            self.assertEquals(reprepro.call_args_list,
+                              [mock.call('pull', 'folsom'),
+                               mock.call('export')])
+
+        ops = RepreproOperation.objects.all()
+        self.assertEquals(set(op.state for op in ops),
+                          set([RepreproOperation.DONE]))
+        self.assertIsNone(Repository.objects.get(
+                              pk='cisco').reprepro_queue_claimed)
+
+    def test_claimed_queue_is_left_alone(self):
+        self.assertTrue(self.repository.claim_reprepro_queue())
+        self.assertFalse(self.repository.claim_reprepro_queue())
+
+        with mock.patch.object(Repository, '_reprepro') as reprepro:
+            op = self.repository.queue_reprepro('export')
+            self.assertFalse(reprepro.called)
+            self.assertIsNone(op.wait(timeout=0))
+
+            # Until the claim is deemed abandoned
+            Repository.objects.filter(pk='cisco').update(
+                reprepro_queue_claimed=timezone.now() -
+                                       datetime.timedelta(hours=2))
+            self.assertEquals(self.repository.run_reprepro_operations(), 1)
+            reprepro.assert_called_with('export')
+        self.assertTrue(op.wait())
+
+    def test_abandoned_operations_are_retried(self):
+        with mock.patch('repomgmt.tasks.run_reprepro_operations'):
+            op = self.repository.queue_reprepro('export')
+        # A worker claimed the queue, started the export and died
+        self.assertTrue(self.repository.claim_reprepro_queue())
+        self.assertEquals(RepreproOperation.next_pending(self.repository), op)
+        self.assertIsNone(op.wait(timeout=0))
+
+        two_hours_ago = timezone.now() - datetime.timedelta(hours=2)
+        Repository.objects.filter(pk='cisco').update(
+            reprepro_queue_claimed=two_hours_ago)
+        RepreproOperation.objects.filter(pk=op.pk).update(
+            started=two_hours_ago)
+        with mock.patch.object(Repository, '_reprepro') as reprepro:
+            tasks.process_incoming()
+            reprepro.assert_called_once_with('export')
+        self.assertTrue(op.wait(timeout=0))
+
+    def test_claim_is_renewed_between_operations(self):
+        with mock.patch('repomgmt.tasks.run_reprepro_operations'):
+            self.repository.queue_reprepro('pull', 'folsom')
+            self.repository.queue_reprepro('export')
+        claims = []
+
+        def reprepro(*args):
+            claims.append(Repository.objects.get(
+                              pk='cisco').reprepro_queue_claimed)
+
+        clock = [timezone.now()]
+
+        def now():
+            clock[0] += datetime.timedelta(minutes=1)
+            return clock[0]
+
+        with mock.patch.object(Repository, '_reprepro') as run:
+            run.side_effect = reprepro
+            with mock.patch('django.utils.timezone.now', now):
+                self.assertEquals(self.repository.run_reprepro_operations(),
+                                  2)
+        self.assertTrue(claims[0] < claims[1])
+
+    def test_lost_claim_stops_the_run(self):
+        with mock.patch('repomgmt.tasks.run_reprepro_operations'):
+            self.repository.queue_reprepro('pull', 'folsom')
+            self.repository.queue_reprepro('export')
+        taken_over = timezone.now() + datetime.timedelta(hours=1)
+
+        def reprepro(*args):
+            # Someone decided we were dead and took over
+            Repository.objects.filter(pk='cisco').update(
+                reprepro_queue_claimed=taken_over)
+
+        with mock.patch.object(Repository, '_reprepro') as run:
+            run.side_effect = reprepro
+            self.assertEquals(self.repository.run_reprepro_operations(), 1)
+            run.assert_called_once_with('pull', 'folsom')
+        self.assertEquals(Repository.objects.get(
+                              pk='cisco').reprepro_queue_claimed, taken_over)
+
+    def test_failures_are_recorded(self):
+        with mock.patch.object(Repository, '_reprepro') as reprepro:
+            reprepro.side_effect = CommandFailed('failed', ['reprepro'], 255,
+                                                 '', 'Could not get lock')
+            op = self.repository.queue_reprepro('export')
+        self.assertFalse(op.wait())
+        self.assertEquals(op.output, 'Could not get lock')
+
+    def test_promote_does_not_wait(self):
+        series = Series.objects.get(pk=1)
+        with mock.patch('repomgmt.tasks.run_reprepro_operations'):
+            with mock.patch.object(Repository, '_reprepro') as reprepro:
+                op = series.promote()
+                self.assertFalse(reprepro.called)
+        self.assertEquals(op.arg_list, ['pull', series.name])
+        self.assertEquals(op.state, RepreproOperation.PENDING)
+
+
+class ProcessIncomingTests(TestCase):
+    fixtures = ['test_series.yaml']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        Repository(name='other').save()
+
+    def test_only_repositories_with_uploads_are_processed(self):
+        os.mkdir(os.path.join(self.tmpdir, 'cisco'))
+        os.mkdir(os.path.join(self.tmpdir, 'other'))
+        open(os.path.join(self.tmpdir, 'cisco', 'nova_1.0.dsc'), 'w').close()
+        open(os.path.join(self.tmpdir, 'other', 'nova_1.0_source.changes'),
+             'w').close()
+
+        with override_settings(BASE_INCOMING_DIR=self.tmpdir):
+            with mock.patch('repomgmt.tasks.process_incoming_for_repository'
+                            ) as subtask:
+                tasks.process_incoming()
+        subtask.delay.assert_called_once_with('other')
+
+    def test_missing_incoming_dir(self):
+        self.assertFalse(utils.has_changes_files(
+                             os.path.join(self.tmpdir, 'missing')))
+
+    def test_runs_are_merged(self):
+        with mock.patch('repomgmt.tasks.run_reprepro_operations'):
+            tasks.process_incoming_for_repository('cisco')
+            tasks.process_incoming_for_repository('cisco')
+        ops = RepreproOperation.pending(Repository.objects.get(name='cisco'))
+        self.assertEquals([(op.arg_list, op.creates_builds) for op in ops],
+                          [(['processincoming', 'incoming'], True)])
+
+
+class IncomingWatcherTests(TestCase):
+    fixtures = ['test_series.yaml']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        mod = __import__('repomgmt.management.commands.repo-incoming-watcher')
+        self.module = getattr(mod.management.commands,
+                              'repo-incoming-watcher')
+
+    def write(self, name, contents):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fp:
+            fp.write(contents)
+        return path
+
+    def write_changes(self):
+        return self.write('nova_1.0_source.changes', textwrap.dedent('''\
+            Format: 1.8
+            Source: nova
+            Files:
+             d41d8cd98f00b204e9800998ecf8427e 3 python optional nova_1.0.dsc
+             d41d8cd98f00b204e9800998ecf8427e 5 python optional nova_1.0.tar.gz
+            '''))
+
+    def test_upload_complete(self):
+        changes = self.write_changes()
+        self.assertFalse(utils.upload_complete(changes))
+        self.write('nova_1.0.dsc', 'dsc')
+        self.write('nova_1.0.tar.gz', 'ta')
+        self.assertFalse(utils.upload_complete(changes))
+        self.write('nova_1.0.tar.gz', 'tarba')
+        self.assertTrue(utils.upload_complete(changes))
+
+        with open(changes, 'r') as fp:
+            contents = fp.read()
+        self.write('nova_1.0_source.changes',
+                   '-----BEGIN PGP SIGNED MESSAGE-----\n' + contents)
+        self.assertFalse(utils.upload_complete(changes))
+
+    def test_arrivals_are_debounced(self):
+        watcher = self.module.IncomingWatcher(2)
+        watcher.arrived('cisco', now=100)
+        watcher.arrived('cisco', now=101)
+        self.assertEquals(watcher.timeout(now=101), 2)
+        self.assertEquals(watcher.ready(now=102), [])
+        self.assertEquals(watcher.ready(now=103), ['cisco'])
+        self.assertIsNone(watcher.timeout())
+
+    def test_only_complete_uploads_are_processed(self):
+        command = self.module.Command()
+        with mock.patch.object(Repository, 'reprepro_incomingdir',
+                               self.tmpdir):
+            with mock.patch('repomgmt.tasks.process_incoming_for_repository'
+                            ) as subtask:
+                self.write_changes()
+                command.trigger(['cisco'])
+                self.assertFalse(subtask.delay.called)
+
+                self.write('nova_1.0.dsc', 'dsc')
+                self.write('nova_1.0.tar.gz', 'tarba')
+                command.trigger(['cisco'])
+                subtask.delay.assert_called_once_with('cisco')
+
+
+class BuildRecordCreationTests(TestCase):
+    fixtures = ['test_series.yaml']
+
+    dsc = textwrap.dedent("""\
+        -----BEGIN PGP SIGNED MESSAGE-----
+        Hash: SHA1
+
+        Format: 3.0 (quilt)
+        Source: %(name)s
+        Binary: %(name)s
+        Architecture: %(arch)s
+        Version: %(version)s
+        Files:
+         0123456789abcdef0123456789abcdef 1234 %(name)s_%(version)s.orig.tar.gz
+        """)
+
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.settings = override_settings(BASE_PUBLIC_REPO_DIR=self.outdir,
+                                          BASE_REPO_DIR='/base/repo/dir')
+        self.settings.enable()
+        self.repository = Repository.objects.get(name='cisco')
+        os.makedirs(os.path.join(self.repository.reprepro_outdir, 'pool'))
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.outdir)
+
+    def upload(self, name, version, arch):
+        path = 'pool/%s_%s.dsc' % (name, version)
+        with open(os.path.join(self.repository.reprepro_outdir, path),
+                  'w') as fp:
+            fp.write(self.dsc % {'name': name, 'version': version,
+                                 'arch': arch})
+        return ['add', 'folsom-proposed', 'dsc', 'main', 'source',
+                name, version, path]
+
+    def builds(self):
+        return sorted(BuildRecord.objects.values_list(
+                          'source_package_name', 'version', 'architecture'))
+
+    def test_create_for_uploads(self):
+        BuildRecord(series_id=1, architecture_id='i386',
+                    source_package_name='foo', version='1.0').save()
+        uploads = [BuildRecord.upload_from_hook_args(self.upload(*args))
+                   for args in [('foo', '1.0', 'any'),
+                                ('bar', '2.0', 'all'),
+                                ('baz', '3.0', 'amd64 armhf'),
+                                ('foo', '1.0', 'any')]]
+        with self.assertNumQueries(6):
+            self.assertEquals(
+                BuildRecord.create_for_uploads(self.repository, uploads), 3)
+        self.assertEquals(self.builds(), [('bar', '2.0', 'i386'),
+                                          ('baz', '3.0', 'amd64'),
+                                          ('foo', '1.0', 'amd64'),
+                                          ('foo', '1.0', 'i386')])
+        self.assertEquals(sorted(SourcePackageVersion.objects.values_list(
+                                     'pocket', 'name', 'version')),
+                          [('proposed', 'bar', '2.0'),
+                           ('proposed', 'baz', '3.0'),
+                           ('proposed', 'foo', '1.0')])
+
+    def test_new_upload_not_superseded_before_hook_catches_up(self):
+        series = Series.objects.get(pk=1)
+        SourcePackageVersion.record(series, 'proposed', 'foo', '1.0')
+        SourcePackageVersion.record(series, 'proposed', 'bar', '1.0')
+        uploads = [BuildRecord.upload_from_hook_args(
+                       self.upload('foo', '2.0', 'i386'))]
+        BuildRecord.create_for_uploads(self.repository, uploads)
+        br = BuildRecord.objects.get(source_package_name='foo')
+        self.assertFalse(br.superseded())
+        self.assertEquals(BuildRecord.sweep_superseded(), 0)
+        self.assertEquals(SourcePackageVersion.objects.get(
+                              name='bar').version, '1.0')
+
+    def test_ignores_removals(self):
+        self.assertIsNone(BuildRecord.upload_from_hook_args(
+            ['remove', 'folsom-proposed', 'dsc', 'main', 'source',
+             'foo', '1.0', 'pool/foo_1.0.dsc']))
+
+    def test_flush_queue_creates_builds_afterwards(self):
+        uploads = [self.upload('foo', '1.0', 'i386'),
+                   self.upload('bar', '1.0', 'amd64')]
+
+        def reprepro(cmd, override_env):
+            # What create-build-records.sh does
+            with open(override_env['REPOMGMT_BUILD_RECORD_QUEUE'], 'a') as fp:
+                for args in uploads:
+                    fp.write('%s\t\n' % ('\t'.join(args),))
+            self.assertEquals(BuildRecord.objects.count(), 0)
+            return ''
+
+        with mock.patch('repomgmt.utils.run_cmd') as run_cmd:
+            run_cmd.side_effect = reprepro
+            Series.objects.get(name='folsom').flush_queue()
+        self.assertEquals(self.builds(), [('bar', '1.0', 'amd64'),
+                                          ('foo', '1.0', 'i386')])
+
+    def test_unreadable_dsc_skips_only_that_upload(self):
+        uploads = [self.upload('foo', '1.0', 'i386'),
+                   self.upload('bar', '1.0', 'amd64')]
+        os.unlink(os.path.join(self.repository.reprepro_outdir,
+                               uploads[0][-1]))
+
+        def reprepro(cmd, override_env):
+            with open(override_env['REPOMGMT_BUILD_RECORD_QUEUE'], 'a') as fp:
+                for args in uploads:
+                    fp.write('%s\t\n' % ('\t'.join(args),))
+            return ''
+
+        with mock.patch('repomgmt.utils.run_cmd') as run_cmd:
+            run_cmd.side_effect = reprepro
+            Series.objects.get(name='folsom').flush_queue()
+        self.assertEquals(self.builds(), [('bar', '1.0', 'amd64')])
+        self.assertEquals(
+            RepreproOperation.objects.latest('pk').state,
+            RepreproOperation.DONE)
+
+    def test_build_record_failure_does_not_fail_reprepro(self):
+        def reprepro(cmd, override_env):
+            with open(override_env['REPOMGMT_BUILD_RECORD_QUEUE'], 'a') as fp:
+                fp.write('%s\t\n' % ('\t'.join(
+                             self.upload('foo', '1.0', 'i386')),))
+            return ''
+
+        with mock.patch('repomgmt.utils.run_cmd') as run_cmd:
+            run_cmd.side_effect = reprepro
+            with mock.patch.object(BuildRecord, 'create_for_uploads') as c:
+                c.side_effect = DatabaseError('locked')
+                Series.objects.get(name='folsom').flush_queue()
+        self.assertEquals(
+            RepreproOperation.objects.latest('pk').state,
+            RepreproOperation.DONE)
+
+    def test_hook_daemon_batches_uploads(self):
+        mod = __import__('repomgmt.management.commands.repo-hook-daemon')
+        module = getattr(mod.management.commands, 'repo-hook-daemon')
+        env = {'REPREPRO_BASE_DIR': '/base/repo/dir/cisco',
+               'REPREPRO_CAUSING_COMMAND': 'pull'}
+        events = [{'hook': 'create-build-records', 'env': env,
+                   'args': self.upload('foo%d' % (i,), '1.0', 'i386')}
+                  for i in range(3)]
+        with mock.patch.object(BuildRecord, 'create_for_uploads',
+                               wraps=BuildRecord.create_for_uploads) as create:
+            module.Command().dispatch_all(events)
+            self.assertEquals(create.call_count, 1)
+        self.assertEquals(len(self.builds()), 3)
+
+
+class HookDaemonTests(TestCase):
+    fixtures = ['test_series.yaml']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        mod = __import__('repomgmt.management.commands.repo-hook-daemon')
+        self.module = getattr(mod.management.commands, 'repo-hook-daemon')
+        self.spool = self.module.HookSpool(os.path.join(self.tmpdir, 'spool'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def event(self, codename, name, version, hook='update-source-packages'):
+        return {'hook': hook,
+                'args': ['add', codename, 'dsc', 'main', 'source',
+                         name, version, '%s_%s.dsc' % (name, version)],
+                'env': {'REPREPRO_BASE_DIR': '/base/repo/dir/cisco',
+                        'REPREPRO_CAUSING_COMMAND': 'processincoming'}}
+
+    @override_settings(BASE_REPO_DIR='/base/repo/dir')
+    def test_drain(self):
+        self.spool.add(self.event('folsom-proposed', 'nova', '1.0'))
+        self.spool.add(self.event('nosuchseries', 'nova', '1.0'))
+        self.spool.add(self.event('folsom', 'nova', '0.9'))
+        self.spool.add(self.event('folsom', 'nova', '0.9', hook='rm-rf'))
+
+        self.assertEquals(self.module.Command().drain(self.spool), 2)
+        self.assertEquals(self.spool.pending(), [])
+        self.assertEquals(len(os.listdir(self.spool.failed_path)), 2)
+        series = Series.objects.get(name='folsom')
+        self.assertEquals(series.get_source_packages(),
+                          {'stable': {'nova': '0.9'},
+                           'proposed': {'nova': '1.0'},
+                           'queued': {}})
+
+    @override_settings(BASE_REPO_DIR='/base/repo/dir')
+    def test_process_changes_runs_outside_the_batch(self):
+        self.spool.add(self.event('folsom-proposed', 'nova', '1.0'))
+        self.spool.add(self.event('folsom-proposed', 'nova', '1.0',
+                                  hook='process-changes'))
+        command = self.module.Command()
+        with mock.patch.object(command, 'dispatch_all') as dispatch_all, \
+                mock.patch.object(command, 'dispatch') as dispatch:
+            self.assertEquals(command.drain(self.spool), 2)
+        batched = dispatch_all.call_args[0][0]
+        self.assertEquals([e['hook'] for e in batched],
+                          ['update-source-packages'])
+        self.assertEquals(dispatch.call_args[0][0]['hook'], 'process-changes')
+
+    def test_process_changes_script_does_not_use_the_daemon(self):
+        script = render_to_string('reprepro/process-changes.sh.tmpl',
+                                  {'basedir': '/srv', 'hook_client': '/hc.py'})
+        self.assertNotIn('/hc.py', script)
+        self.assertIn('repo-process-changes', script)
+
+    def test_client_spools_when_daemon_is_down(self):
+        socket_path = os.path.join(self.tmpdir, 'sock')
+        with mock.patch.dict(os.environ, {'REPREPRO_BASE_DIR': '/foo'}), \
+                mock.patch('sys.stderr'):
+            hookclient.main(['hookclient.py', socket_path, self.spool.path,
+                             'create-build-records', 'add', 'folsom'])
+        names = self.spool.pending()
+        self.assertEquals(len(names), 1)
+        event = self.spool.load(names[0])
+        self.assertEquals(event['hook'], 'create-build-records')
+        self.assertEquals(event['args'], ['add', 'folsom'])
+        self.assertEquals(event['env']['REPREPRO_BASE_DIR'], '/foo')
+
+    def test_client_sends_to_daemon(self):
+        socket_path = os.path.join(self.tmpdir, 'sock')
+        server = self.module.HookServer(socket_path, self.spool)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            hookclient.send(socket_path, self.event('folsom', 'nova', '1.0'))
+            self.assertTrue(server.wakeup.is_set())
+            self.assertEquals(len(self.spool.pending()), 1)
+            self.assertRaises(IOError, hookclient.send, socket_path,
+                              self.event('folsom', 'nova', '1.0',
+                                         hook='rm-rf'))
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
 
 class RepositoryTests(TestCase):
     def test_repository_unicode(self):
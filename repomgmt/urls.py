@@ -30,8 +30,20 @@ urlpatterns = patterns('',
     # Builds
     url(r'^builds/(?P<build_id>\w+)/$', 'repomgmt.views.build_detail',
         name='build_detail'),
+    url(r'^builds/(?P<build_id>\d+)/log/$', 'repomgmt.views.build_log',
+        name='build_log'),
     url(r'^builds/$', 'repomgmt.views.build_list', name='build_list'),
 
+    # Failure triage
+    url(r'^failures/$', 'repomgmt.views.failure_signature_list',
+        name='failure_signature_list'),
+    url(r'^failures/(?P<signature_id>\d+)/$',
+        'repomgmt.views.failure_signature_detail',
+        name='failure_signature_detail'),
+
+    # Log search
+    url(r'^search/$', 'repomgmt.views.log_search', name='log_search'),
+
     # Package Sources
     url(r'^packagesources/$', 'repomgmt.views.pkg_sources_list',
                               name='pkg_sources_list'),
@@ -80,6 +92,8 @@ urlpatterns = patterns('',
     url(r'^docs/workflow/$', 'repomgmt.views.docs_workflow', name='docs_workflow'),
 
     # Puppet
+    url(r'^puppet/nodes/(?P<tarball_id>\d+)/$',
+        'repomgmt.views.puppet_node_manifest'),
     url(r'^puppet/(?P<build_record_id>\w+)/$',
         'repomgmt.views.puppet_manifest'),
 
@@ -15,10 +15,17 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 #
+import bisect
+import errno
+import hashlib
 import logging
 import os
 import re
+import sqlite3
+import struct
 import subprocess
+import time
+import zlib
 
 from django.conf import settings
 
@@ -60,6 +67,644 @@ def run_cmd(cmd, input=None, cwd=None, override_env=None,
     return stdout
 
 
+class CommandOutput(object):
+    """Splits streamed command output into lines
+
+    Each complete line is passed to line_callback as soon as it has
+    arrived. The output itself is only kept (and returned by getvalue())
+    if keep is True."""
+    def __init__(self, line_callback, keep=False):
+        self.line_callback = line_callback
+        self.keep = keep
+        self._chunks = []
+        self._partial = []
+
+    def feed(self, data):
+        if self.keep:
+            self._chunks.append(data)
+
+        if '\n' not in data:
+            self._partial.append(data)
+            return
+
+        lines = data.split('\n')
+        self._partial.append(lines[0])
+        lines[0] = ''.join(self._partial)
+        self._partial = [lines.pop()]
+        for line in lines:
+            self.line_callback(line)
+
+    def close(self):
+        """Passes on whatever is left after the last newline"""
+        self.line_callback(''.join(self._partial))
+        self._partial = []
+
+    def getvalue(self):
+        return ''.join(self._chunks)
+
+
+def tail_blocks(blocks, max_lines, max_bytes):
+    """Returns the last max_lines lines of some data
+
+    blocks yields the data backwards, a block at a time, starting from
+    the end. Blocks are only consumed until there are enough lines, and
+    never more than max_bytes of them."""
+    collected = []
+    newlines = 0
+    read = 0
+    at_start = True
+    for block in blocks:
+        if newlines > max_lines or read >= max_bytes:
+            at_start = False
+            break
+        if len(block) > max_bytes - read:
+            collected.append(block[len(block) - (max_bytes - read):])
+            at_start = False
+            break
+        collected.append(block)
+        newlines += block.count('\n')
+        read += len(block)
+
+    lines = ''.join(reversed(collected)).splitlines(True)
+    if not at_start and len(lines) > 1:
+        # The first line is most likely cut off
+        lines = lines[1:]
+    return ''.join(lines[-max_lines:])
+
+
+def tail(path, max_lines, max_bytes, block_size=8192):
+    """Returns the last max_lines lines of the file at path
+
+    The file is read backwards in blocks, so only the tail is ever
+    read, and never more than max_bytes of it."""
+    def blocks(fp):
+        fp.seek(0, os.SEEK_END)
+        pos = fp.tell()
+        while pos > 0:
+            size = min(block_size, pos)
+            pos -= size
+            fp.seek(pos)
+            yield fp.read(size)
+
+    with open(path, 'rb') as fp:
+        return tail_blocks(blocks(fp), max_lines, max_bytes)
+
+
+class PlainLog(object):
+    """Read access to an uncompressed log file"""
+    def __init__(self, path):
+        self.path = path
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def read(self, start=0, end=None, chunk_size=65536):
+        """Yields the data from offset start up to (not including) end"""
+        with open(self.path, 'rb') as fp:
+            fp.seek(start)
+            while end is None or start < end:
+                size = chunk_size
+                if end is not None:
+                    size = min(size, end - start)
+                data = fp.read(size)
+                if not data:
+                    break
+                start += len(data)
+                yield data
+
+    def tail(self, max_lines, max_bytes):
+        return tail(self.path, max_lines, max_bytes)
+
+
+class BlockLog(object):
+    """A log stored as a series of independently compressed gzip blocks
+
+    The data lives in <prefix>.gz, which, being a plain concatenation of
+    gzip members, can be read with zcat. <prefix>.idx has an entry for
+    each block with its offset and length, both compressed and not, so
+    any part of the log can be read without decompressing the rest."""
+    INDEX_ENTRY = struct.Struct('>QQII')
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.data_path = prefix + '.gz'
+        self.index_path = prefix + '.idx'
+
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    def index(self):
+        """List of (offset, compressed offset, length, compressed length)"""
+        with open(self.index_path, 'rb') as fp:
+            data = fp.read()
+        entry_size = self.INDEX_ENTRY.size
+        return [self.INDEX_ENTRY.unpack_from(data, i)
+                for i in range(0, len(data) - entry_size + 1, entry_size)]
+
+    def size(self):
+        entry_size = self.INDEX_ENTRY.size
+        with open(self.index_path, 'rb') as fp:
+            fp.seek(0, os.SEEK_END)
+            # Ignore any incomplete entry at the end
+            entries = fp.tell() / entry_size
+            if not entries:
+                return 0
+            fp.seek((entries - 1) * entry_size)
+            offset, _, length, __ = self.INDEX_ENTRY.unpack(
+                                                      fp.read(entry_size))
+        return offset + length
+
+    def _blocks(self, entries):
+        with open(self.data_path, 'rb') as fp:
+            for offset, c_offset, length, c_length in entries:
+                fp.seek(c_offset)
+                yield offset, zlib.decompress(fp.read(c_length),
+                                              16 + zlib.MAX_WBITS)
+
+    def read(self, start=0, end=None):
+        """Yields the data from offset start up to (not including) end"""
+        index = self.index()
+        first = max(bisect.bisect_right([e[0] for e in index], start) - 1, 0)
+        for offset, data in self._blocks(index[first:]):
+            if end is not None and offset >= end:
+                break
+            lo = max(start - offset, 0)
+            hi = len(data)
+            if end is not None:
+                hi = min(hi, end - offset)
+            if lo < hi:
+                yield data[lo:hi]
+
+    def tail(self, max_lines, max_bytes):
+        blocks = (data for _, data in self._blocks(reversed(self.index())))
+        return tail_blocks(blocks, max_lines, max_bytes)
+
+
+class BlockLogWriter(object):
+    """Appends to a BlockLog
+
+    Data is compressed and written out in blocks of block_size bytes,
+    or whatever has been written when flush_interval seconds have
+    passed since the last block, so that the log can be read while it
+    is being written. Each block is also passed to the indexer, if
+    there is one. on_close, if given, is called once the log has been
+    closed."""
+    def __init__(self, prefix, block_size=65536, flush_interval=10,
+                 indexer=None, on_close=None):
+        self.log = BlockLog(prefix)
+        self.on_close = on_close
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.indexer = indexer
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.time()
+
+        index = self.log.exists() and self.log.index() or []
+        if index:
+            offset, c_offset, length, c_length = index[-1]
+            self._offset = offset + length
+            self._c_offset = c_offset + c_length
+        else:
+            self._offset = 0
+            self._c_offset = 0
+
+        self._data = open(self.log.data_path, 'ab')
+        self._index = open(self.log.index_path, 'ab')
+        # Drop anything a crash left behind after the last complete block
+        self._data.truncate(self._c_offset)
+        self._index.truncate(len(index) * BlockLog.INDEX_ENTRY.size)
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flushes if flush_interval seconds have passed since the last
+        flush
+
+        Call this every so often while no data is coming in, or a quiet
+        command's last lines sit in the buffer until it says more."""
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        if not self._buffered:
+            return
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+        self._data.write(compressed)
+        self._data.flush()
+        self._index.write(BlockLog.INDEX_ENTRY.pack(self._offset,
+                                                    self._c_offset,
+                                                    len(data),
+                                                    len(compressed)))
+        self._index.flush()
+        if self.indexer is not None:
+            self.indexer.add(self._offset, data)
+        self._offset += len(data)
+        self._c_offset += len(compressed)
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        self._index.close()
+        if self.indexer is not None:
+            self.indexer.close()
+        if self.on_close is not None:
+            self.on_close()
+
+
+class LogSearchIndex(object):
+    """A full text index of logs, kept in an SQLite database
+
+    Logs are indexed in chunks, each remembering which log (identified
+    by a kind and a reference, e.g. 'build' and a build record id) it
+    came from and where in the log it starts. Uses FTS5 if SQLite has
+    it and FTS4 otherwise."""
+    HIGHLIGHT_START = '\x02'
+    HIGHLIGHT_END = '\x03'
+    # How many chunks search() looks at for each log it returns
+    SEARCH_OVERFETCH = 10
+
+    def __init__(self, path):
+        self.path = path
+        self._fts_version = None
+
+    def connect(self):
+        # LogIndexer hangs on to its connection, and builds finish in a
+        # different thread from the one writing their logs
+        conn = sqlite3.connect(self.path, timeout=30,
+                               check_same_thread=False)
+        conn.text_factory = str
+        if self._fts_version is None:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS chunks '
+                         '(id INTEGER PRIMARY KEY, kind TEXT, ref INTEGER, '
+                         ' offset INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS chunks_kind_ref '
+                         'ON chunks (kind, ref)')
+            self._fts_version = self._create_fts_table(conn)
+        return conn
+
+    def _create_fts_table(self, conn):
+        row = conn.execute("SELECT sql FROM sqlite_master "
+                           "WHERE name = 'chunks_fts'").fetchone()
+        if row is not None:
+            return 'fts5' in row[0].lower() and 5 or 4
+        try:
+            conn.execute('CREATE VIRTUAL TABLE chunks_fts USING fts5(body)')
+            return 5
+        except sqlite3.OperationalError:
+            conn.execute('CREATE VIRTUAL TABLE chunks_fts USING fts4(body)')
+            return 4
+
+    def add(self, kind, ref, offset, text, conn=None):
+        """Indexes a chunk of a log
+
+        Pass a connection from connect() to reuse it."""
+        own_conn = conn is None
+        if own_conn:
+            conn = self.connect()
+        try:
+            with conn:
+                cursor = conn.execute('INSERT INTO chunks (kind, ref, offset) '
+                                      'VALUES (?, ?, ?)', (kind, ref, offset))
+                conn.execute('INSERT INTO chunks_fts (rowid, body) '
+                             'VALUES (?, ?)', (cursor.lastrowid, text))
+        finally:
+            if own_conn:
+                conn.close()
+
+    def remove(self, kind, ref):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM chunks_fts WHERE rowid IN '
+                             '(SELECT id FROM chunks '
+                             ' WHERE kind = ? AND ref = ?)', (kind, ref))
+                conn.execute('DELETE FROM chunks WHERE kind = ? AND ref = ?',
+                             (kind, ref))
+        finally:
+            conn.close()
+
+    def contains(self, kind, ref):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT 1 FROM chunks '
+                                'WHERE kind = ? AND ref = ? LIMIT 1',
+                                (kind, ref)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def search(self, query, limit=50):
+        """Returns (kind, ref, offset, snippet) for the best matching logs
+
+        Matches in the snippet are surrounded by HIGHLIGHT_START and
+        HIGHLIGHT_END. Only the best matching chunk of each log is
+        returned. Only the best limit * SEARCH_OVERFETCH chunks are
+        looked at, so logs with lots of matching chunks can crowd others
+        out."""
+        conn = self.connect()
+        try:
+            if self._fts_version == 5:
+                snippet = 'snippet(chunks_fts, 0, ?, ?, ?, 16)'
+                order = 'rank'
+            else:
+                snippet = "snippet(chunks_fts, ?, ?, ?, 0, 16)"
+                order = 'chunks_fts.rowid DESC'
+            rows = conn.execute('SELECT c.kind, c.ref, c.offset, %s '
+                                'FROM chunks_fts '
+                                'JOIN chunks c ON c.id = chunks_fts.rowid '
+                                'WHERE chunks_fts MATCH ? '
+                                'ORDER BY %s LIMIT ?' % (snippet, order),
+                                (self.HIGHLIGHT_START, self.HIGHLIGHT_END,
+                                 '...', query,
+                                 limit * self.SEARCH_OVERFETCH))
+            results = []
+            seen = set()
+            for kind, ref, offset, snippet in rows:
+                if (kind, ref) in seen:
+                    continue
+                seen.add((kind, ref))
+                results.append((kind, ref, offset, snippet))
+                if len(results) >= limit:
+                    break
+            return results
+        finally:
+            conn.close()
+
+
+def log_search_index():
+    path = getattr(settings, 'LOG_SEARCH_INDEX', None)
+    if path is None:
+        path = os.path.join(settings.BUILD_LOG_DIR, 'search.sqlite')
+    return LogSearchIndex(path)
+
+
+def write_if_changed(path, contents, mode=None, force=False):
+    """Replaces path with contents unless it already has exactly that
+    (or force is set)
+
+    Returns whether anything was written."""
+    changed = True
+    if not force:
+        try:
+            with open(path, 'r') as fp:
+                changed = fp.read() != contents
+        except IOError:
+            pass
+
+    if changed:
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as fp:
+            fp.write(contents)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    elif mode is not None and os.stat(path).st_mode & 07777 != mode:
+        os.chmod(path, mode)
+    return changed
+
+
+def has_changes_files(path):
+    """Whether there's a .changes file in directory path
+
+    Just lists the directory, so it's cheap enough to call for every
+    repository every time incoming is processed."""
+    try:
+        names = os.listdir(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    return any(name.endswith('.changes') for name in names)
+
+
+def changes_file_list(contents):
+    """(name, size) of each file listed in a .changes file"""
+    start = contents.find('\nFiles:')
+    if start == -1:
+        return []
+    files = []
+    for line in contents[start + 1:].split('\n')[1:]:
+        if not line.startswith(' '):
+            break
+        # <md5sum> <size> <section> <priority> <name>
+        fields = line.split()
+        if len(fields) == 5 and fields[1].isdigit():
+            files.append((fields[4], int(fields[1])))
+    return files
+
+
+def upload_complete(changes_path):
+    """Whether a .changes file and all the files it lists have arrived
+    in full"""
+    try:
+        with open(changes_path, 'r') as fp:
+            contents = fp.read()
+    except IOError:
+        return False
+    if (contents.startswith('-----BEGIN PGP SIGNED MESSAGE-----') and
+            '-----END PGP SIGNATURE-----' not in contents):
+        return False
+    files = changes_file_list(contents)
+    if not files:
+        return False
+    dirname = os.path.dirname(changes_path)
+    for name, size in files:
+        try:
+            if os.stat(os.path.join(dirname, name)).st_size != size:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def hook_socket_path():
+    return getattr(settings, 'HOOK_SOCKET',
+                   os.path.join(settings.BASE_REPO_DIR, '.hooks.sock'))
+
+
+def hook_spool_dir():
+    return getattr(settings, 'HOOK_SPOOL_DIR',
+                   os.path.join(settings.BASE_REPO_DIR, '.hooks.spool'))
+
+
+class LogIndexer(object):
+    """Feeds a log to a LogSearchIndex as it is being written
+
+    Only whole lines are indexed, so words are never split between
+    chunks. Whatever is left after the last newline is indexed when the
+    indexer is closed. Indexing problems are logged, but never stop
+    the log from being written."""
+    def __init__(self, index, kind, ref):
+        self.index = index
+        self.kind = kind
+        self.ref = ref
+        self._pending = ''
+        self._pending_offset = None
+        self._conn = None
+
+    def _add(self, offset, text):
+        try:
+            if self._conn is None:
+                self._conn = self.index.connect()
+            self.index.add(self.kind, self.ref, offset, text, conn=self._conn)
+        except Exception:
+            logger.error('Failed to index %s %s' % (self.kind, self.ref),
+                         exc_info=True)
+
+    def add(self, offset, data):
+        if self._pending_offset is None:
+            self._pending_offset = offset
+        text = self._pending + data
+        cut = text.rfind('\n') + 1
+        if cut:
+            self._add(self._pending_offset, text[:cut])
+            self._pending_offset += cut
+        self._pending = text[cut:]
+
+    def close(self):
+        if self._pending:
+            self._add(self._pending_offset, self._pending)
+        self._pending = ''
+        self._pending_offset = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+# Things that differ between otherwise identical failures, most specific
+# first.
+FAILURE_NOISE = [
+    (re.compile(r'\d{4}-?\d{2}-?\d{2}[T -]?\d{2}:?\d{2}(:?\d{2})?'
+                r'(\.\d+)?Z?'), '<time>'),
+    (re.compile(r'\b\d{1,2}:\d{2}(:\d{2})?\b'), '<time>'),
+    (re.compile(r'[\w.+~-]*(/[\w.+~-]+)+/?'), '<path>'),
+    (re.compile(r'\b[0-9a-f]{7,}\b'), '<hash>'),
+    (re.compile(r'\b\d+:?\d*(\.\d+)+([-~+][\w.~+]*)?'), '<version>'),
+    (re.compile(r'\d+'), 'N'),
+    (re.compile(r'[ \t]+'), ' '),
+]
+
+
+def failure_excerpt(log_tail, max_lines=15):
+    """The lines of a log most likely to say why something failed
+
+    That is, the last max_lines non-blank lines before sbuild's summary
+    (if any), with box drawing left out."""
+    lines = log_tail.splitlines()
+    for i in range(len(lines) - 1, -1, -1):
+        if re.match(r'^\|\s*Summary\s*\|', lines[i]):
+            lines = lines[:i]
+            break
+    lines = [l for l in lines
+             if l.strip() and not re.match(r'^[+|][-+|\s]*$', l)]
+    return '\n'.join(lines[-max_lines:])
+
+
+def normalise_failure(excerpt):
+    lines = []
+    for line in excerpt.splitlines():
+        for rx, replacement in FAILURE_NOISE:
+            line = rx.sub(replacement, line)
+        lines.append(line.strip())
+    return '\n'.join(lines)
+
+
+def failure_signature(excerpt):
+    """Returns the normalised excerpt and a hash of it"""
+    normalised = normalise_failure(excerpt)
+    return normalised, hashlib.sha1(normalised).hexdigest()
+
+
+def stanza_field(stanza, name):
+    """Value of a single line field in a deb822 stanza, or None"""
+    prefix = name + ':'
+    if stanza.startswith(prefix):
+        start = len(prefix)
+    else:
+        start = stanza.find('\n' + prefix)
+        if start == -1:
+            return None
+        start += len(prefix) + 1
+    end = stanza.find('\n', start)
+    if end == -1:
+        end = len(stanza)
+    return stanza[start:end].strip()
+
+
+def parse_sources(chunks):
+    """Yields (package, version) for each stanza in a Sources index
+
+    chunks is an iterable of successive pieces of the index."""
+    rest = ''
+    for chunk in chunks:
+        stanzas = (rest + chunk).split('\n\n')
+        rest = stanzas.pop()
+        for stanza in stanzas:
+            name = stanza_field(stanza, 'Package')
+            version = stanza_field(stanza, 'Version')
+            if name and version:
+                yield name, version
+    name = stanza_field(rest, 'Package')
+    version = stanza_field(rest, 'Version')
+    if name and version:
+        yield name, version
+
+
+def dsc_architectures(path):
+    """The architectures listed in a .dsc file"""
+    with open(path, 'r') as fp:
+        return (stanza_field(fp.read(), 'Architecture') or '').split()
+
+
+def read_chunks(fp, chunk_size=65536):
+    return iter(lambda: fp.read(chunk_size), '')
+
+
+def gunzip_chunks(fp, chunk_size=65536):
+    """Decompresses gzip compressed fp a chunk at a time"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for data in read_chunks(fp, chunk_size):
+        yield decompressor.decompress(data)
+    yield decompressor.flush()
+
+
+# path -> ((inode, mtime, size), {package: version})
+_sources_cache = {}
+
+
+def read_sources_index(path):
+    """{package: version} from a Sources or Sources.gz index
+
+    Parsed indices are kept until the file is replaced or modified, so
+    don't change the returned dict."""
+    st = os.stat(path)
+    key = (st.st_ino, st.st_mtime, st.st_size)
+    cached = _sources_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with open(path, 'rb') as fp:
+        if path.endswith('.gz'):
+            pkgs = dict(parse_sources(gunzip_chunks(fp)))
+        else:
+            pkgs = dict(parse_sources(read_chunks(fp)))
+    _sources_cache[path] = (key, pkgs)
+    return pkgs
+
+
 def get_image_by_regex(cl, regex):
     rx = re.compile(regex)
     for image in cl.images.list():
@@ -16,6 +16,8 @@
 #   limitations under the License.
 #
 import datetime
+import json
+import sqlite3
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
@@ -23,16 +25,20 @@ from django.contrib.sites.models import get_current_site
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
 from django.forms import ModelForm
-from django.http import HttpResponse, HttpResponseRedirect
+from django.core.servers.basehttp import FileWrapper
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.utils import timezone
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 
 
 from repomgmt import utils, tasks
 from repomgmt.models import Architecture, BuildNode, BuildRecord
 from repomgmt.models import ChrootTarball, Repository, Series
 from repomgmt.models import UbuntuSeries, PackageSource, Subscription
-from repomgmt.models import PackageSourceBuildProblem
+from repomgmt.models import PackageSourceBuildProblem, FailureSignature
 
 
 class NewArchitectureForm(ModelForm):
@@ -146,7 +152,7 @@ def repository_list(request):
             form = NewRepositoryForm(request.POST)
             if form.is_valid():
                 repo = form.save()
-                repo.write_configuration()
+                repo.schedule_write_configuration()
                 return HttpResponseRedirect(reverse('repository_list'))
             else:
                 return new_repository_form(request)
@@ -170,7 +176,7 @@ def series_list(request, repository_name):
                 series.repository = repository
                 series.save()
                 form.save_m2m()
-                repository.write_configuration()
+                repository.schedule_write_configuration()
                 kwargs = {'repository_name': repository_name}
                 return HttpResponseRedirect(reverse('series_list',
                                                     kwargs=kwargs))
@@ -218,9 +224,17 @@ def promote_series(request):
                                             'series_name': series_name}))
 
 
+def puppet_node_manifest(request, tarball_id):
+    tarball = ChrootTarball.objects.get(pk=tarball_id)
+    return render(request, 'buildd.puppet.pp.tmpl',
+                          {'tarball': tarball,
+                           'settings': settings},
+                          content_type='text/plain')
+
+
 def puppet_manifest(request, build_record_id):
     build_record = BuildRecord.objects.get(pk=build_record_id)
-    return render(request, 'buildd.puppet.pp.tmpl',
+    return render(request, 'buildd-build.puppet.pp.tmpl',
                           {'build_record': build_record,
                            'settings': settings},
                           content_type='text/plain')
@@ -246,12 +260,192 @@ def build_detail(request, build_id):
             return HttpResponseRedirect(
                       reverse('build_detail', kwargs={'build_id': build_id}))
 
+    log = br.log()
     return render(request, 'build.html',
-                          {'build': br})
+                          {'build': br,
+                           'log_size': log is not None and log.size() or 0})
+
+
+def _parse_range(header, size):
+    """Parses a Range header asking for a single range of bytes
+
+    Returns (start, end), end being exclusive. Returns None if there's
+    no range we understand (so the whole thing should be sent) and False
+    if the range is outside the first size bytes."""
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+
+    start, _, end = header[len('bytes='):].partition('-')
+    try:
+        if start == '':
+            start = max(size - int(end), 0)
+            end = size
+        else:
+            start = int(start)
+            end = end and int(end) + 1 or size
+    except ValueError:
+        return None
+
+    end = min(end, size)
+    if start >= end:
+        return False
+    return start, end
+
+
+def _follow_build_log(request, br):
+    """Returns what has been added to a build log since a given offset
+
+    Answers right away, with at most BUILD_LOG_FOLLOW_MAX_BYTES of it.
+    X-Log-Offset is where to pick up next time and Retry-After tells the
+    client how long to wait before asking again."""
+    try:
+        since = max(int(request.GET['since']), 0)
+    except ValueError:
+        since = 0
+
+    # The log is complete by the time the state changes, so check the
+    # state first
+    finished = br.state not in (BuildRecord.BUILDING,
+                                BuildRecord.NEEDS_BUILDING)
+    log = br.log()
+    size = log is not None and log.size() or 0
+
+    data = ''
+    offset = size
+    if since < size:
+        end = min(size, since +
+                  getattr(settings, 'BUILD_LOG_FOLLOW_MAX_BYTES', 1048576))
+        data = ''.join(log.read(since, end))
+        offset = since + len(data)
+    caught_up = offset >= size
+    response = HttpResponse(data, content_type='text/plain')
+    response['X-Log-Offset'] = offset
+    response['X-Build-Finished'] = finished and caught_up and 'true' or 'false'
+    # There's more to come straight away if the answer was cut short
+    response['Retry-After'] = (caught_up and
+                               getattr(settings, 'BUILD_LOG_POLL_INTERVAL', 5)
+                               or 0)
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def build_log(request, build_id):
+    br = get_object_or_404(BuildRecord, id=build_id)
+    if 'since' in request.GET:
+        return _follow_build_log(request, br)
+
+    if br.log_expired:
+        return HttpResponse('This build log has expired.\n', status=410,
+                            content_type='text/plain')
+
+    log = br.log()
+    if log is None:
+        raise Http404
+
+    if 'tail' in request.GET:
+        try:
+            max_lines = int(request.GET['tail'])
+        except ValueError:
+            max_lines = 20
+        return HttpResponse(br.log_tail(max_lines), content_type='text/plain')
+
+    if request.GET.get('format') == 'gz' and isinstance(log, utils.BlockLog):
+        response = HttpResponse(FileWrapper(open(log.data_path, 'rb')),
+                                content_type='application/x-gzip')
+        response['Content-Disposition'] = ('attachment; filename=%s.log.gz' %
+                                           (br.pk,))
+        return response
+
+    # Anything written after this point is left for the next request
+    size = log.size()
+    byte_range = _parse_range(request.META.get('HTTP_RANGE'), size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % (size,)
+        return response
+
+    if byte_range is None:
+        start, end = 0, size
+        response = StreamingHttpResponse(log.read(start, end),
+                                         content_type='text/plain')
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(log.read(start, end), status=206,
+                                         content_type='text/plain')
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+    response['Content-Length'] = end - start
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _highlight(snippet):
+    index = utils.LogSearchIndex
+    return mark_safe(escape(snippet.decode('utf-8', 'replace'))
+                        .replace(index.HIGHLIGHT_START, '<b>')
+                        .replace(index.HIGHLIGHT_END, '</b>'))
+
+
+def log_search(request):
+    query = request.GET.get('q', '').strip()
+    results = []
+    error = None
+    if query:
+        try:
+            hits = utils.log_search_index().search(query)
+        except sqlite3.OperationalError, e:
+            hits = []
+            error = str(e)
+
+        builds = BuildRecord.objects.in_bulk([ref for kind, ref, _, __ in hits
+                                              if kind == 'build'])
+        problems = PackageSourceBuildProblem.objects.in_bulk(
+                                              [ref for kind, ref, _, __ in hits
+                                               if kind == 'problem'])
+        for kind, ref, offset, snippet in hits:
+            if kind == 'build' and ref in builds:
+                name = unicode(builds[ref])
+                url = reverse('build_detail', kwargs={'build_id': ref})
+            elif kind == 'problem' and ref in problems:
+                name = 'Build problem for %s' % (problems[ref].name,)
+                url = reverse('pkg_src_build_problem_detail',
+                              kwargs={'problem_id': ref})
+            else:
+                # Deleted since it was indexed
+                continue
+            results.append({'kind': kind,
+                            'id': ref,
+                            'name': name,
+                            'url': url,
+                            'offset': offset,
+                            'snippet': _highlight(snippet)})
+
+    if request.GET.get('format') == 'json':
+        return HttpResponse(json.dumps({'query': query,
+                                        'error': error,
+                                        'results': results}),
+                            content_type='application/json')
+
+    return render(request, 'search.html',
+                  {'query': query, 'error': error, 'results': results})
+
+
+BUILD_LIST_ORDERINGS = {'created': '-created',
+                        'build_time': '-build_time',
+                        'fail_stage': 'fail_stage'}
 
 
 def build_list(request):
-    builds = BuildRecord.objects.order_by('-created')
+    builds = BuildRecord.objects.all()
+
+    fail_stage = request.GET.get('fail_stage', '')
+    if fail_stage:
+        builds = builds.filter(fail_stage=fail_stage)
+
+    order = request.GET.get('order', 'created')
+    if order not in BUILD_LIST_ORDERINGS:
+        order = 'created'
+    builds = builds.order_by(BUILD_LIST_ORDERINGS[order], '-created')
+
     paginator = Paginator(builds, 25)
 
     page = request.GET.get('page')
@@ -264,7 +458,35 @@ def build_list(request):
         # If page is out of range (e.g. 9999), deliver last page of results.
         builds = paginator.page(paginator.num_pages)
     return render(request, 'builds.html',
-                          {'build_records': builds})
+                          {'build_records': builds,
+                           'fail_stage': fail_stage,
+                           'order': order})
+
+
+def failure_signature_list(request):
+    signatures = FailureSignature.objects.order_by('-last_seen')
+    paginator = Paginator(signatures, 25)
+
+    page = request.GET.get('page')
+    try:
+        signatures = paginator.page(page)
+    except PageNotAnInteger:
+        signatures = paginator.page(1)
+    except EmptyPage:
+        signatures = paginator.page(paginator.num_pages)
+    return render(request, 'failure_signatures.html',
+                          {'signatures': signatures})
+
+
+def failure_signature_detail(request, signature_id):
+    signature = get_object_or_404(FailureSignature, id=signature_id)
+    builds = signature.buildrecord_set.select_related('series__repository',
+                                                      'architecture')
+    problems = signature.packagesourcebuildproblem_set.all()
+    return render(request, 'failure_signature.html',
+                          {'signature': signature,
+                           'build_records': builds.order_by('-finished'),
+                           'problems': problems.order_by('-timestamp')})
 
 
 def tarball_list(request):